@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+
+def submit_many(experiments, context=None, **kwargs):
+    """Submits experiments (Experiment objects or dicts of their parameters) in given context; returns futures
+    of backend jobs ids (see mrunner.session.submit_many)"""
+    # imported on use, so importing mrunner stays cheap
+    from mrunner.session import submit_many as _submit_many
+    return _submit_many(experiments, context=context, **kwargs)
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of backends. Backend modules (with kubernetes, docker and paramiko libraries) are imported only
+once backend of given type is used, thus commands not submitting experiments start fast.
+"""
+import importlib
+
+BACKENDS = {
+    'kubernetes': 'mrunner.backends.k8s:KubernetesBackend',
+    'slurm': 'mrunner.backends.slurm:SlurmBackend',
+}
+
+
+def get_backend_class(backend_type):
+    try:
+        module_name, class_name = BACKENDS[backend_type].split(':')
+    except KeyError:
+        raise ValueError('Unknown backend type: {} (available: {})'.format(backend_type,
+                                                                            ', '.join(sorted(BACKENDS))))
+    return getattr(importlib.import_module(module_name), class_name)
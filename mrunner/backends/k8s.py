@@ -1,19 +1,130 @@
 # -*- coding: utf-8 -*-
+import collections
+import hashlib
+import io
+import json
 import logging
+import posixpath
+import random
 import re
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import attr
 from kubernetes import client, config
+from kubernetes.client.rest import ApiException
+from path import Path
 
 from mrunner.experiment import COMMON_EXPERIMENT_MANDATORY_FIELDS, COMMON_EXPERIMENT_OPTIONAL_FIELDS
-from mrunner.utils.docker_engine import DockerEngine
-from mrunner.utils.utils import make_attr_class, filter_only_attr
+from mrunner.utils.cache import FileCache, get_cache_dir
+from mrunner.utils.docker_engine import DockerEngine, create_code_archive
+from mrunner.utils.namesgenerator import id_generator
+from mrunner.utils.utils import make_attr_class, filter_only_attr, RateLimiter
 
 LOGGER = logging.getLogger(__name__)
 
 
+def project_namespace(project):
+    return re.sub(r'[ .,_-]+', '-', project)
+
+
 def _generate_project_namespace(args):
-    return re.sub(r'[ .,_-]+', '-', args.project)
+    return project_namespace(args.project)
+
+
+def _sanitize_label_value(value):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '-', str(value))[:63].strip('-_.')
+
+
+SWEEP_MODE_JOBS = 'jobs'
+SWEEP_MODE_INDEXED = 'indexed'
+SWEEP_MODE_WORKERS = 'workers'
+
+LABEL_PROJECT = 'mrunner/project'
+LABEL_SWEEP = 'mrunner/sweep'
+LABEL_EXPERIMENT = 'mrunner/experiment'
+LABEL_POOL = 'mrunner/pool'
+
+CODE_DELIVERY_IMAGE = 'image'
+CODE_DELIVERY_OVERLAY = 'overlay'
+# fields of experiment determining its docker image and code archive
+IMAGE_FIELDS = ['cwd', 'paths_to_copy', 'exclude', 'requirements', 'base_image', 'base_image_pull', 'buildkit',
+                'storage_dir', 'neptune_token_files', 'registry_url', 'registry_username', 'registry_password',
+                'google_project_id', 'project', 'namespace', 'code_delivery']
+
+
+def get_container_cmd(experiment, with_params=True):
+    """Command of experiment (by default with params), as run in experiment docker image"""
+    from mrunner.utils.docker_engine import rewrite_paths
+    cmd = experiment.cmd.command if with_params else ' '.join(experiment.cmd_without_params)
+    return [item for item in rewrite_paths(experiment.cwd, cmd).split(' ') if item]
+
+
+def generate_labels(experiment, with_experiment=True, with_sweep=True):
+    """Labels used to select jobs and pods of given project, sweep or experiment"""
+    labels = {LABEL_PROJECT: experiment.namespace}
+    if with_sweep and experiment.sweep_id:
+        labels[LABEL_SWEEP] = experiment.sweep_id
+    if with_experiment:
+        labels[LABEL_EXPERIMENT] = experiment.name
+    return {k: _sanitize_label_value(v) for k, v in labels.items()}
+
+
+def generate_label_selector(project, sweep_id=None, experiment_name=None):
+    labels = {LABEL_PROJECT: project_namespace(project), LABEL_SWEEP: sweep_id, LABEL_EXPERIMENT: experiment_name}
+    return ','.join('{}={}'.format(k, _sanitize_label_value(v)) for k, v in sorted(labels.items()) if v)
+
+
+def is_job_complete(job):
+    """Job (single, indexed, distributed or workers pool) completed all its pods successfully"""
+    return any(condition.type == 'Complete' and condition.status == 'True'
+               for condition in (job.status and job.status.conditions) or [])
+
+
+def generate_owner_references(owner):
+    """Resources owned by job are deleted together with it"""
+    if owner is None:
+        return None
+    return [client.V1OwnerReference(api_version='batch/v1', kind='Job', name=owner.metadata.name,
+                                    uid=owner.metadata.uid)]
+
+
+def get_storage_shard(experiment):
+    """Experiments are assigned to project storage shards by hash of their name and params"""
+    shards = int(experiment.storage_shards or 1)
+    if shards == 1:
+        return 0
+    key = ' '.join([experiment.name] + list(experiment.params))
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % shards
+
+
+def storage_shard_name(name, shard):
+    """First shard keeps names of resources of not sharded storage"""
+    return '{}-{}'.format(name, shard) if shard else name
+
+
+PROFILE_KEYS = ['requests', 'limits', 'node_selector', 'affinity', 'tolerations', 'priority_class',
+                'topology_spread', 'scheduler_name']
+
+
+def get_profile(experiment):
+    """Resource profile selected by experiment (from profiles defined in context) updated with its overrides"""
+    profile = {}
+    if experiment.profile:
+        if experiment.profile not in experiment.profiles:
+            raise ValueError('Unknown resource profile: {} (defined: {})'.format(experiment.profile,
+                                                                                ', '.join(experiment.profiles)))
+        profile.update(experiment.profiles[experiment.profile])
+    for key, value in experiment.profile_overrides.items():
+        if key in ['requests', 'limits', 'node_selector'] and value is not None:
+            value = dict(profile.get(key) or {}, **value)
+        profile[key] = value
+    unknown_keys = set(profile) - set(PROFILE_KEYS)
+    if unknown_keys:
+        raise ValueError('Unknown resource profile keys: {}'.format(', '.join(sorted(unknown_keys))))
+    return profile
 
 
 def _extract_cmd_without_params(args):
@@ -42,6 +153,29 @@ EXPERIMENT_OPTIONAL_FIELDS = [
     ('cmd_without_params', dict(init=False, default=attr.Factory(_extract_cmd_without_params, takes_self=True))),
     ('params', dict(init=False, default=attr.Factory(_extract_params, takes_self=True))),
     ('default_pvc_size', dict(default='')),
+    ('storage_shards', dict(default=1)),  # number of NFS servers (or volumes) of project storage
+    ('storage_class', dict(default=None)),  # RWX storage class used for project storage instead of NFS server
+    ('base_image_pull', dict(default='always')),  # always, if-not-present or number of minutes
+    ('buildkit', dict(default=False)),  # build image with docker buildx (with persistent pip cache)
+    ('sweep_id', dict(default='')),  # identifies all experiments submitted with single mrunner invocation
+    ('job_ttl', dict(default=None)),  # seconds after which finished jobs (and their pods) are deleted
+    # image pre-pull on nodes selected with node selector, before jobs are created
+    ('prepull_image', dict(default=False)),
+    ('prepull_node_selector', dict(default=attr.Factory(dict), type=dict)),
+    ('prepull_ready_fraction', dict(default=0.9)),
+    ('prepull_timeout', dict(default=600)),
+    # node-local scratch ('disk', 'memory' or host path of local SSD) used as STORAGE_DIR; synced to project storage
+    ('scratch', dict(default=None)),
+    ('scratch_size', dict(default=None)),
+    ('scratch_sync_interval', dict(default=60)),
+    # resource profiles (requests, limits, node selector, affinity, tolerations, priority class, ...)
+    ('code_delivery', dict(default=CODE_DELIVERY_IMAGE)),  # code baked into image or unpacked from storage
+    ('code_archive', dict(default=None)),  # set by backend: path of code archive on project storage
+    ('nodes', dict(default=1)),  # number of pods of distributed experiment
+    ('master_port', dict(default=29500)),
+    ('profiles', dict(default=attr.Factory(dict), type=dict)),
+    ('profile', dict(default=None)),
+    ('profile_overrides', dict(default=attr.Factory(dict), type=dict)),
     ('namespace', dict(init=False, default=attr.Factory(_generate_project_namespace, takes_self=True))),
 ]
 
@@ -52,40 +186,180 @@ ExperimentRunOnKubernetes = make_attr_class('ExperimentRunOnKubernetes', EXPERIM
 
 class Job(client.V1Job):
     RESOURCE_NAME_MAP = {'cpu': 'cpu', 'mem': 'memory', 'gpu': 'nvidia.com/gpu', 'tpu': 'cloud-tpus.google.com/v2'}
+    STORAGE_VOLUME_NAME = 'experiment-storage'
+    SCRATCH_VOLUME_NAME = 'scratch'
+    SCRATCH_MOUNT_PATH = '/scratch'
+    SCRATCH_SYNC_GRACE_PERIOD = 600  # time for final sync of scratch after experiment finished
+    CODE_VOLUME_NAME = 'code'
+    CODE_STORAGE_VOLUME_NAME = 'code-storage'
+    CODE_STORAGE_MOUNT_PATH = '/mnt/mrunner'
+    EXPERIMENT_DIR = '/experiment'  # working directory of docker image
+
+    # copies files modified since previous sync; final sync is done when sidecar is terminated
+    SCRATCH_SYNC_SCRIPT = '''
+cd "$SCRATCH_DIR"
+flush() {
+  touch /tmp/next
+  if [ -f /tmp/last ]; then find . -type f -newer /tmp/last; else find . -type f; fi > /tmp/files
+  [ -s /tmp/files ] && tar cf - -T /tmp/files | tar xf - -C "$STORAGE_DIR"
+  mv /tmp/next /tmp/last
+}
+trap 'flush; exit 0' TERM
+while true; do flush; sleep "$SYNC_INTERVAL" & wait $!; done
+'''
 
     def __init__(self, image, experiment):
+        name = self.generate_name(experiment)
+        ctr = self._create_container(name, image, experiment, args=experiment.params, env=self._get_env(experiment))
+        labels = generate_labels(experiment)
+        pod_spec = self._create_pod_spec(image, experiment, ctr)
+        pod_template = client.V1PodTemplateSpec(metadata=client.V1ObjectMeta(labels=labels), spec=pod_spec)
+        job_spec = client.V1JobSpec(template=pod_template, backoff_limit=0,  # , active_deadline_seconds=100)
+                                    ttl_seconds_after_finished=self._get_ttl(experiment))
+        super(Job, self).__init__(metadata=client.V1ObjectMeta(name=name, labels=labels), spec=job_spec)
+
+    @staticmethod
+    def generate_name(experiment):
         from mrunner.utils.namesgenerator import get_random_name
 
         experiment_name = re.sub(r'[ ,.\-_:;]+', '-', experiment.name)
-        name = '{}-{}'.format(experiment_name, get_random_name('-'))
+        return '{}-{}'.format(experiment_name, get_random_name('-'))
 
+    @staticmethod
+    def _get_ttl(experiment):
+        return int(experiment.job_ttl) if experiment.job_ttl is not None else None
+
+    @staticmethod
+    def _get_env(experiment):
         envs = experiment.env.copy()
         envs.update(experiment.cmd.env if experiment.cmd else {})
-        envs = {k: str(v) for k, v in envs.items()}
-
-        resources = dict([self._map_resources(name, qty) for name, qty in experiment.resources.items()])
-
-        internal_volume_name = 'experiment-storage'
-        vol = client.V1Volume(name=internal_volume_name,
-                              persistent_volume_claim=client.V1PersistentVolumeClaimVolumeSource(
-                                  claim_name=KubernetesBackend.NFS_PVC_NAME))
-        ctr = client.V1Container(name=name, image=image, args=experiment.params,
-                                 volume_mounts=[client.V1VolumeMount(mount_path=experiment.storage_dir,
-                                                                     name=internal_volume_name)],
-                                 resources=client.V1ResourceRequirements(
-                                     limits={k: v for k, v in resources.items()}),
-                                 env=[client.V1EnvVar(name=k, value=v) for k, v in envs.items()])
-        pod_spec = client.V1PodSpec(restart_policy='Never', containers=[ctr], volumes=[vol])
-        pod_template = client.V1PodTemplateSpec(spec=pod_spec)
-        job_spec = client.V1JobSpec(template=pod_template, backoff_limit=0)  # , active_deadline_seconds=100)
-        super(Job, self).__init__(metadata=client.V1ObjectMeta(name=name), spec=job_spec)
+        return {k: str(v) for k, v in envs.items()}
+
+    def _create_container(self, name, image, experiment, command=None, args=None, env=None, volume_mounts=()):
+        profile = get_profile(experiment)
+        # experiment resources take precedence over limits of profile; without requests in profile, kubernetes
+        # sets requests equal to limits
+        limits = dict([self._map_resources(resource_name, qty)
+                       for resource_name, qty in dict(profile.get('limits') or {}, **experiment.resources).items()])
+        requests = dict([self._map_resources(resource_name, qty)
+                         for resource_name, qty in (profile.get('requests') or {}).items()])
+        volume_mounts = [client.V1VolumeMount(mount_path=experiment.storage_dir,
+                                              name=self.STORAGE_VOLUME_NAME)] + list(volume_mounts)
+        if experiment.scratch:
+            # experiment writes into scratch (through STORAGE_DIR), while project storage is still readable
+            volume_mounts.append(self._create_scratch_mount(experiment))
+            env = dict(env or {}, STORAGE_DIR=self.SCRATCH_MOUNT_PATH)
+        if experiment.code_archive:
+            # code is unpacked by init container
+            volume_mounts.append(client.V1VolumeMount(mount_path=self.EXPERIMENT_DIR, name=self.CODE_VOLUME_NAME))
+        # image is shared by experiments, thus it has no entrypoint
+        command = command or get_container_cmd(experiment, with_params=False)
+        return client.V1Container(name=name, image=image, command=command, args=args,
+                                  volume_mounts=volume_mounts,
+                                  resources=client.V1ResourceRequirements(limits=limits or None,
+                                                                          requests=requests or None),
+                                  env=[client.V1EnvVar(name=k, value=v) for k, v in (env or {}).items()] +
+                                  self._create_pod_name_env(experiment))
+
+    @staticmethod
+    def _create_pod_name_env(experiment):
+        if not (experiment.scratch or '').startswith('/'):
+            return []
+        return [client.V1EnvVar(name='POD_NAME', value_from=client.V1EnvVarSource(
+            field_ref=client.V1ObjectFieldSelector(field_path='metadata.name')))]
+
+    def _create_pod_spec(self, image, experiment, ctr, volumes=(), shard=None):
+        volumes = [self._create_storage_volume(experiment, shard=shard)] + list(volumes)
+        pod_spec = client.V1PodSpec(restart_policy='Never', containers=[ctr], volumes=volumes,
+                                    **self._get_scheduling(experiment))
+        if experiment.code_archive:
+            self._add_code_unpacking(pod_spec, image, experiment)
+        if not experiment.scratch:
+            return pod_spec
+
+        volumes.append(self._create_scratch_volume(experiment))
+        # native sidecar (init container with restart policy Always) is terminated after experiment container exits
+        sync_ctr = client.V1Container(name='scratch-sync', image=image, restart_policy='Always',
+                                      command=['/bin/sh', '-c', self.SCRATCH_SYNC_SCRIPT],
+                                      env=[client.V1EnvVar(name='SCRATCH_DIR', value=self.SCRATCH_MOUNT_PATH),
+                                           client.V1EnvVar(name='STORAGE_DIR', value=experiment.storage_dir),
+                                           client.V1EnvVar(name='SYNC_INTERVAL',
+                                                           value=str(experiment.scratch_sync_interval))] +
+                                      self._create_pod_name_env(experiment),
+                                      volume_mounts=[client.V1VolumeMount(mount_path=experiment.storage_dir,
+                                                                          name=self.STORAGE_VOLUME_NAME),
+                                                     self._create_scratch_mount(experiment)])
+        pod_spec.init_containers = (pod_spec.init_containers or []) + [sync_ctr]
+        pod_spec.termination_grace_period_seconds = self.SCRATCH_SYNC_GRACE_PERIOD
+        return pod_spec
+
+    def _add_code_unpacking(self, pod_spec, image, experiment):
+        # code archives are stored on first shard of project storage
+        archive_path = posixpath.join(self.CODE_STORAGE_MOUNT_PATH, experiment.code_archive)
+        unpack_ctr = client.V1Container(name='code', image=image,
+                                        command=['tar', 'xf', archive_path, '-C', self.EXPERIMENT_DIR],
+                                        volume_mounts=[client.V1VolumeMount(mount_path=self.CODE_STORAGE_MOUNT_PATH,
+                                                                            name=self.CODE_STORAGE_VOLUME_NAME,
+                                                                            read_only=True),
+                                                       client.V1VolumeMount(mount_path=self.EXPERIMENT_DIR,
+                                                                            name=self.CODE_VOLUME_NAME)])
+        code_storage_volume = self._create_storage_volume(experiment, shard=0)
+        code_storage_volume.name = self.CODE_STORAGE_VOLUME_NAME
+        pod_spec.volumes += [client.V1Volume(name=self.CODE_VOLUME_NAME, empty_dir=client.V1EmptyDirVolumeSource()),
+                             code_storage_volume]
+        pod_spec.init_containers = [unpack_ctr] + (pod_spec.init_containers or [])
+
+    @staticmethod
+    def _get_scheduling(experiment):
+        """Pod spec scheduling fields from resource profile; affinity, tolerations and topology spread constraints
+        are raw kubernetes manifests (camelCase keys), which are serialized as they are"""
+        profile = get_profile(experiment)
+        topology_spread = []
+        for constraint in profile.get('topology_spread') or []:
+            # by default spread pods of project
+            constraint = dict(constraint)
+            constraint.setdefault('labelSelector',
+                                  {'matchLabels': generate_labels(experiment, with_experiment=False)})
+            topology_spread.append(constraint)
+        return {'node_selector': profile.get('node_selector') or None,
+                'affinity': profile.get('affinity') or None,
+                'tolerations': profile.get('tolerations') or None,
+                'priority_class_name': profile.get('priority_class'),
+                'topology_spread_constraints': topology_spread or None,
+                'scheduler_name': profile.get('scheduler_name')}
+
+    def _create_scratch_volume(self, experiment):
+        if experiment.scratch in ['disk', 'memory']:
+            return client.V1Volume(name=self.SCRATCH_VOLUME_NAME, empty_dir=client.V1EmptyDirVolumeSource(
+                medium='Memory' if experiment.scratch == 'memory' else None,
+                size_limit=self._map_resources('mem', experiment.scratch_size)[1] if experiment.scratch_size else None))
+        if experiment.scratch.startswith('/'):
+            return client.V1Volume(name=self.SCRATCH_VOLUME_NAME,
+                                   host_path=client.V1HostPathVolumeSource(path=experiment.scratch,
+                                                                           type='DirectoryOrCreate'))
+        raise ValueError('Unknown scratch type: {} (use disk, memory or path on node)'.format(experiment.scratch))
+
+    def _create_scratch_mount(self, experiment):
+        # pods sharing host path get separate subdirectories
+        sub_path_expr = '$(POD_NAME)' if experiment.scratch.startswith('/') else None
+        return client.V1VolumeMount(mount_path=self.SCRATCH_MOUNT_PATH, name=self.SCRATCH_VOLUME_NAME,
+                                    sub_path_expr=sub_path_expr)
+
+    def _create_storage_volume(self, experiment, shard=None):
+        shard = get_storage_shard(experiment) if shard is None else shard
+        return client.V1Volume(name=self.STORAGE_VOLUME_NAME,
+                               persistent_volume_claim=client.V1PersistentVolumeClaimVolumeSource(
+                                   claim_name=storage_shard_name(KubernetesBackend.NFS_PVC_NAME, shard)))
 
     def _map_resources(self, resource_name, resource_qty):
+        if resource_name not in self.RESOURCE_NAME_MAP:
+            raise ValueError('Unknown resource: {} (use {})'.format(resource_name,
+                                                                     ', '.join(sorted(self.RESOURCE_NAME_MAP))))
         name = self.RESOURCE_NAME_MAP[resource_name]
         if name == 'memory':
-            qty = resource_qty + 'i'
+            qty = str(resource_qty) + 'i'
         else:
-            qty = resource_qty
+            qty = str(resource_qty)
         return name, qty
 
     @staticmethod
@@ -93,6 +367,156 @@ class Job(client.V1Job):
         return re.sub(r'[ .,_=-]+', '-', arg)
 
 
+class SweepConfigMap(client.V1ConfigMap):
+    """
+    Holds shell script for each experiment of sweep; script is keyed with index of experiment in sweep
+    """
+    MAX_SIZE = 1000 * 1000  # kubernetes limits size of config map to 1MiB
+
+    def __init__(self, name, experiments, owner=None):
+        data = {str(idx): self._generate_script(experiment) for idx, experiment in enumerate(experiments)}
+        if sum(len(script) for script in data.values()) > self.MAX_SIZE:
+            raise ValueError('Sweep is too large to be run as single indexed job; split it into smaller ones')
+        metadata = client.V1ObjectMeta(name=name, labels=generate_labels(experiments[0], with_experiment=False),
+                                       owner_references=generate_owner_references(owner))
+        super(SweepConfigMap, self).__init__(metadata=metadata, data=data)
+
+    @staticmethod
+    def _generate_script(experiment):
+        from six.moves import shlex_quote
+
+        lines = ['export {}={}'.format(k, shlex_quote(v)) for k, v in sorted(Job._get_env(experiment).items())]
+        lines.append('exec {}'.format(' '.join(shlex_quote(item) for item in get_container_cmd(experiment))))
+        return '\n'.join(lines) + '\n'
+
+
+class IndexedJob(Job):
+    """
+    Single job running whole sweep; each pod runs experiment selected by its completion index
+    See details on https://kubernetes.io/docs/concepts/workloads/controllers/job/#completion-mode
+    """
+    SWEEP_VOLUME_NAME = 'sweep'
+    SWEEP_MOUNT_PATH = '/etc/mrunner/sweep'
+
+    def __init__(self, image, experiments, parallelism=None):
+        experiment = experiments[0]
+        for other in experiments[1:]:
+            for key in ['namespace', 'storage_dir', 'resources', 'profile', 'profile_overrides']:
+                if getattr(other, key) != getattr(experiment, key):
+                    raise ValueError('All experiments of indexed job shall have same {}'.format(key))
+
+        name = self.generate_name(experiment)
+        command = ['/bin/sh', '-c', '. {}/"$JOB_COMPLETION_INDEX"'.format(self.SWEEP_MOUNT_PATH)]
+        sweep_mount = client.V1VolumeMount(mount_path=self.SWEEP_MOUNT_PATH, name=self.SWEEP_VOLUME_NAME,
+                                           read_only=True)
+        ctr = self._create_container(name, image, experiment, command=command, volume_mounts=[sweep_mount])
+        sweep_volume = client.V1Volume(name=self.SWEEP_VOLUME_NAME,
+                                       config_map=client.V1ConfigMapVolumeSource(name=name))
+        labels = generate_labels(experiment, with_experiment=False)
+        pod_spec = self._create_pod_spec(image, experiment, ctr, volumes=[sweep_volume])
+        pod_template = client.V1PodTemplateSpec(metadata=client.V1ObjectMeta(labels=labels), spec=pod_spec)
+        # failure of one experiment shall not stop remaining ones
+        job_spec = client.V1JobSpec(template=pod_template, completion_mode='Indexed',
+                                    completions=len(experiments),
+                                    parallelism=int(parallelism) if parallelism else len(experiments),
+                                    backoff_limit_per_index=0,
+                                    ttl_seconds_after_finished=self._get_ttl(experiment))
+        super(Job, self).__init__(metadata=client.V1ObjectMeta(name=name, labels=labels), spec=job_spec)
+
+
+class WorkerPoolJob(Job):
+    """
+    Job of long-living workers, which run experiments taken from queue placed on project storage;
+    workers exit when queue is empty for idle_timeout seconds
+    """
+    WORKER_SCRIPT_PATH = '.mrunner/mrunner_worker.py'  # relative to experiment directory in docker image
+
+    def __init__(self, image, experiment, pool, queue_path, workers, idle_timeout=None):
+        from mrunner.utils.namesgenerator import get_random_name
+        from mrunner.worker import DEFAULT_IDLE_TIMEOUT
+
+        name = 'workers-{}'.format(get_random_name('-'))
+        command = ['python', self.WORKER_SCRIPT_PATH, '--queue', queue_path,
+                   '--idle-timeout', str(idle_timeout or DEFAULT_IDLE_TIMEOUT)]
+        ctr = self._create_container(name, image, experiment, command=command)
+        # pool is shared by sweeps, thus it is labeled with pool only (experiments of sweep are found in queue)
+        labels = generate_labels(experiment, with_experiment=False, with_sweep=False)
+        labels[LABEL_POOL] = pool
+        # queue is stored on first shard of project storage
+        pod_spec = self._create_pod_spec(image, experiment, ctr, shard=0)
+        pod_template = client.V1PodTemplateSpec(metadata=client.V1ObjectMeta(labels=labels), spec=pod_spec)
+        # workers catch failures of experiments; tolerate failures of workers (ex. evicted pods)
+        job_spec = client.V1JobSpec(template=pod_template, parallelism=workers, backoff_limit=workers,
+                                    ttl_seconds_after_finished=self._get_ttl(experiment))
+        super(Job, self).__init__(metadata=client.V1ObjectMeta(name=name, labels=labels), spec=job_spec)
+
+
+class DistributedJob(Job):
+    """
+    Indexed job running single experiment on multiple pods (nodes); pods are reachable by stable
+    DNS names (<job name>-<index>.<job name>) through headless service named after the job
+    """
+
+    def __init__(self, image, experiment):
+        name = self.generate_name(experiment)
+        nodes = int(experiment.nodes)
+        env = self._get_env(experiment)
+        env.update({'MASTER_ADDR': '{}-0.{}'.format(name, name), 'MASTER_PORT': str(experiment.master_port),
+                    'WORLD_SIZE': str(nodes)})
+        ctr = self._create_container(name, image, experiment, args=experiment.params, env=env)
+        ctr.env.append(client.V1EnvVar(name='RANK', value_from=client.V1EnvVarSource(
+            field_ref=client.V1ObjectFieldSelector(
+                field_path="metadata.annotations['{}']".format(JobsTable.INDEX_ANNOTATION)))))
+        labels = generate_labels(experiment)
+        pod_spec = self._create_pod_spec(image, experiment, ctr)
+        pod_spec.subdomain = name
+        pod_template = client.V1PodTemplateSpec(metadata=client.V1ObjectMeta(labels=labels), spec=pod_spec)
+        # failure of any pod fails whole experiment
+        job_spec = client.V1JobSpec(template=pod_template, completion_mode='Indexed', completions=nodes,
+                                    parallelism=nodes, backoff_limit=0,
+                                    ttl_seconds_after_finished=self._get_ttl(experiment))
+        super(Job, self).__init__(metadata=client.V1ObjectMeta(name=name, labels=labels), spec=job_spec)
+
+
+class DistributedJobSvc(client.V1Service):
+    """
+    Headless service providing DNS records of distributed job pods
+    """
+
+    def __init__(self, job, owner=None):
+        name = job.metadata.name
+        svc_spec = client.V1ServiceSpec(cluster_ip='None', selector={'job-name': name},
+                                        publish_not_ready_addresses=True)
+        metadata = client.V1ObjectMeta(name=name, labels=job.metadata.labels,
+                                       owner_references=generate_owner_references(owner))
+        super(DistributedJobSvc, self).__init__(metadata=metadata, spec=svc_spec)
+
+
+class ImagePrePullDaemonSet(client.V1DaemonSet):
+    """
+    Pulls image on all selected nodes: init container using image exits immediately,
+    and pod becomes ready (with tiny pause container) once image is present on node
+    """
+    PAUSE_IMAGE = 'k8s.gcr.io/pause:3.1'
+
+    def __init__(self, name, image, node_selector=None):
+        labels = {'mrunner/prepull': name}
+        prepull_ctr = client.V1Container(name='prepull', image=image, command=['sh', '-c', 'true'],
+                                         image_pull_policy='IfNotPresent')
+        pause_ctr = client.V1Container(name='pause', image=self.PAUSE_IMAGE,
+                                       resources=client.V1ResourceRequirements(requests={'cpu': '1m',
+                                                                                         'memory': '8Mi'}))
+        # GPU/TPU nodes are usually tainted
+        pod_spec = client.V1PodSpec(init_containers=[prepull_ctr], containers=[pause_ctr],
+                                    node_selector=node_selector or None,
+                                    tolerations=[client.V1Toleration(operator='Exists', effect='NoSchedule')],
+                                    termination_grace_period_seconds=0)
+        pod_template = client.V1PodTemplateSpec(metadata=client.V1ObjectMeta(labels=labels), spec=pod_spec)
+        ds_spec = client.V1DaemonSetSpec(selector=client.V1LabelSelector(match_labels=labels), template=pod_template)
+        super(ImagePrePullDaemonSet, self).__init__(metadata=client.V1ObjectMeta(name=name, labels=labels),
+                                                    spec=ds_spec)
+
+
 class StandardPVC(client.V1PersistentVolumeClaim):
 
     def __init__(self, name, size, access_mode):
@@ -110,9 +534,10 @@ class NFSDeployment(client.V1Deployment):
     LABELS = {'role': 'nfs-server'}
     IMAGE = 'k8s.gcr.io/volume-nfs:0.8'
 
-    def __init__(self, name, storage_pvc):
+    def __init__(self, name, storage_pvc, labels=None):
+        labels = labels or self.LABELS
         internal_volume_name = 'nfs-server-volume'
-        mount_path = '/exports'
+        mount_path = KubernetesBackend.STORAGE_EXPORT_PATH
 
         ctr = client.V1Container(name=name, image=self.IMAGE,
                                  ports=[client.V1ContainerPort(name=k, container_port=v)
@@ -122,12 +547,12 @@ class NFSDeployment(client.V1Deployment):
         volume_source = client.V1PersistentVolumeClaimVolumeSource(claim_name=storage_pvc)
         volume = client.V1Volume(name=internal_volume_name, persistent_volume_claim=volume_source)
         pod_spec = client.V1PodSpec(containers=[ctr], volumes=[volume])
-        pod_metadata = client.V1ObjectMeta(labels=self.LABELS)
+        pod_metadata = client.V1ObjectMeta(labels=labels)
         pod_template = client.V1PodTemplateSpec(metadata=pod_metadata, spec=pod_spec)
         rs_spec = client.V1ReplicaSetSpec(replicas=1,
-                                          selector=client.V1LabelSelector(match_labels=self.LABELS),
+                                          selector=client.V1LabelSelector(match_labels=labels),
                                           template=pod_template)
-        metadata = client.V1ObjectMeta(name=name, labels=self.LABELS)
+        metadata = client.V1ObjectMeta(name=name, labels=labels)
         super(NFSDeployment, self).__init__(metadata=metadata, spec=rs_spec)
 
 
@@ -136,10 +561,10 @@ class NFSSvc(client.V1Service):
     Service for NFS pod
     """
 
-    def __init__(self, name):
+    def __init__(self, name, selector=None):
         nfs_service_spec = client.V1ServiceSpec(ports=[client.V1ServicePort(name=k, port=v)
                                                        for k, v in NFSDeployment.PORTS.items()],
-                                                selector=NFSDeployment.LABELS)
+                                                selector=selector or NFSDeployment.LABELS)
         super(NFSSvc, self).__init__(metadata=client.V1ObjectMeta(name=name), spec=nfs_service_spec)
 
 
@@ -152,9 +577,12 @@ class NFSPv(client.V1PersistentVolume):
     """
     STORAGE_CLASS = 'nfs'
 
-    def __init__(self, name, nfs_server_ip):
+    def __init__(self, name, nfs_server_ip, claim_namespace=None, claim_name=None):
+        # PV is pre-bound to its claim, otherwise claim may bind to PV of other project (or shard)
+        claim_ref = client.V1ObjectReference(namespace=claim_namespace, name=claim_name) if claim_name else None
         pv_spec = client.V1PersistentVolumeSpec(capacity={'storage': '1Mi'},
                                                 access_modes=['ReadWriteMany'],
+                                                claim_ref=claim_ref,
                                                 storage_class_name=self.STORAGE_CLASS,
                                                 persistent_volume_reclaim_policy='Delete',
                                                 nfs=client.V1NFSVolumeSource(server=nfs_server_ip, path='/'))
@@ -174,54 +602,611 @@ class NFSPvc(client.V1PersistentVolumeClaim):
         super(NFSPvc, self).__init__(metadata=client.V1ObjectMeta(name=name), spec=pvc_spec)
 
 
+class StorageAccessDeployment(client.V1Deployment):
+    """
+    Pod with project storage (volume of RWX storage class) mounted, used to upload files into storage
+    """
+    LABELS = {'role': 'storage-access'}
+    IMAGE = 'busybox:1.36'
+
+    def __init__(self, name, storage_pvc):
+        volume_name = 'storage'
+        ctr = client.V1Container(name=name, image=self.IMAGE, command=['sh', '-c', 'trap "exit 0" TERM; '
+                                                                                   'while true; do sleep 1; done'],
+                                 volume_mounts=[client.V1VolumeMount(mount_path=KubernetesBackend.STORAGE_EXPORT_PATH,
+                                                                     name=volume_name)])
+        volume = client.V1Volume(name=volume_name,
+                                 persistent_volume_claim=client.V1PersistentVolumeClaimVolumeSource(
+                                     claim_name=storage_pvc))
+        pod_template = client.V1PodTemplateSpec(metadata=client.V1ObjectMeta(labels=self.LABELS),
+                                                spec=client.V1PodSpec(containers=[ctr], volumes=[volume]))
+        dep_spec = client.V1DeploymentSpec(replicas=1, selector=client.V1LabelSelector(match_labels=self.LABELS),
+                                           template=pod_template)
+        super(StorageAccessDeployment, self).__init__(metadata=client.V1ObjectMeta(name=name, labels=self.LABELS),
+                                                      spec=dep_spec)
+
+
+class QueuedSpec(collections.namedtuple('QueuedSpec', 'pool spec_id state name sweep_id exit_code')):
+    """Experiment put into queue of workers pool; state is name of queue subdirectory"""
+
+    @property
+    def phase(self):
+        from mrunner.worker import FileQueue
+
+        if self.state == FileQueue.DONE:
+            return 'Succeeded' if self.exit_code == 0 else 'Failed'
+        return {FileQueue.PENDING: 'Queued', FileQueue.RUNNING: 'Running'}.get(self.state, self.state)
+
+
+class JobsTable(object):
+    """
+    State of experiments (phase and exit code of their pods); single row per job and completion index
+    """
+    FINISHED_PHASES = ['Succeeded', 'Failed']
+    INDEX_ANNOTATION = 'batch.kubernetes.io/job-completion-index'
+
+    def __init__(self):
+        self._rows = {}
+        self._expected = 0
+
+    def expect(self, jobs):
+        """Number of experiments to finish is obtained from completions of jobs"""
+        self._expected = sum(job.spec.completions or 1 for job in jobs)
+
+    def update(self, pod):
+        """Updates table with pod state; returns True if state of experiment changed"""
+        labels = pod.metadata.labels or {}
+        annotations = pod.metadata.annotations or {}
+        key = (labels.get('job-name', pod.metadata.name), annotations.get(self.INDEX_ANNOTATION))
+
+        exit_code = None
+        for status in (pod.status.container_statuses or []):
+            if status.state and status.state.terminated:
+                exit_code = status.state.terminated.exit_code
+        row = (labels.get(LABEL_EXPERIMENT, ''), pod.status.phase, exit_code)
+        if self._rows.get(key) == row:
+            return False
+        self._rows[key] = row
+        return True
+
+    @property
+    def rows(self):
+        """Yields (job name, completion index, experiment name, phase, exit code)"""
+        for (job_name, index), (experiment, phase, exit_code) in sorted(self._rows.items(),
+                                                                        key=lambda item: (item[0][0],
+                                                                                          int(item[0][1] or 0))):
+            yield job_name, index, experiment, phase, exit_code
+
+    def count(self, phase):
+        return len([row for row in self._rows.values() if row[1] == phase])
+
+    @property
+    def finished(self):
+        finished = len([row for row in self._rows.values() if row[1] in self.FINISHED_PHASES])
+        return finished >= max(self._expected, len(self._rows))
+
+
 class KubernetesBackend(object):
     DEFAULT_STORAGE_PVC_SIZE = '40G'
     DEFAULT_STORAGE_PVC_NAME = 'storage'
     NFS_PVC_NAME = 'nfs'
+    STORAGE_ACCESS_NAME = 'storage-access'
+    DEFAULT_SUBMIT_WORKERS = 16
+    DEFAULT_API_QPS = 50
+    MAX_THROTTLED_RETRIES = 5
+    WATCH_TIMEOUT = 300
+    STORAGE_EXPORT_PATH = '/exports'  # project storage mount path in NFS server pod
+    STORAGE_POD_TIMEOUT = 300
+    EXEC_CHUNK_SIZE = 512 * 1024
+    QUEUES_DIR = '.mrunner/queues'  # relative to project storage
+    UPLOADS_DIR = '.mrunner/uploads'
+    CODE_DIR = '.mrunner/code'
+    PREPULL_POLL_INTERVAL = 5
 
-    def __init__(self):
+    SETUP_CACHE_FILENAME = 'k8s_setup.json'
+
+    @classmethod
+    def from_context(cls, context):
+        return cls(submit_workers=context.get('submit_workers'), api_qps=context.get('api_qps'),
+                   setup_cache_ttl=context.get('setup_cache_ttl'), push_workers=context.get('push_workers'))
+
+    def __init__(self, submit_workers=None, api_qps=None, setup_cache_ttl=None, push_workers=None):
         self._check_env()
-        config.load_kube_config()
-        self.core_api = client.CoreV1Api()
-        self.batch_api = client.BatchV1Api()
-        self.apps_api = client.AppsV1Api()
+        self._submit_workers = int(submit_workers or self.DEFAULT_SUBMIT_WORKERS)
+        self._push_workers = push_workers
+        self._docker_engine = None
+        self._rate_limiter = RateLimiter(float(api_qps or self.DEFAULT_API_QPS))
+
+        # project level resources are ensured once per invocation; optionally also remembered on disk for a while
+        self._configured_projects = set()
+        self._prepulled_images = set()
+        self._uploaded_code = set()
+        self._key_locks = collections.defaultdict(threading.Lock)
+        self._key_locks_lock = threading.Lock()
+        self._setup_cache = FileCache(get_cache_dir() / self.SETUP_CACHE_FILENAME,
+                                      ttl=float(setup_cache_ttl)) if setup_cache_ttl else None
+
+        # single api client (and its connections pool) is shared by all apis and submitting threads
+        configuration = client.Configuration()
+        config.load_kube_config(client_configuration=configuration)
+        configuration.connection_pool_maxsize = max(configuration.connection_pool_maxsize or 0,
+                                                    self._submit_workers)
+        self.api_client = client.ApiClient(configuration)
+        self.core_api = client.CoreV1Api(self.api_client)
+        self.batch_api = client.BatchV1Api(self.api_client)
+        self.apps_api = client.AppsV1Api(self.api_client)
 
     def run(self, experiment):
-        experiment = ExperimentRunOnKubernetes(**filter_only_attr(ExperimentRunOnKubernetes, experiment))
-        image = DockerEngine().build_and_publish_image(experiment=experiment)
+        return self.run_sweep([experiment, ])[0]
+
+    def run_sweep(self, experiments, mode=SWEEP_MODE_JOBS, parallelism=None, idle_timeout=None, submit_workers=None):
+        """Prepares jobs for all experiments first and then creates them concurrently (with submit_workers threads,
+        by default as configured for backend); returns jobs ids (in order of experiments, except of indexed mode,
+        in which single job runs all of them)"""
+        experiments = [ExperimentRunOnKubernetes(**filter_only_attr(ExperimentRunOnKubernetes, experiment))
+                       for experiment in experiments]
+        distributed = [experiment for experiment in experiments if int(experiment.nodes or 1) > 1]
+        if distributed and mode != SWEEP_MODE_JOBS:
+            raise ValueError('Distributed experiments (with nodes > 1) may be run only in {} sweep mode'.format(
+                SWEEP_MODE_JOBS))
+        if mode == SWEEP_MODE_INDEXED:
+            return [self.run_indexed(experiments, parallelism=parallelism), ]
+        if mode == SWEEP_MODE_WORKERS:
+            return self.run_on_workers(experiments, max_workers=parallelism, idle_timeout=idle_timeout)
+
+        # next image is built while previous ones are pushed; jobs are created once all images are published
+        jobs, job_ids, images = [], [], []
+        prepared_images = {}  # code is packed and hashed once per distinct image of sweep
+        for experiment in experiments:
+            self.ensure_project(experiment)
+            image, experiment = self.prepare_image(experiment, wait=False, cache=prepared_images)
+            images.append(image)
+            self.ensure_image_pulled(experiment, image)
+            if int(experiment.nodes or 1) > 1:
+                self.docker_engine.wait_for_push(image)
+                job_ids.append(self.run_distributed(image, experiment))
+            else:
+                jobs.append((experiment.namespace, Job(image, experiment)))
+                job_ids.append(None)
+
+        self.docker_engine.wait_for_push(*images)
+        # jobs ids are returned in order of experiments
+        created_job_ids = iter(self.create_jobs(jobs, workers=submit_workers))
+        return [job_id or next(created_job_ids) for job_id in job_ids]
+
+    def run_distributed(self, image, experiment):
+        """Runs experiment on multiple pods; their DNS names are provided by service owned by job"""
+        job = DistributedJob(image, experiment)
+        self._create_job_owning(experiment.namespace, job, 'svc', DistributedJobSvc(job))
+        LOGGER.info('job/{}: runs experiment on {} pods'.format(job.metadata.name, experiment.nodes))
+        return '{}/{}'.format(experiment.namespace, job.metadata.name)
+
+    def run_indexed(self, experiments, parallelism=None):
+        """Runs all experiments as single indexed job; all of them shall use same code and docker image"""
+        experiment = experiments[0]
+        self.ensure_project(experiment)
+        image, experiment = self.prepare_image(experiment)
+        self.ensure_image_pulled(experiment, image)
+        experiments = [attr.evolve(experiment_, code_archive=experiment.code_archive) for experiment_ in experiments]
+
+        job = IndexedJob(image, experiments, parallelism=parallelism)
+        job_name = job.metadata.name
+        # config map is validated before job is created; pods wait with start till it is available
+        config_map = SweepConfigMap(job_name, experiments)
+        self._create_job_owning(experiment.namespace, job, 'configmap', config_map)
+        LOGGER.info('job/{}: runs {} experiments'.format(job_name, len(experiments)))
+        return '{}/{}'.format(experiment.namespace, job_name)
 
-        self.configure_namespace(experiment)
-        self.configure_storage_for_project(experiment)
+    def run_on_workers(self, experiments, max_workers=None, idle_timeout=None):
+        """Puts experiments into queue of workers pool and starts additional workers if required; workers
+        pool is shared by all experiments using same docker image"""
+        from mrunner.worker import FileQueue
+        import mrunner.worker
 
-        for experiment in [experiment, ]:
-            job = Job(image, experiment)
-            job_name = job.to_dict()['metadata']['name']
-            self._ensure_resource('job', experiment.namespace, job_name, job)
+        experiment = experiments[0]
+        worker_script = '{}:{}'.format(Path(mrunner.worker.__file__).abspath(), WorkerPoolJob.WORKER_SCRIPT_PATH)
+        self.ensure_project(experiment)
+        image, experiment = self.prepare_image(
+            attr.evolve(experiment, paths_to_copy=experiment.paths_to_copy + [worker_script]))
+        self.ensure_image_pulled(experiment, image)
+
+        # workers unpack code once, thus pool is specific to both image and code
+        pool = hashlib.sha1((image + (experiment.code_archive or '')).encode('utf-8')).hexdigest()[:12]
+        queue_dir = posixpath.join(self.QUEUES_DIR, pool)
+        specs, spec_ids = {}, []
+        for experiment_ in experiments:
+            spec_id = FileQueue.new_spec_id(experiment_.name)
+            spec_ids.append(spec_id)
+            specs[FileQueue.spec_filename(spec_id)] = FileQueue.dumps({'name': experiment_.name,
+                                                                       'sweep_id': experiment_.sweep_id,
+                                                                       'command': get_container_cmd(experiment_),
+                                                                       'env': Job._get_env(experiment_)})
+        self.upload_to_storage(experiment.namespace, posixpath.join(queue_dir, FileQueue.PENDING), specs)
+
+        # scale pool up with number of queued experiments; workers exit by themselves when queue is empty
+        self._rate_limiter.acquire()
+        pool_jobs = self.batch_api.list_namespaced_job(experiment.namespace,
+                                                       label_selector='{}={}'.format(LABEL_POOL, pool))
+        active_workers = sum(job.status.active or 0 for job in pool_jobs.items)
+        new_workers = min(len(experiments), int(max_workers or len(experiments)) - active_workers)
+        LOGGER.info('Queued {} experiments for pool {} ({} active workers, starting {})'.format(
+            len(experiments), pool, active_workers, max(new_workers, 0)))
+        if new_workers > 0:
+            queue_path = posixpath.join(experiment.storage_dir, queue_dir)
+            job = WorkerPoolJob(image, experiment, pool, queue_path, new_workers, idle_timeout=idle_timeout)
+            self._create_job(experiment.namespace, job)
+        return ['{}/{}/{}'.format(experiment.namespace, pool, spec_id) for spec_id in spec_ids]
+
+    @property
+    def docker_engine(self):
+        if self._docker_engine is None:
+            self._docker_engine = DockerEngine(push_workers=self._push_workers)
+        return self._docker_engine
+
+    def prepare_image(self, experiment, wait=True, cache=None):
+        """Builds and publishes docker image of experiment; with overlay code delivery, image contains only
+        dependencies, and code archive is uploaded into project storage; unless wait is set, image may be still
+        pushed on return (see DockerEngine.wait_for_push); returns (image, updated experiment). Results are
+        remembered in cache dict (if given) and reused for experiments with same IMAGE_FIELDS"""
+        if cache is not None:
+            key = repr([getattr(experiment, field) for field in IMAGE_FIELDS])
+            if key not in cache:
+                image, prepared = self.prepare_image(experiment, wait=wait)
+                cache[key] = image, prepared.code_archive
+            image, code_archive = cache[key]
+            return image, attr.evolve(experiment, code_archive=code_archive)
+
+        if experiment.code_delivery == CODE_DELIVERY_IMAGE:
+            return self.docker_engine.build_and_publish_image(experiment=experiment, wait=wait), experiment
+        if experiment.code_delivery != CODE_DELIVERY_OVERLAY:
+            raise ValueError('Unknown code delivery: {} (use {} or {})'.format(
+                experiment.code_delivery, CODE_DELIVERY_IMAGE, CODE_DELIVERY_OVERLAY))
+
+        image = self.docker_engine.build_and_publish_deps_image(experiment=experiment, wait=wait)
+        code_hash, payload = create_code_archive(experiment)
+        filename = '{}.tar'.format(code_hash)
+        code_archive = posixpath.join(self.CODE_DIR, filename)
+        key = '{}/{}'.format(experiment.namespace, code_hash)
+        with self._key_lock('code', key):
+            if key not in self._uploaded_code:
+                from six.moves import shlex_quote
+
+                if self.exec_in_storage(experiment.namespace, ['sh', '-c', 'test -f {} && echo exists || true'.format(
+                        shlex_quote(posixpath.join(self.STORAGE_EXPORT_PATH, code_archive)))]).strip() != 'exists':
+                    self.upload_to_storage(experiment.namespace, self.CODE_DIR, {filename: payload})
+                    LOGGER.info('Uploaded code archive {} ({} bytes)'.format(code_hash, len(payload)))
+                self._uploaded_code.add(key)
+        return image, attr.evolve(experiment, code_archive=code_archive)
+
+    def _key_lock(self, *key):
+        """Returns lock of given setup step; steps with different keys are done concurrently"""
+        with self._key_locks_lock:
+            return self._key_locks[key]
+
+    def ensure_image_pulled(self, experiment, image):
+        """Pre-pulls image on selected nodes with short-living daemon set (if enabled); waits till image is
+        present on prepull_ready_fraction of nodes"""
+        if not experiment.prepull_image:
+            return
+        # concurrent submissions of experiments with the same image wait till it is pre-pulled
+        with self._key_lock('prepull', image):
+            if image not in self._prepulled_images:
+                self._prepulled_images.add(image)
+                self._prepull_image(experiment, image)
+
+    def _prepull_image(self, experiment, image):
+        self.docker_engine.wait_for_push(image)
+
+        name = 'prepull-{}'.format(hashlib.sha1(image.encode('utf-8')).hexdigest()[:12])
+        daemon_set = ImagePrePullDaemonSet(name, image, node_selector=experiment.prepull_node_selector)
+        self._ensure_resource('ds', experiment.namespace, name, daemon_set)
+        try:
+            deadline = time.time() + float(experiment.prepull_timeout)
+            while True:
+                resource = self.apps_api.read_namespaced_daemon_set_status(name, experiment.namespace)
+                status = resource.status
+                desired, ready = status.desired_number_scheduled or 0, status.number_ready or 0
+                LOGGER.debug('ds/{}: image {} present on {}/{} nodes'.format(name, image, ready, desired))
+                # once controller observed daemon set, desired number of pods is known
+                observed = (status.observed_generation or 0) >= (resource.metadata.generation or 1)
+                if observed and not desired:
+                    LOGGER.warning('No nodes match selector of ds/{} ({}); image {} is not pre-pulled'.format(
+                        name, experiment.prepull_node_selector, image))
+                    break
+                if desired and ready >= float(experiment.prepull_ready_fraction) * desired:
+                    LOGGER.info('Image {} pulled on {}/{} nodes'.format(image, ready, desired))
+                    break
+                if time.time() > deadline:
+                    LOGGER.warning('Image {} pulled only on {}/{} nodes; not waiting longer'.format(image, ready,
+                                                                                                     desired))
+                    break
+                time.sleep(self.PREPULL_POLL_INTERVAL)
+        finally:
+            self.apps_api.delete_namespaced_daemon_set(name, experiment.namespace, propagation_policy='Background')
+
+    def upload_to_storage(self, namespace, remote_dir, files):
+        """Uploads files (name -> payload) into directory on project storage; files are extracted aside and then
+        moved into remote_dir, so they appear there atomically"""
+        from six.moves import shlex_quote
+
+        payload = io.BytesIO()
+        with tarfile.open(fileobj=payload, mode='w') as tar_file:
+            for filename, data in sorted(files.items()):
+                info = tarfile.TarInfo(filename)
+                info.size = len(data)
+                info.mtime = time.time()
+                tar_file.addfile(info, io.BytesIO(data))
+        payload = payload.getvalue()
+
+        target_dir = posixpath.join(self.STORAGE_EXPORT_PATH, remote_dir)
+        tmp_dir = posixpath.join(self.STORAGE_EXPORT_PATH, self.UPLOADS_DIR, id_generator(8))
+        # head reads exactly payload size, because stdin of exec can't be closed
+        self.exec_in_storage(namespace, ['sh', '-c', 'mkdir -p {0} {1} && head -c {2} | tar xmf - -C {1} && '
+                                                     'mv {1}/* {0}/ && rmdir {1}'.format(shlex_quote(target_dir),
+                                                                                         shlex_quote(tmp_dir),
+                                                                                         len(payload))],
+                             stdin=payload)
+        LOGGER.debug('Uploaded {} files ({} bytes) into {}'.format(len(files), len(payload), remote_dir))
+
+    def exec_in_storage(self, namespace, command, stdin=None):
+        """Runs command in storage pod, which has (first shard of) project storage mounted under STORAGE_EXPORT_PATH"""
+        from kubernetes.stream import stream
+
+        # stream temporarily replaces request method of api client, thus separate one is used
+        core_api = client.CoreV1Api(client.ApiClient(self.api_client.configuration))
+        resp = stream(core_api.connect_get_namespaced_pod_exec, self._get_storage_pod(namespace), namespace,
+                      command=command, stdin=stdin is not None, stdout=True, stderr=True, tty=False,
+                      _preload_content=False)
+        if stdin is not None:
+            for offset in range(0, len(stdin), self.EXEC_CHUNK_SIZE):
+                resp.write_stdin(stdin[offset:offset + self.EXEC_CHUNK_SIZE])
+        stdout, stderr = [], []
+        while resp.is_open():
+            resp.update(timeout=1)
+            stdout.append(resp.read_stdout(timeout=0))
+            stderr.append(resp.read_stderr(timeout=0))
+        resp.close()
+        if resp.returncode:
+            raise RuntimeError('Command {} failed in storage pod: {}'.format(command, ''.join(stderr)))
+        return ''.join(stdout)
+
+    def _get_storage_pod(self, namespace):
+        # NFS server of first shard or storage access pod (for storage class based storage)
+        label_selector = 'role in ({},{})'.format(NFSDeployment.LABELS['role'], StorageAccessDeployment.LABELS['role'])
+        deadline = time.time() + self.STORAGE_POD_TIMEOUT
+        while True:
+            pods = self.core_api.list_namespaced_pod(namespace, label_selector=label_selector,
+                                                     field_selector='status.phase=Running')
+            if pods.items:
+                return pods.items[0].metadata.name
+            if time.time() > deadline:
+                raise RuntimeError('Storage pod of {} project is not running'.format(namespace))
+            LOGGER.debug('Waiting for storage pod in {} namespace'.format(namespace))
+            time.sleep(2)
+
+    def create_jobs(self, jobs, workers=None):
+        """Creates (namespace, job) pairs using bounded pool of threads; returns "namespace/name" jobs ids"""
+        workers = int(workers or self._submit_workers)
+        with ThreadPoolExecutor(max_workers=min(workers, len(jobs)) or 1) as executor:
+            futures = [executor.submit(self._create_job, namespace, job) for namespace, job in jobs]
+
+        job_ids, errors = [], []
+        for (namespace, job), future in zip(jobs, futures):
+            if future.exception():
+                errors.append('job/{}: {}'.format(job.metadata.name, future.exception()))
+            else:
+                job_ids.append('{}/{}'.format(namespace, job.metadata.name))
+        if errors:
+            raise RuntimeError('Failed to create {}/{} jobs:\n{}'.format(len(errors), len(jobs), '\n'.join(errors)))
+        return job_ids
+
+    def _create_job_owning(self, namespace, job, resource_type, resource):
+        """Creates job and resource owned by it (thus deleted together with job); job is deleted if resource
+        could not be created, so its pods don't wait for resource forever"""
+        created_job = self._create_job(namespace, job)
+        resource.metadata.owner_references = generate_owner_references(created_job)
+        try:
+            self._ensure_resource(resource_type, namespace, resource.metadata.name, resource)
+        except Exception:
+            LOGGER.debug('job/{}: deleting, as {}/{} could not be created'.format(job.metadata.name, resource_type,
+                                                                                 resource.metadata.name))
+            self._rate_limiter.acquire()
+            self.batch_api.delete_namespaced_job(job.metadata.name, namespace, propagation_policy='Background')
+            raise
+        return created_job
+
+    def _create_job(self, namespace, job):
+        for attempt in range(self.MAX_THROTTLED_RETRIES + 1):
+            self._rate_limiter.acquire()
+            try:
+                resource = self.batch_api.create_namespaced_job(namespace=namespace, body=job)
+                LOGGER.debug('job/{} created'.format(job.metadata.name))
+                return resource
+            except ApiException as e:
+                if e.status != 429 or attempt == self.MAX_THROTTLED_RETRIES:
+                    raise
+                retry_after = (e.headers or {}).get('Retry-After')
+                delay = float(retry_after) if retry_after else (2 ** attempt) * (0.5 + random.random() / 2)
+                LOGGER.debug('job/{}: throttled by API server; retry in {:.1f}s'.format(job.metadata.name, delay))
+                time.sleep(delay)
+
+    def ensure_project(self, experiment):
+        """Ensures namespace and storage of experiment project; done once per (cluster, namespace)"""
+        key = '{}/{}'.format(self.api_client.configuration.host, experiment.namespace)
+        # projects are set up concurrently; experiments of project wait till its setup is done
+        with self._key_lock('project', key):
+            if key in self._configured_projects:
+                return
+            if self._setup_cache and self._setup_cache.get(key):
+                LOGGER.debug('{}: project resources recently ensured; skipping'.format(key))
+            else:
+                self.configure_namespace(experiment)
+                self.configure_storage_for_project(experiment)
+                if self._setup_cache:
+                    self._setup_cache.set(key, True)
+            self._configured_projects.add(key)
+
+    def delete_jobs(self, namespace, label_selector, only_succeeded=False, dry_run=False):
+        """Deletes selected jobs (or only completed ones); pods (and sweep config maps) are deleted in background;
+        returns names of deleted jobs (with dry_run: names of jobs which would be deleted)"""
+        self._rate_limiter.acquire()
+        jobs = self.batch_api.list_namespaced_job(namespace, label_selector=label_selector).items
+        if only_succeeded:
+            jobs = [job for job in jobs if is_job_complete(job)]
+        job_names = sorted(job.metadata.name for job in jobs)
+        if dry_run or not job_names:
+            return job_names
+
+        if only_succeeded:
+            # completion can't be selected with field selector (it counts succeeded pods), thus jobs are deleted by name
+            for job_name in job_names:
+                self._rate_limiter.acquire()
+                try:
+                    self.batch_api.delete_namespaced_job(job_name, namespace, propagation_policy='Background')
+                except ApiException as e:
+                    if e.status != 404:
+                        raise
+        else:
+            self._rate_limiter.acquire()
+            self.batch_api.delete_collection_namespaced_job(namespace, label_selector=label_selector,
+                                                            propagation_policy='Background')
+        LOGGER.debug('{}: deleted {} jobs selected with {}'.format(namespace, len(job_names), label_selector))
+        return job_names
+
+    def list_queued(self, namespace, sweep_id=None, experiment_name=None):
+        """Lists experiments of selected sweep (or all) put into queues of workers pools (pending, running and done
+        ones); queues are looked up only in projects which have workers pools"""
+        from six.moves import shlex_quote
+
+        self._rate_limiter.acquire()
+        if not self.batch_api.list_namespaced_job(namespace, label_selector=LABEL_POOL).items:
+            return []
+        # specs are single line JSONs with sorted keys
+        pattern = '"sweep_id": {}'.format(json.dumps(sweep_id)) if sweep_id else '"command": '
+        queues_dir = posixpath.join(self.STORAGE_EXPORT_PATH, self.QUEUES_DIR)
+        output = self.exec_in_storage(namespace, ['sh', '-c', 'cd {} 2>/dev/null && grep -H -F {} */*/*.json || true'
+                                                  .format(shlex_quote(queues_dir), shlex_quote(pattern))])
+        specs = []
+        for line in output.splitlines():
+            path, found, payload = line.partition('.json:')
+            if not found:
+                continue
+            pool, state, spec_id = path.split('/')
+            spec = json.loads(payload)
+            if experiment_name and spec.get('name') != experiment_name:
+                continue
+            specs.append(QueuedSpec(pool, spec_id, state, spec.get('name'), spec.get('sweep_id'),
+                                    (spec.get('result') or {}).get('exit_code')))
+        return specs
+
+    def delete_queued(self, namespace, sweep_id=None, experiment_name=None, dry_run=False):
+        """Removes selected experiments, which are still pending, from queues of workers pools (running ones are
+        finished by workers); returns removed specs (with dry_run: specs which would be removed)"""
+        from six.moves import shlex_quote
+        from mrunner.worker import FileQueue
+
+        specs = [spec for spec in self.list_queued(namespace, sweep_id=sweep_id, experiment_name=experiment_name)
+                 if spec.state == FileQueue.PENDING]
+        if dry_run or not specs:
+            return specs
+        paths = ['{}/{}/{}'.format(spec.pool, spec.state, FileQueue.spec_filename(spec.spec_id)) for spec in specs]
+        queues_dir = posixpath.join(self.STORAGE_EXPORT_PATH, self.QUEUES_DIR)
+        # spec might be claimed by worker meanwhile; only actually removed ones are printed
+        output = self.exec_in_storage(namespace, ['sh', '-c', 'cd {} && for f in {}; do rm "$f" 2>/dev/null && '
+                                                  'echo "$f"; done; true'.format(
+                                                      shlex_quote(queues_dir),
+                                                      ' '.join(shlex_quote(path) for path in paths))])
+        removed = set(output.split())
+        return [spec for spec, path in zip(specs, paths) if path in removed]
+
+    def follow(self, namespace, label_selector, until_finished=False, timeout=None):
+        """Yields table of experiments state after each change of selected pods; state is obtained from single
+        watch stream, which is resumed from last seen resource version"""
+        from kubernetes import watch
+
+        table = JobsTable()
+        resource_version = self._relist(table, namespace, label_selector)
+        yield table
+        deadline = time.time() + timeout if timeout else None
+        while not (until_finished and table.finished) and (not deadline or time.time() < deadline):
+            stream_timeout = int(max(deadline - time.time(), 1)) if deadline else self.WATCH_TIMEOUT
+            watcher = watch.Watch()
+            try:
+                for event in watcher.stream(self.core_api.list_namespaced_pod, namespace,
+                                            label_selector=label_selector, resource_version=resource_version,
+                                            timeout_seconds=stream_timeout):
+                    pod = event['object']
+                    resource_version = pod.metadata.resource_version
+                    if table.update(pod):
+                        yield table
+                    if until_finished and table.finished:
+                        watcher.stop()
+                        break
+            except ApiException as e:
+                if e.status != 410:
+                    raise
+                # resource version is too old (history compacted on server side); list from scratch
+                LOGGER.debug('Watch expired; listing pods again')
+                resource_version = self._relist(table, namespace, label_selector)
+                yield table
+
+    def _relist(self, table, namespace, label_selector):
+        jobs = self.batch_api.list_namespaced_job(namespace, label_selector=label_selector)
+        table.expect(jobs.items)
+        pods = self.core_api.list_namespaced_pod(namespace, label_selector=label_selector)
+        for pod in pods.items:
+            table.update(pod)
+        return pods.metadata.resource_version
 
     def configure_namespace(self, experiment):
         namespace = client.V1Namespace(metadata=client.V1ObjectMeta(name=experiment.namespace))
         self._ensure_resource('namespace', None, experiment.namespace, namespace)
 
     def configure_storage_for_project(self, experiment):
-        """Configures storage as in https://github.com/kubernetes/examples/tree/master/staging/volumes/nfs"""
-        nfs_svc_name = 'nfs-server'
-        nfs_pv_name = 'pvc-nfs-{}'.format(experiment.namespace)
+        """Configures storage as in https://github.com/kubernetes/examples/tree/master/staging/volumes/nfs;
+        each shard of storage gets separate NFS server (or volume of RWX storage class)"""
+        for shard in range(int(experiment.storage_shards or 1)):
+            if experiment.storage_class:
+                self._configure_storage_class_shard(experiment, shard)
+            else:
+                self._configure_nfs_shard(experiment, shard)
+        if experiment.storage_class:
+            self._ensure_resource('dep', experiment.namespace, self.STORAGE_ACCESS_NAME,
+                                  StorageAccessDeployment(name=self.STORAGE_ACCESS_NAME, storage_pvc=self.NFS_PVC_NAME))
+
+    def _configure_storage_class_shard(self, experiment, shard):
+        nfs_pvc_name = storage_shard_name(self.NFS_PVC_NAME, shard)
+        pvc = StandardPVC(name=nfs_pvc_name, size=experiment.default_pvc_size or self.DEFAULT_STORAGE_PVC_SIZE,
+                          access_mode='ReadWriteMany')
+        pvc.spec.storage_class_name = experiment.storage_class
+        self._ensure_resource('pvc', experiment.namespace, nfs_pvc_name, pvc)
+
+    def _configure_nfs_shard(self, experiment, shard):
+        storage_pvc_name = storage_shard_name(self.DEFAULT_STORAGE_PVC_NAME, shard)
+        nfs_svc_name = storage_shard_name('nfs-server', shard)
+        nfs_pv_name = storage_shard_name('pvc-nfs-{}'.format(experiment.namespace), shard)
+        nfs_pvc_name = storage_shard_name(self.NFS_PVC_NAME, shard)
+        # role label differs between shards, so service of each shard selects only its NFS server
+        labels = {'role': nfs_svc_name}
 
-        self._ensure_resource('pvc', experiment.namespace, self.DEFAULT_STORAGE_PVC_NAME,
-                              StandardPVC(name=self.DEFAULT_STORAGE_PVC_NAME,
+        self._ensure_resource('pvc', experiment.namespace, storage_pvc_name,
+                              StandardPVC(name=storage_pvc_name,
                                           size=experiment.default_pvc_size or self.DEFAULT_STORAGE_PVC_SIZE,
                                           access_mode="ReadWriteOnce"))
         self._ensure_resource('dep', experiment.namespace, nfs_svc_name,
-                              NFSDeployment(name=nfs_svc_name, storage_pvc=self.DEFAULT_STORAGE_PVC_NAME))
-        _, nfs_svc = self._ensure_resource('svc', experiment.namespace, nfs_svc_name, NFSSvc(name=nfs_svc_name))
+                              NFSDeployment(name=nfs_svc_name, storage_pvc=storage_pvc_name, labels=labels))
+        _, nfs_svc = self._ensure_resource('svc', experiment.namespace, nfs_svc_name,
+                                           NFSSvc(name=nfs_svc_name, selector=labels))
 
         nfs_svc_ip = nfs_svc.spec.cluster_ip
-        _, nfs_pv = self._ensure_resource('pv', None, nfs_pv_name, NFSPv(nfs_pv_name, nfs_svc_ip))
+        _, nfs_pv = self._ensure_resource('pv', None, nfs_pv_name,
+                                          NFSPv(nfs_pv_name, nfs_svc_ip, claim_namespace=experiment.namespace,
+                                                claim_name=nfs_pvc_name))
         if nfs_pv.spec.nfs.server != nfs_svc_ip:
-            nfs_pv.spec.source.server = nfs_svc_ip
+            nfs_pv.spec.nfs.server = nfs_svc_ip
             self.core_api.patch_persistent_volume(nfs_pv_name, nfs_pv)
-            LOGGER.warning('pv/{}: patched NFS server ip (current={})', nfs_pv_name, nfs_svc_ip)
-        self._ensure_resource('pvc', experiment.namespace, self.NFS_PVC_NAME, NFSPvc(name=self.NFS_PVC_NAME))
+            LOGGER.warning('pv/{}: patched NFS server ip (current={})'.format(nfs_pv_name, nfs_svc_ip))
+        self._ensure_resource('pvc', experiment.namespace, nfs_pvc_name, NFSPvc(name=nfs_pvc_name))
 
     def _ensure_resource(self, resource_type, namespace, name, resource_body):
         list_kwargs = {'field_selector': 'metadata.name={}'.format(name)}
@@ -232,7 +1217,9 @@ class KubernetesBackend(object):
             create_kwargs['namespace'] = namespace
 
         list_fun, create_fun = {
+            'configmap': (self.core_api.list_namespaced_config_map, self.core_api.create_namespaced_config_map),
             'dep': (self.apps_api.list_namespaced_deployment, self.apps_api.create_namespaced_deployment),
+            'ds': (self.apps_api.list_namespaced_daemon_set, self.apps_api.create_namespaced_daemon_set),
             'job': (self.batch_api.list_namespaced_job, self.batch_api.create_namespaced_job),
             'namespace': (self.core_api.list_namespace, self.core_api.create_namespace),
             'pod': (self.core_api.list_namespaced_pod, self.core_api.create_namespaced_pod),
@@ -241,8 +1228,10 @@ class KubernetesBackend(object):
                     self.core_api.create_namespaced_persistent_volume_claim),
             'svc': (self.core_api.list_namespaced_service, self.core_api.create_namespaced_service),
         }[resource_type]
+        self._rate_limiter.acquire()
         response = list_fun(**list_kwargs)
         if not response.items:
+            self._rate_limiter.acquire()
             resource = create_fun(**create_kwargs)
             LOGGER.debug('{}/{} created ({})'.format(resource_type, name, resource.to_str()))
         else:
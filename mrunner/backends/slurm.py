@@ -1,20 +1,21 @@
 # -*- coding: utf-8 -*-
+import collections
+import contextlib
 import logging
+import re
 import tarfile
 import tempfile
+import threading
 
 import attr
-from fabric.api import run as fabric_run
-from fabric.context_managers import cd
-from fabric.contrib.project import rsync_project
-from fabric.state import env
+import paramiko
 from paramiko.agent import Agent
 from path import Path
+from six.moves import shlex_quote
 
 from mrunner.experiment import COMMON_EXPERIMENT_MANDATORY_FIELDS, COMMON_EXPERIMENT_OPTIONAL_FIELDS
 from mrunner.plgrid import PLGRID_USERNAME, PLGRID_HOST, PLGRID_TESTING_PARTITION
 from mrunner.utils.namesgenerator import id_generator
-from mrunner.utils.neptune import NEPTUNE_LOCAL_VERSION
 from mrunner.utils.utils import GeneratedTemplateFile, get_paths_to_copy, make_attr_class, filter_only_attr
 
 LOGGER = logging.getLogger(__name__)
@@ -72,6 +73,8 @@ class ExperimentScript(GeneratedTemplateFile):
     DEFAULT_SLURM_EXPERIMENT_SCRIPT_TEMPLATE = 'slurm_experiment.sh.jinja2'
 
     def __init__(self, experiment):
+        from mrunner.utils.neptune import NEPTUNE_LOCAL_VERSION
+
         # merge env vars
         env = experiment.cmd.env.copy() if experiment.cmd else {}
         env.update(experiment.env)
@@ -176,31 +179,104 @@ class SRunWrapperCmd(SlurmWrappersCmd):
         self._cmd = 'srun'
 
 
+class SshConnection(object):
+    """SSH connection to cluster (authenticated with keys from ssh agent); commands are run with login shell"""
+
+    def __init__(self, slurm_url):
+        username, _, host = slurm_url.rpartition('@')
+        host, _, port = host.partition(':')
+        self._host = host
+        self._client = paramiko.SSHClient()
+        self._client.load_system_host_keys()
+        self._client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self._client.connect(host, port=int(port or 22), username=username or None)
+
+    def is_active(self):
+        transport = self._client.get_transport()
+        return bool(transport and transport.is_active())
+
+    def run(self, cmd, echo=True):
+        """Runs command and returns its output (echoed unless echo is unset); raises RuntimeError on failure"""
+        LOGGER.debug('[{}] run: {}'.format(self._host, cmd))
+        _, stdout, stderr = self._client.exec_command('/bin/bash -l -c {}'.format(shlex_quote(cmd)))
+        output = []
+        for line in stdout:
+            line = line.rstrip('\r\n')
+            LOGGER.log(logging.INFO if echo else logging.DEBUG, '[{}] out: {}'.format(self._host, line))
+            output.append(line)
+        if stdout.channel.recv_exit_status():
+            raise RuntimeError('Command failed on {}: {}\n{}'.format(self._host, cmd,
+                                                                     stderr.read().decode('utf-8').strip()))
+        return '\n'.join(output).strip()
+
+    def put(self, local_path, remote_path):
+        with contextlib.closing(self._client.open_sftp()) as sftp:
+            sftp.put(local_path, remote_path)
+
+    def close(self):
+        self._client.close()
+
+
 class SlurmBackend(object):
 
+    @classmethod
+    def from_context(cls, context):
+        return cls()
+
+    def __init__(self):
+        # each submitting thread uses its own connection, thus experiments are submitted concurrently
+        self._idle_connections = collections.defaultdict(list)  # slurm url -> connections not used by any thread
+        self._connections_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _connection(self, slurm_url):
+        """Yields connection used only by calling thread; it is returned to pool of idle connections afterwards"""
+        with self._connections_lock:
+            idle = self._idle_connections[slurm_url]
+            connection = idle.pop() if idle else None
+        if connection is None or not connection.is_active():
+            connection = SshConnection(slurm_url)
+        try:
+            yield connection
+        finally:
+            with self._connections_lock:
+                self._idle_connections[slurm_url].append(connection)
+
     def run(self, experiment):
+        """Submits experiment; experiments may be submitted concurrently (ex. with --jobs)"""
         assert Agent().get_keys(), "Add your private key to ssh agent using 'ssh-add' command"
 
-        # configure fabric
         slurm_url = experiment.pop('slurm_url', '{}@{}'.format(PLGRID_USERNAME, PLGRID_HOST))
-        env['host_string'] = slurm_url
-
-        slurm_scratch_dir = Path(self._fabric_run('echo $SCRATCH'))
-        experiment = ExperimentRunOnSlurm(slurm_scratch_dir=slurm_scratch_dir, slurm_url=slurm_url,
-                                          **filter_only_attr(ExperimentRunOnSlurm, experiment))
-        LOGGER.debug('Configuration: {}'.format(experiment))
-
-        self.ensure_directories(experiment)
-        script_path = self.deploy_code(experiment)
-        SCmd = {'sbatch': SBatchWrapperCmd, 'srun': SRunWrapperCmd}[experiment.cmd_type]
-        cmd = SCmd(experiment=experiment, script_path=script_path)
-        self._fabric_run(cmd.command)
-
-    def ensure_directories(self, experiment):
-        self._ensure_dir(experiment.experiment_scratch_dir)
-        self._ensure_dir(experiment.storage_dir)
-
-    def deploy_code(self, experiment):
+        with self._connection(slurm_url) as connection:
+            slurm_scratch_dir = Path(connection.run('echo $SCRATCH'))
+            experiment = ExperimentRunOnSlurm(slurm_scratch_dir=slurm_scratch_dir, slurm_url=slurm_url,
+                                              **filter_only_attr(ExperimentRunOnSlurm, experiment))
+            LOGGER.debug('Configuration: {}'.format(experiment))
+
+            self.ensure_directories(connection, experiment)
+            script_path = self.deploy_code(connection, experiment)
+            SCmd = {'sbatch': SBatchWrapperCmd, 'srun': SRunWrapperCmd}[experiment.cmd_type]
+            cmd = SCmd(experiment=experiment, script_path=script_path)
+            output = connection.run(cmd.command)
+
+        # sbatch prints id of submitted job; srun blocks till the end of experiment
+        match = re.search(r'Submitted batch job (\d+)', output or '')
+        return match.group(1) if match else None
+
+    def sacct(self, slurm_url, job_ids):
+        """Obtains resources usage of given jobs from slurm accounting"""
+        from mrunner.utils.efficiency import parse_sacct
+
+        with self._connection(slurm_url) as connection:
+            output = connection.run('sacct -j {} --noheader --parsable2 --format=JobID,State,Elapsed,TotalCPU,'
+                                    'MaxRSS,AllocCPUS'.format(','.join(job_ids)), echo=False)
+        return parse_sacct(output)
+
+    def ensure_directories(self, connection, experiment):
+        connection.run('mkdir -p {path}'.format(path=experiment.experiment_scratch_dir))
+        connection.run('mkdir -p {path}'.format(path=experiment.storage_dir))
+
+    def deploy_code(self, connection, experiment):
         paths_to_dump = get_paths_to_copy(exclude=experiment.exclude, paths_to_copy=experiment.paths_to_copy)
         with tempfile.NamedTemporaryFile(suffix='.tar.gz') as temp_file:
             # archive all files
@@ -216,27 +292,14 @@ class SlurmBackend(object):
                     tar_file.add(neptune_token_path, arcname=remote_path)
 
             # upload archive to cluster and extract
-            self._put(temp_file.name, experiment.experiment_scratch_dir)
-            with cd(experiment.experiment_scratch_dir):
-                archive_remote_path = experiment.experiment_scratch_dir / Path(temp_file.name).name
-                self._fabric_run('tar xf {tar_filename} && rm {tar_filename}'.format(tar_filename=archive_remote_path))
+            archive_remote_path = experiment.experiment_scratch_dir / Path(temp_file.name).name
+            connection.put(temp_file.name, archive_remote_path)
+            connection.run('cd {dir} && tar xf {tar_filename} && rm {tar_filename}'.format(
+                dir=experiment.experiment_scratch_dir, tar_filename=archive_remote_path))
 
         # create and upload experiment script
         script = ExperimentScript(experiment)
         remote_script_path = experiment.project_scratch_dir / script.script_name
-        self._put(script.path, remote_script_path)
+        connection.put(script.path, remote_script_path)
 
         return remote_script_path
-
-    @staticmethod
-    def _put(local_path, remote_path, quiet=True):
-        quiet_kwargs = {'ssh_opts': '-q', 'extra_opts': '-q'} if quiet else {}
-        rsync_project(remote_path, local_path, **quiet_kwargs)
-
-    @staticmethod
-    def _ensure_dir(directory_path):
-        SlurmBackend._fabric_run('mkdir -p {path}'.format(path=directory_path))
-
-    @staticmethod
-    def _fabric_run(cmd):
-        return fabric_run(cmd)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Entry point of mrunner command. If daemon started with `mrunner serve` is running, command is forwarded to it
+(daemon keeps backends, their api clients and connections warm); otherwise command is run in this process.
+
+Module depends only on python standard library, so commands are forwarded without importing backends.
+"""
+import json
+import os
+import socket
+import sys
+
+NO_DAEMON_ENV = 'MRUNNER_NO_DAEMON'
+# commands run always locally: daemon itself, contexts management (which may open editor) and commands following
+# experiments (daemon runs one command at a time, so they would block other clients for long)
+LOCAL_COMMANDS = ['serve', 'context', 'status', 'wait']
+GROUP_OPTIONS_WITH_VALUE = ['--config', '--context']
+# environment selecting clusters and credentials; commands are forwarded only to daemon run with the same one
+ENVIRONMENT_KEYS = ['KUBECONFIG', 'DOCKER_HOST', 'DOCKER_CONFIG', 'GOOGLE_APPLICATION_CREDENTIALS', 'CLOUDSDK_CONFIG']
+ENVIRONMENT_PREFIXES = ('NEPTUNE_',)
+
+
+def get_socket_path():
+    cache_dir = os.path.expanduser(os.environ.get('XDG_CACHE_HOME', '~/.cache'))
+    return os.path.join(cache_dir, 'mrunner', 'daemon.sock')
+
+
+def get_environment(environ=None):
+    environ = os.environ if environ is None else environ
+    return {k: v for k, v in environ.items() if k in ENVIRONMENT_KEYS or k.startswith(ENVIRONMENT_PREFIXES)}
+
+
+def get_subcommand(argv):
+    args = iter(argv)
+    for arg in args:
+        if arg in GROUP_OPTIONS_WITH_VALUE:
+            next(args, None)
+        elif not arg.startswith('-'):
+            return arg
+    return None
+
+
+def forward(argv, socket_path=None):
+    """Runs command in daemon and writes its output; returns exit code or None if daemon is not running
+    (or it refused command, because it runs with different environment)"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path or get_socket_path())
+    except (IOError, OSError):
+        sock.close()
+        return None
+
+    with sock, sock.makefile('rwb') as stream:
+        stream.write(json.dumps({'argv': argv, 'cwd': os.getcwd(), 'env': get_environment()}).encode('utf-8') + b'\n')
+        stream.flush()
+        for line in stream:
+            message = json.loads(line.decode('utf-8'))
+            if 'exit_code' in message:
+                return message['exit_code']
+            if 'refused' in message:
+                sys.stderr.write('mrunner daemon refused command ({}); running it locally\n'.format(message['refused']))
+                return None
+            output = sys.stdout if 'stdout' in message else sys.stderr
+            output.write(message.get('stdout', message.get('stderr')))
+            output.flush()
+    return 1  # daemon exited while running command
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not os.environ.get(NO_DAEMON_ENV) and get_subcommand(argv) not in LOCAL_COMMANDS + [None]:
+        exit_code = forward(argv)
+        if exit_code is not None:
+            sys.exit(exit_code)
+
+    from mrunner.cli.mrunner_cli import cli
+    cli(args=argv, prog_name='mrunner')
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,7 @@ import yaml
 from mrunner.utils.utils import make_attr_class
 
 AVAILABLE_RESOURCES = ['cpu', 'mem', 'gpu', 'tpu']
+REQUIRED_CONTEXT_KEYS = ['neptune', 'storage_dir', 'backend_type', 'context_name']
 
 Config = make_attr_class('Config', [
     ('contexts', dict(default={})),
@@ -43,6 +44,16 @@ class ConfigParser(object):
             config_file.write(yaml_payload)
 
 
+def get_context(config, context_name):
+    """Returns context of given name; raises KeyError for unknown context and AttributeError if context misses
+    required keys"""
+    context = config.contexts[context_name]
+    for k in REQUIRED_CONTEXT_KEYS:
+        if k not in context:
+            raise AttributeError('Missing required "{}" context key'.format(k))
+    return context
+
+
 @click.group(invoke_without_command=True)
 @click.pass_context
 def context(ctx):
@@ -6,11 +6,12 @@ import logging
 import click
 from path import Path
 
-from mrunner.backends.k8s import KubernetesBackend
-from mrunner.backends.slurm import SlurmBackend
-from mrunner.cli.config import ConfigParser, context as context_cli
-from mrunner.experiment import generate_experiments, get_experiments_spec_handle
-from mrunner.utils.neptune import NeptuneWrapperCmd
+from mrunner.cli.config import ConfigParser, get_context, context as context_cli
+from mrunner.experiment import generate_experiments, get_experiments_spec
+from mrunner.session import Session, PreparedExperiment, get_backend, DEFAULT_SLURM_URL
+from mrunner.utils.cache import FileCache, get_cache_dir
+from mrunner.utils.efficiency import EfficiencyStore, DEFAULT_HEADROOM
+from mrunner.utils.pipeline import Pipeline
 
 LOGGER = logging.getLogger(__name__)
 
@@ -23,6 +24,23 @@ def get_default_config_path(ctx):
     return app_dir / default_config_file_name
 
 
+def get_efficiency_store(ctx):
+    return EfficiencyStore(ctx.obj['config_path'].abspath().parent / EfficiencyStore.DEFAULT_FILENAME)
+
+
+def get_sweeps_cache():
+    """Remembers last sweep run in each context"""
+    return FileCache(get_cache_dir() / 'sweeps.json')
+
+
+def _describe_pipeline_item(item):
+    if isinstance(item, PreparedExperiment):
+        return item.experiment['name']
+    if item is None:
+        return 'experiments'  # generation of experiments failed
+    return item[1].get('name')
+
+
 @click.group()
 @click.option('--debug/--no-debug', default=False, help='Enable debug messages')
 @click.option('--config', default=None, type=click.Path(dir_okay=False),
@@ -43,7 +61,7 @@ def cli(ctx, debug, config, context):
     LOGGER.debug('Using {} as mrunner config'.format(config_path))
     config = ConfigParser(config_path).load()
 
-    cmd_require_context = ctx.invoked_subcommand not in ['context']
+    cmd_require_context = ctx.invoked_subcommand not in ['context', 'serve']
     if cmd_require_context:
         context_name = context or config.current_context or None
         if not context_name:
@@ -54,10 +72,7 @@ def cli(ctx, debug, config, context):
                 'Could not find predefined context: "{}". Use context add command.'.format(context_name))
 
         try:
-            context = config.contexts[context_name]
-            for k in ['neptune', 'storage_dir', 'backend_type', 'context_name']:
-                if k not in context:
-                    raise AttributeError('Missing required "{}" context key'.format(k))
+            context = get_context(config, context_name)
         except KeyError:
             raise click.ClickException('Unknown context {}'.format(context_name))
         except AttributeError as e:
@@ -74,10 +89,17 @@ def cli(ctx, debug, config, context):
 @click.option('--tags', multiple=True, help='Additional tags')
 @click.option('--requirements_file', type=click.Path(), help='Path to requirements file')
 @click.option('--base_image', help='Base docker image used in experiment')
+@click.option('--spec_cache/--no-spec_cache', default=None,
+              help='Reuse experiments generated by spec function while script is not changed')
+@click.option('--jobs', default=None, type=int,
+              help='Number of experiments submitted concurrently (default: 1; kubernetes jobs are created by '
+                   'submit_workers threads of context unless given)')
+@click.option('--fail-fast/--continue-on-error', default=True,
+              help='Stop submitting experiments after first failure (default) or submit all of them')
 @click.argument('script')
 @click.argument('params', nargs=-1)
 @click.pass_context
-def run(ctx, neptune, spec, tags, requirements_file, base_image, script, params):
+def run(ctx, neptune, spec, tags, requirements_file, base_image, spec_cache, jobs, fail_fast, script, params):
     """Run experiment"""
 
     context = ctx.obj['context']
@@ -88,7 +110,8 @@ def run(ctx, neptune, spec, tags, requirements_file, base_image, script, params)
         raise click.ClickException('Provide docker base image')
     if context['backend_type'] == 'kubernetes' and not requirements_file:
         raise click.ClickException('Provide requirements.txt file')
-    script_has_spec = get_experiments_spec_handle(script, spec) is not None
+    spec_cache = context.get('spec_cache', False) if spec_cache is None else spec_cache
+    script_has_spec = get_experiments_spec(script, spec, cache=spec_cache) is not None
     neptune_support = context.get('neptune', None) or neptune
     if neptune_support and not neptune and not script_has_spec:
         raise click.ClickException('Neptune support is enabled in context '
@@ -96,9 +119,31 @@ def run(ctx, neptune, spec, tags, requirements_file, base_image, script, params)
     if neptune and script_has_spec:
         raise click.ClickException('Provide only one of: neptune config or python experiment descriptor')
 
-    if not neptune_support:
-        # TODO: implement it if possible
-        raise click.ClickException('Currentlu doesn\'t support experiments without neptune')
+    try:
+        session = Session(context, base_image=base_image, requirements=requirements, tags=tags, params=params,
+                          jobs=jobs, neptune=neptune, efficiency_store=get_efficiency_store(ctx))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    sweep_id = session.sweep_id
+    kubernetes_experiments = []
+
+    def _prepare(entry):
+        prepared = session.prepare(entry)
+        if prepared.experiment['backend_type'] == 'kubernetes':
+            # kubernetes jobs are created concurrently, after all experiments are prepared
+            kubernetes_experiments.append(prepared)
+            return None
+        return prepared
+
+    def _on_result(result):
+        if result.failed:
+            LOGGER.error('Could not submit {}: {}'.format(_describe_pipeline_item(result.item), result.error))
+            return
+        prepared, job_id = result.item, result.result
+        if not isinstance(prepared, PreparedExperiment):
+            return  # submitted later as sweep
+        LOGGER.info('Submitted {} (job id: {})'.format(prepared.experiment['name'], job_id))
+        session.record_submission(prepared, job_id)
 
     neptune_dir = None
     try:
@@ -108,48 +153,211 @@ def run(ctx, neptune, spec, tags, requirements_file, base_image, script, params)
             neptune_dir = script_path.parent / 'neptune_{}'.format(script_path.stem)
             neptune_dir.makedirs_p()
 
-        for neptune_path, experiment in generate_experiments(script, neptune, context, spec=spec,
-                                                             neptune_dir=neptune_dir):
-
-            experiment.update({'base_image': base_image, 'requirements': requirements})
-
-            if neptune_support:
-                script = experiment.pop('script')
-                cmd = ' '.join([script] + list(params))
-                # tags from neptune.yaml will be extracted by neptune
-                additional_tags = context.get('tags', []) + list(tags)
-                cmd = NeptuneWrapperCmd(cmd=cmd, experiment_config_path=neptune_path,
-                                        neptune_storage=context['storage_dir'],
-                                        paths_to_dump=None,
-                                        additional_tags=additional_tags)
-                experiment['cmd'] = cmd
-                experiment.setdefault('paths_to_copy', [])
-                for possible_token_path in ['~/.neptune_tokens/token', '~/.neptune/tokens/token']:
-                    neptune_path = Path(possible_token_path).expanduser().abspath()
-                    if neptune_path.exists():
-                        neptune_token_files = experiment.setdefault('neptune_token_files', [])
-                        neptune_token_files.append(str(neptune_path))
-
-                assert len(experiment.get('neptune_token_files', [])) < 2, \
-                    'You have multiple neptune tokens ({}); remove obsolete'.format(
-                        ', '.join(experiment['neptune_token_files']))
-            else:
-                # TODO: implement no neptune version
-                # TODO: for sbatch set log path into something like os.path.join(resource_dir_path, "job_logs.txt")
-                raise click.ClickException('Not implemented yet')
-
-            run_kwargs = {'experiment': experiment}
-            backend = {
-                'kubernetes': KubernetesBackend,
-                'slurm': SlurmBackend
-            }[experiment['backend_type']]()
-            # TODO: add calling experiments in parallel
-            backend.run(**run_kwargs)
+        # experiments are generated, prepared and submitted (with `jobs` threads) concurrently
+        pipeline = Pipeline(_prepare, session.submit, jobs=jobs, fail_fast=fail_fast)
+        results = pipeline.run(generate_experiments(script, neptune, context, spec=spec, neptune_dir=neptune_dir,
+                                                    spec_cache=spec_cache), on_result=_on_result)
+        failed = [result for result in results if result.failed]
+        if failed and fail_fast:
+            raise failed[0].error
+
+        if kubernetes_experiments:
+            job_ids = session.run_sweep(kubernetes_experiments)
+            namespace = job_ids[0].split('/')[0]
+            get_sweeps_cache().set(context['context_name'], {'project': namespace, 'sweep_id': sweep_id})
+            LOGGER.info('Created {} kubernetes jobs (project: {}, sweep: {})'.format(len(job_ids), namespace,
+                                                                                    sweep_id))
+        if failed:
+            raise click.ClickException('Could not submit {} of {} experiments'.format(len(failed), len(results)))
     finally:
         if neptune_dir:
             neptune_dir.rmtree_p()
 
 
+@cli.command()
+@click.option('--socket', 'socket_path', default=None, type=click.Path(dir_okay=False),
+              help='Path of daemon unix socket (default: ~/.cache/mrunner/daemon.sock)')
+@click.option('--backends_ttl', default=None, type=float,
+              help='Number of seconds after which backends and cached facts about clusters are renewed')
+def serve(socket_path, backends_ttl):
+    """Run daemon keeping backends warm; other mrunner commands are forwarded to it while it is running"""
+    from mrunner.daemon import serve as serve_daemon, DEFAULT_BACKENDS_TTL
+
+    serve_daemon(socket_path=socket_path, backends_ttl=backends_ttl or DEFAULT_BACKENDS_TTL)
+
+
+@cli.command()
+@click.option('--headroom', default=None, type=float,
+              help='Multiplier applied to peak usage while recommending resources (default: {})'.format(
+                  DEFAULT_HEADROOM))
+@click.pass_context
+def advise(ctx, headroom):
+    """Show resources efficiency of finished experiments and recommend resources"""
+    context = ctx.obj['context']
+    if context['backend_type'] != 'slurm':
+        raise click.ClickException('Resources efficiency data is available only for slurm contexts')
+    headroom = headroom or float(context.get('resources_headroom', DEFAULT_HEADROOM))
+
+    efficiency_store = get_efficiency_store(ctx)
+    slurm_url = context.get('slurm_url', DEFAULT_SLURM_URL)
+    pending_jobs = efficiency_store.pending_jobs(slurm_url=slurm_url)
+    if pending_jobs:
+        usages = get_backend('slurm', context).sacct(slurm_url, [job['job_id'] for job in pending_jobs])
+        updated = efficiency_store.update_usage(usages, slurm_url=slurm_url)
+        LOGGER.debug('Harvested usage of {}/{} jobs'.format(updated, len(pending_jobs)))
+        efficiency_store.save()
+
+    def _format_eff(value):
+        return '{:.0%}'.format(value) if value is not None else '-'
+
+    def _format_resources(resources):
+        return ' '.join('{}={}'.format(k, v) for k, v in sorted(resources.items())) or '-'
+
+    click.echo('\t'.join(['project', 'script', 'params', 'runs', 'cpu_eff', 'mem_eff', 'requested', 'recommended']))
+    for signature, entry, runs, cpu_eff, mem_eff, recommended in efficiency_store.report(headroom=headroom):
+        requested = entry['jobs'][-1]['resources'] if entry['jobs'] else {}
+        click.echo('\t'.join([str(entry['project']), entry['script'], ','.join(entry['parameter_names']) or '-',
+                              str(runs), _format_eff(cpu_eff), _format_eff(mem_eff),
+                              _format_resources(requested), _format_resources(recommended)]))
+
+
+def _get_kubernetes_selection(ctx, project, sweep, experiment, default_last_sweep=True):
+    """Returns namespace, label selector and sweep id of experiments; by default selects last sweep of current
+    context"""
+    from mrunner.backends.k8s import project_namespace, generate_label_selector
+
+    context = ctx.obj['context']
+    if context['backend_type'] != 'kubernetes':
+        raise click.ClickException('Managing experiments is available only for kubernetes contexts')
+    if not project:
+        last_sweep = get_sweeps_cache().get(context['context_name'])
+        if not last_sweep:
+            raise click.ClickException('Provide project name (no experiments were run in this context yet)')
+        project = last_sweep['project']
+        if default_last_sweep:
+            sweep = sweep or last_sweep['sweep_id']
+    return (project_namespace(project), generate_label_selector(project, sweep_id=sweep, experiment_name=experiment),
+            sweep)
+
+
+def _echo_changes(table, reported):
+    for job_name, index, experiment, phase, exit_code in table.rows:
+        row = (experiment, phase, exit_code)
+        if reported.get((job_name, index)) != row:
+            reported[(job_name, index)] = row
+            click.echo('\t'.join(['job/{}{}'.format(job_name, '[{}]'.format(index) if index else ''),
+                                  experiment or '-', phase or '-', '-' if exit_code is None else str(exit_code)]))
+
+
+def _echo_summary(table):
+    click.echo(', '.join('{}: {}'.format(phase, table.count(phase))
+                         for phase in ['Pending', 'Running', 'Succeeded', 'Failed']))
+
+
+def _echo_queued(specs):
+    """Experiments run by workers pools are reported by their state in queue"""
+    if not specs:
+        return
+    for spec in specs:
+        click.echo('\t'.join(['queue/{}/{}'.format(spec.pool, spec.spec_id), spec.name or '-', spec.phase,
+                              '-' if spec.exit_code is None else str(spec.exit_code)]))
+    phases = [spec.phase for spec in specs]
+    click.echo('Workers pools: ' + ', '.join('{}: {}'.format(phase, phases.count(phase))
+                                             for phase in ['Queued', 'Running', 'Succeeded', 'Failed']))
+
+
+_selection_options = [
+    click.option('--project', default=None, help='Project name (by default project of last run sweep)'),
+    click.option('--sweep', default=None, help='Sweep id (by default last run sweep)'),
+    click.option('--experiment', default=None, help='Experiment name'),
+]
+
+
+def selection_options(fun):
+    for option in reversed(_selection_options):
+        fun = option(fun)
+    return fun
+
+
+@cli.command()
+@selection_options
+@click.option('--watch/--no-watch', default=False, help='Stream changes of experiments state')
+@click.pass_context
+def status(ctx, project, sweep, experiment, watch):
+    """Show state of experiments run on kubernetes"""
+    namespace, label_selector, sweep = _get_kubernetes_selection(ctx, project, sweep, experiment)
+    backend = get_backend('kubernetes', ctx.obj['context'])
+    _echo_queued(backend.list_queued(namespace, sweep_id=sweep, experiment_name=experiment))
+    reported = {}
+    for table in backend.follow(namespace, label_selector):
+        _echo_changes(table, reported)
+        if not watch:
+            break
+    _echo_summary(table)
+
+
+@cli.command()
+@selection_options
+@click.option('--timeout', default=None, type=int, help='Maximal number of seconds to wait')
+@click.pass_context
+def wait(ctx, project, sweep, experiment, timeout):
+    """Wait till experiments run on kubernetes finish"""
+    namespace, label_selector, _ = _get_kubernetes_selection(ctx, project, sweep, experiment)
+    backend = get_backend('kubernetes', ctx.obj['context'])
+    reported = {}
+    for table in backend.follow(namespace, label_selector, until_finished=True, timeout=timeout):
+        _echo_changes(table, reported)
+    _echo_summary(table)
+    if not table.finished:
+        raise click.ClickException('Timeout while waiting for experiments')
+    if table.count('Failed'):
+        raise click.ClickException('{} experiments failed'.format(table.count('Failed')))
+
+
+@cli.command()
+@selection_options
+@click.option('--all', 'all_', is_flag=True, default=False,
+              help='Cancel all experiments of project (by default project of last run sweep)')
+@click.option('--dry-run', 'dry_run', is_flag=True, default=False, help='Only list jobs which would be deleted')
+@click.pass_context
+def cancel(ctx, project, sweep, experiment, all_, dry_run):
+    """Cancel experiments run on kubernetes (deletes their jobs and removes them from queues of workers pools)"""
+    if project and not (sweep or experiment or all_):
+        raise click.ClickException('Provide sweep or experiment to cancel (or use --all to cancel whole project)')
+    namespace, label_selector, sweep = _get_kubernetes_selection(ctx, project, sweep, experiment,
+                                                                 default_last_sweep=not all_)
+    backend = get_backend('kubernetes', ctx.obj['context'])
+    action = 'Would cancel' if dry_run else 'Cancelled'
+    # queued experiments are removed first, so workers pools (deleted with --all) don't start them
+    specs = backend.delete_queued(namespace, sweep_id=sweep, experiment_name=experiment, dry_run=dry_run)
+    if specs:
+        for spec in specs:
+            click.echo('queue/{}/{}'.format(spec.pool, spec.spec_id))
+        click.echo('{} {} queued experiments'.format(action, len(specs)))
+    job_names = backend.delete_jobs(namespace, label_selector, dry_run=dry_run)
+    _echo_deleted_jobs(job_names, namespace, label_selector, action)
+
+
+@cli.command()
+@click.option('--project', default=None, help='Project name (by default project of last run sweep)')
+@click.option('--sweep', default=None, help='Sweep id (by default all sweeps of project)')
+@click.option('--dry-run', 'dry_run', is_flag=True, default=False, help='Only list jobs which would be removed')
+@click.pass_context
+def gc(ctx, project, sweep, dry_run):
+    """Remove completed jobs of experiments run on kubernetes"""
+    namespace, label_selector, _ = _get_kubernetes_selection(ctx, project, sweep, None, default_last_sweep=False)
+    job_names = get_backend('kubernetes', ctx.obj['context']).delete_jobs(namespace, label_selector,
+                                                                          only_succeeded=True, dry_run=dry_run)
+    _echo_deleted_jobs(job_names, namespace, label_selector, 'Would remove' if dry_run else 'Removed')
+
+
+def _echo_deleted_jobs(job_names, namespace, label_selector, action):
+    for job_name in job_names:
+        click.echo('job/{}'.format(job_name))
+    click.echo('{} {} jobs selected with {} in {} namespace'.format(action, len(job_names), label_selector,
+                                                                    namespace))
+
+
 cli.add_command(context_cli)
 
 if __name__ == '__main__':
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Daemon running mrunner commands forwarded by thin client (see mrunner.cli.client). Backends (with kubernetes api
+client, docker client, SSH connections and cached facts about clusters) are kept between commands.
+
+Daemon listens on Unix socket accessible only by its owner. Commands are run one at a time, in working directory
+of client. Request is single JSON line ({"argv": [...], "cwd": ..., "env": {...}}); response is stream of JSON lines
+with output ({"stdout": ...} or {"stderr": ...}) ending with {"exit_code": ...}. Commands of clients run with other
+environment (clusters, credentials; see mrunner.cli.client.get_environment) than daemon are refused
+({"refused": ...}), thus client runs them by itself.
+"""
+import io
+import json
+import logging
+import os
+import socket
+import sys
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+
+from six.moves import socketserver
+
+from mrunner.cli.client import get_socket_path, get_environment
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_BACKENDS_TTL = 600  # seconds after which backends (and cluster facts cached by them) are recreated
+
+
+class _OutputStream(io.TextIOBase):
+    """Text stream sending written text to client"""
+
+    def __init__(self, wfile, name):
+        self._wfile = wfile
+        self._name = name
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if not text:
+            return 0
+        try:
+            self._wfile.write(json.dumps({self._name: text}).encode('utf-8') + b'\n')
+            self._wfile.flush()
+        except (IOError, OSError):
+            pass  # client disconnected; command is finished anyway
+        return len(text)
+
+
+def _forget_user_modules(cwd):
+    """Spec scripts and modules imported from client working directory are loaded again by each command,
+    so their changes are visible"""
+    from mrunner import experiment
+
+    experiment._scripts_globals.clear()
+    experiment._specs_experiments.clear()
+    cwd = os.path.join(os.path.realpath(cwd), '')
+    prefixes = tuple(os.path.join(os.path.realpath(prefix), '') for prefix in {sys.prefix, sys.exec_prefix})
+    for name, module in list(sys.modules.items()):
+        module_file = getattr(module, '__file__', None)
+        if not module_file or name == 'mrunner' or name.startswith('mrunner.'):
+            continue
+        module_file = os.path.realpath(module_file)
+        # installed packages (ex. virtualenv placed in project directory) are kept
+        installed = module_file.startswith(prefixes) or 'site-packages' in module_file
+        if module_file.startswith(cwd) and not installed:
+            del sys.modules[name]
+
+
+def run_command(argv, cwd, stdout, stderr):
+    """Runs mrunner command in daemon process; returns exit code"""
+    import click
+    from mrunner.cli.mrunner_cli import cli
+
+    root_logger = logging.getLogger()
+    previous_level, previous_cwd = root_logger.level, os.getcwd()
+    handler = logging.StreamHandler(stderr)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.DEBUG if '--debug' in argv else logging.INFO)
+    try:
+        os.chdir(cwd)
+        _forget_user_modules(cwd)
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                exit_code = cli.main(args=argv, prog_name='mrunner', standalone_mode=False)
+                return exit_code if isinstance(exit_code, int) else 0
+            except click.ClickException as e:
+                e.show()
+                return e.exit_code
+            except click.Abort:
+                click.echo('Aborted!', err=True)
+                return 1
+            except Exception:
+                traceback.print_exc()
+                return 1
+    finally:
+        os.chdir(previous_cwd)
+        root_logger.removeHandler(handler)
+        root_logger.setLevel(previous_level)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        from mrunner.session import expire_backends
+
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        environment, client_environment = get_environment(), request.get('env', {})
+        differ = sorted(k for k in set(environment) | set(client_environment)
+                        if environment.get(k) != client_environment.get(k))
+        if differ:
+            LOGGER.info('Refused: mrunner {} (environment differs: {})'.format(' '.join(request['argv']),
+                                                                              ', '.join(differ)))
+            self._send({'refused': 'environment differs: {}'.format(', '.join(differ))})
+            return
+
+        LOGGER.info('Running: mrunner {} (in {})'.format(' '.join(request['argv']), request['cwd']))
+        stderr = _OutputStream(self.wfile, 'stderr')
+        try:
+            expire_backends(self.server.backends_ttl)
+            exit_code = run_command(request['argv'], request['cwd'], stdout=_OutputStream(self.wfile, 'stdout'),
+                                    stderr=stderr)
+        except Exception:
+            stderr.write(traceback.format_exc())
+            exit_code = 1
+        self._send({'exit_code': exit_code})
+
+    def _send(self, message):
+        try:
+            self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+        except (IOError, OSError):
+            pass
+
+
+class DaemonServer(socketserver.UnixStreamServer):
+
+    def __init__(self, socket_path, backends_ttl=DEFAULT_BACKENDS_TTL):
+        self.backends_ttl = backends_ttl
+        self.socket_path = socket_path
+        socketserver.UnixStreamServer.__init__(self, socket_path, _RequestHandler)
+
+    def server_bind(self):
+        # socket is created accessible only by its owner
+        previous_umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(previous_umask)
+        os.chmod(self.socket_path, 0o600)
+
+
+def _remove_stale_socket(socket_path):
+    if not os.path.exists(socket_path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        raise RuntimeError('mrunner daemon is already running (socket: {})'.format(socket_path))
+    except (IOError, OSError):
+        os.remove(socket_path)
+    finally:
+        sock.close()
+
+
+def serve(socket_path=None, backends_ttl=DEFAULT_BACKENDS_TTL):
+    socket_path = socket_path or get_socket_path()
+    socket_dir = os.path.dirname(socket_path)
+    if socket_dir and not os.path.isdir(socket_dir):
+        os.makedirs(socket_dir, mode=0o700)
+    _remove_stale_socket(socket_path)
+
+    server = DaemonServer(socket_path, backends_ttl=backends_ttl)
+    LOGGER.info('mrunner daemon listens on {}'.format(socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
@@ -1,18 +1,28 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import logging
+import pickle
 import random
 import re
 import warnings
+from copy import deepcopy
 
 import attr
 import six
 from path import Path
 
+from mrunner.utils.cache import get_cache_dir
 from mrunner.utils.namesgenerator import id_generator, get_random_name
-from mrunner.utils.neptune import NeptuneConfigFileV1, NeptuneConfigFileV2, load_neptune_config, NEPTUNE_LOCAL_VERSION
 
 LOGGER = logging.getLogger(__name__)
 
+SPEC_CACHE_DIRNAME = 'specs'
+
+# scripts are executed once per their path and content: (path, content hash) -> script globals
+_scripts_globals = {}
+# experiments yielded by spec functions: (path, content hash, spec) -> list of experiments parameters
+_specs_experiments = {}
+
 COMMON_EXPERIMENT_MANDATORY_FIELDS = [
     ('backend_type', dict()),
     ('name', dict()),
@@ -80,7 +90,8 @@ class NeptuneExperiment(object):
 
 
 def merge_experiment_parameters(cli_kwargs, neptune_config, context):
-    config = context.copy()
+    # lists of context are extended, thus context (which may be reused) is copied deeply
+    config = deepcopy(context)
     for k, v in list(neptune_config.items()) + list(cli_kwargs.items()):
         if k not in config:
             LOGGER.debug('New config["{}"]: {}'.format(k, v))
@@ -98,10 +109,12 @@ def merge_experiment_parameters(cli_kwargs, neptune_config, context):
     return config
 
 
-def _load_py_experiment_and_generate_neptune_yamls(script, spec, *, neptune_dir, neptune_version=None):
-    LOGGER.info('Found {} function in {}; will use it as experiments configuration generator'.format(spec, script))
+def _generate_neptune_yamls(experiments, *, neptune_dir, neptune_version=None):
     neptune_support = bool(neptune_dir)
     if neptune_support:
+        # neptune is imported only when it is used
+        from mrunner.utils.neptune import NeptuneConfigFileV1, NeptuneConfigFileV2, NEPTUNE_LOCAL_VERSION
+
         if neptune_version and NEPTUNE_LOCAL_VERSION < neptune_version:
             # this shall match because we'll later use local neptune to parse them
             raise RuntimeError('Current neptune major version: {}, doesn\'t match forced one: {}'.format(
@@ -118,18 +131,12 @@ def _load_py_experiment_and_generate_neptune_yamls(script, spec, *, neptune_dir,
         LOGGER.debug('Generated neptune file {}: {}'.format(neptune_path, Path(neptune_path).text()))
         return neptune_path
 
-    spec_fun = get_experiments_spec_handle(script, spec)
-    for experiment in spec_fun():
-        if isinstance(experiment, dict):
-            experiment = NeptuneExperiment(**experiment)
-        elif not hasattr(experiment, 'to_dict'):
-            experiment = NeptuneExperiment(**experiment.__dict__)
-        cli_params = experiment.to_dict()
-
+    for cli_params in experiments:
         neptune_path = _dump_to_neptune(cli_params, neptune_dir) if neptune_support else None
 
         # TODO: possibly part of this shall not be removed on experiments without neptune support
-        cli_params.pop('parameters', None)
+        # names of parameters are kept to identify similar experiments (ex. while right-sizing resources)
+        cli_params['parameter_names'] = sorted(cli_params.pop('parameters', None) or {})
         cli_params.pop('project', None)
         cli_params.pop('description', None)
         cli_params.pop('tags', None)
@@ -139,16 +146,30 @@ def _load_py_experiment_and_generate_neptune_yamls(script, spec, *, neptune_dir,
 
 
 def generate_experiments(script, neptune, context, *, spec='spec',
-                         neptune_dir=None, neptune_version=None, **cli_kwargs):
-    spec_fun = get_experiments_spec_handle(script, spec)
-    if spec_fun:
-        experiments = _load_py_experiment_and_generate_neptune_yamls(script, spec=spec,
-                                                                     neptune_dir=neptune_dir,
-                                                                     neptune_version=neptune_version)
+                         neptune_dir=None, neptune_version=None, spec_cache=False, **cli_kwargs):
+    spec_experiments = get_experiments_spec(script, spec, cache=spec_cache)
+    if spec_experiments is not None:
+        LOGGER.info('Found {} function in {}; will use it as experiments configuration generator'.format(spec,
+                                                                                                        script))
+        experiments = _generate_neptune_yamls(spec_experiments, neptune_dir=neptune_dir,
+                                              neptune_version=neptune_version)
     else:
+        from mrunner.utils.neptune import load_neptune_config
+
         neptune_config = load_neptune_config(neptune)
         experiments = [(neptune, {'script': script, 'name': neptune_config['name']})]
+    return _merge_experiments(experiments, context, cli_kwargs)
+
 
+def prepare_experiments(experiments, context, *, neptune_dir=None, neptune_version=None, **cli_kwargs):
+    """Generates (neptune_path, experiment) pairs for Experiment objects (or dicts of their parameters),
+    same as generate_experiments does for experiments yielded by spec function"""
+    experiments = _generate_neptune_yamls((_to_experiment_params(experiment) for experiment in experiments),
+                                          neptune_dir=neptune_dir, neptune_version=neptune_version)
+    return _merge_experiments(experiments, context, cli_kwargs)
+
+
+def _merge_experiments(experiments, context, cli_kwargs):
     for neptune_path, cli_kwargs_ in experiments:
         cli_kwargs_['name'] = re.sub(r'[ .,_-]+', '-', cli_kwargs_['name'].lower())
         cli_kwargs_['cwd'] = Path.getcwd()
@@ -163,10 +184,67 @@ def generate_experiments(script, neptune, context, *, spec='spec',
         yield neptune_path, experiment
 
 
+def _read_script(script):
+    path = Path(script).abspath()
+    payload = path.bytes()
+    return path, payload, hashlib.sha1(payload).hexdigest()
+
+
 def get_experiments_spec_handle(script, spec):
-    vars = {}
-    exec(open(script).read(), vars)
-    spec_fun = vars.get(spec, None)
+    """Returns spec function defined in script or None; script is executed once per its path and content"""
+    path, payload, content_hash = _read_script(script)
+    key = (path, content_hash)
+    if key not in _scripts_globals:
+        vars = {}
+        exec(compile(payload, path, 'exec'), vars)
+        _scripts_globals[key] = vars
+    spec_fun = _scripts_globals[key].get(spec, None)
     if not callable(spec_fun):
         spec_fun = None
     return spec_fun
+
+
+def _to_experiment_params(experiment):
+    if isinstance(experiment, dict):
+        experiment = NeptuneExperiment(**experiment)
+    elif not hasattr(experiment, 'to_dict'):
+        experiment = NeptuneExperiment(**experiment.__dict__)
+    return dict(experiment.to_dict())
+
+
+def get_experiments_spec(script, spec, cache=False):
+    """Returns list of parameters of experiments yielded by spec function of script (or None if script doesn't
+    define it); spec function is called once per process, and with cache its result is also stored on disk
+    and reused while script content doesn't change (changes of modules imported by script are not detected)"""
+    path, _, content_hash = _read_script(script)
+    key = (path, content_hash, spec)
+    cache_path = get_cache_dir() / SPEC_CACHE_DIRNAME / '{}.pickle'.format(
+        hashlib.sha1('\n'.join(key).encode('utf-8')).hexdigest())
+    if key not in _specs_experiments and cache and cache_path.exists():
+        try:
+            with cache_path.open('rb') as cache_file:
+                _specs_experiments[key] = pickle.load(cache_file)
+            LOGGER.debug('Experiments of {} loaded from {}'.format(script, cache_path))
+        except Exception as e:
+            LOGGER.debug('Could not load cached experiments of {}: {}'.format(script, e))
+
+    if key not in _specs_experiments:
+        spec_fun = get_experiments_spec_handle(script, spec)
+        experiments = [_to_experiment_params(experiment) for experiment in spec_fun()] if spec_fun else None
+        _specs_experiments[key] = experiments
+        if cache:
+            # written under temporary name first, so concurrent mrunner invocations never read partial file
+            tmp_path = Path('{}.{}.tmp'.format(cache_path, id_generator(6)))
+            try:
+                cache_path.parent.makedirs_p()
+                with tmp_path.open('wb') as cache_file:
+                    pickle.dump(experiments, cache_file)
+                tmp_path.rename(cache_path)
+            except (pickle.PicklingError, TypeError, AttributeError, IOError, OSError) as e:
+                LOGGER.debug('Could not cache experiments of {}: {}'.format(script, e))
+            finally:
+                tmp_path.remove_p()
+
+    experiments = _specs_experiments[key]
+    # experiments are modified by callers
+    return [dict(experiment) for experiment in experiments] if experiments is not None else None
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Submission of experiments from python code. Session keeps backends (with their api clients and connections)
+between submissions, thus large sweeps may be submitted in batches without paying start-up costs each time.
+"""
+import collections
+import logging
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+from path import Path
+
+from mrunner.backends import get_backend_class
+from mrunner.experiment import prepare_experiments
+from mrunner.plgrid import PLGRID_USERNAME, PLGRID_HOST
+from mrunner.utils.namesgenerator import get_random_name, id_generator
+from mrunner.utils.pipeline import Pipeline
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_SLURM_URL = '{}@{}'.format(PLGRID_USERNAME, PLGRID_HOST)
+NEPTUNE_CODE_DIR = 'neptune_mrunner'  # where neptune yamls are placed among copied experiment code
+
+PreparedExperiment = collections.namedtuple('PreparedExperiment', 'experiment script signature parameter_names')
+
+
+def create_backend(backend_type, context):
+    return get_backend_class(backend_type).from_context(context)
+
+
+_backends = {}  # (backend type, context) -> (backend, creation time)
+_backends_lock = threading.Lock()
+
+
+def get_backend(backend_type, context):
+    """Returns backend shared by sessions with same context, thus its api clients and connections are reused"""
+    key = repr((backend_type, sorted(context.items())))
+    with _backends_lock:
+        if key not in _backends:
+            _backends[key] = (create_backend(backend_type, context), time.time())
+        return _backends[key][0]
+
+
+def expire_backends(max_age):
+    """Forgets backends created more than max_age seconds ago (with facts about cluster cached by them)"""
+    with _backends_lock:
+        for key, (_, created) in list(_backends.items()):
+            if time.time() - created > max_age:
+                del _backends[key]
+
+
+def new_sweep_id():
+    return '{}-{}'.format(get_random_name('-'), id_generator(4))
+
+
+def get_default_config_path(app_name='mrunner'):
+    import click
+    return Path(click.get_app_dir(app_name)) / 'config.yaml'
+
+
+def get_efficiency_store(config_path=None):
+    """Returns store of resources efficiency kept next to mrunner configuration (the one used by CLI)"""
+    from mrunner.utils.efficiency import EfficiencyStore
+    return EfficiencyStore(Path(config_path or get_default_config_path()).abspath().parent /
+                           EfficiencyStore.DEFAULT_FILENAME)
+
+
+def load_context(context_name=None, config_path=None):
+    """Loads context from mrunner configuration (by default: active context from user configuration)"""
+    from mrunner.cli.config import ConfigParser, get_context
+
+    config = ConfigParser(Path(config_path or get_default_config_path())).load()
+    return get_context(config, context_name or config.current_context)
+
+
+def _extract_params_names(params):
+    return [p.lstrip('-').split('=')[0] for p in params if p.startswith('-')]
+
+
+class Session(object):
+    """Prepares and submits experiments in given context; backends are shared by sessions with same context"""
+
+    def __init__(self, context, base_image=None, requirements=None, tags=(), params=(), jobs=None,
+                 neptune=None, sweep_id=None, efficiency_store=None):
+        if isinstance(context, str):
+            context = load_context(context)
+        self.context = context
+        self.base_image = base_image or context.get('base_image')
+        self.requirements = list(requirements or context.get('requirements') or [])
+        self.tags = list(tags)
+        self.params = list(params)
+        self.jobs = jobs
+        self.neptune_support = bool(context.get('neptune') or neptune)
+        self.sweep_id = sweep_id or new_sweep_id()
+        self.efficiency_store = efficiency_store if efficiency_store is not None else get_efficiency_store()
+        if context['backend_type'] == 'kubernetes' and not self.base_image:
+            raise ValueError('Provide docker base image')
+        if not self.neptune_support:
+            raise ValueError('Experiments without neptune are not supported yet (enable neptune in context)')
+
+        self._backends = {}
+        self._backends_lock = threading.Lock()
+        self._threads = []
+
+    def backend(self, backend_type):
+        with self._backends_lock:
+            if backend_type not in self._backends:
+                self._backends[backend_type] = get_backend(backend_type, self.context)
+            return self._backends[backend_type]
+
+    def prepare(self, entry, sweep_id=None):
+        """Prepares (neptune_path, experiment) pair, as generated by generate_experiments, for submission"""
+        from mrunner.utils.efficiency import experiment_signature, apply_recommendation, DEFAULT_HEADROOM
+        from mrunner.utils.neptune import NeptuneWrapperCmd
+
+        neptune_path, experiment = entry
+        experiment.update({'base_image': self.base_image, 'requirements': self.requirements,
+                           'sweep_id': sweep_id or self.sweep_id})
+
+        experiment_script = experiment.pop('script')
+        cmd = ' '.join([experiment_script] + self.params)
+        # tags from neptune.yaml will be extracted by neptune
+        additional_tags = self.context.get('tags', []) + self.tags
+        cmd = NeptuneWrapperCmd(cmd=cmd, experiment_config_path=neptune_path,
+                                neptune_storage=self.context['storage_dir'],
+                                paths_to_dump=None,
+                                additional_tags=additional_tags)
+        experiment['cmd'] = cmd
+        experiment.setdefault('paths_to_copy', [])
+        for possible_token_path in ['~/.neptune_tokens/token', '~/.neptune/tokens/token']:
+            neptune_path = Path(possible_token_path).expanduser().abspath()
+            if neptune_path.exists():
+                neptune_token_files = experiment.setdefault('neptune_token_files', [])
+                neptune_token_files.append(str(neptune_path))
+
+        assert len(experiment.get('neptune_token_files', [])) < 2, \
+            'You have multiple neptune tokens ({}); remove obsolete'.format(
+                ', '.join(experiment['neptune_token_files']))
+
+        parameter_names = experiment.pop('parameter_names', None) or _extract_params_names(self.params)
+        signature = experiment_signature(experiment.get('project'), experiment_script, parameter_names)
+        if experiment['backend_type'] == 'slurm' and self.efficiency_store and self.context.get('resources_advice'):
+            headroom = float(self.context.get('resources_headroom', DEFAULT_HEADROOM))
+            recommended = self.efficiency_store.recommend(signature, headroom=headroom)
+            experiment['resources'] = apply_recommendation(experiment.get('resources'), recommended)
+
+        # backend is created while preparing, so its setup errors are reported before submission
+        self.backend(experiment['backend_type'])
+        return PreparedExperiment(experiment, experiment_script, signature, parameter_names)
+
+    def submit(self, prepared):
+        """Submits single prepared experiment (kubernetes ones shall be submitted with run_sweep)"""
+        return self.backend(prepared.experiment['backend_type']).run(experiment=prepared.experiment)
+
+    def run_sweep(self, prepared_experiments):
+        """Submits prepared kubernetes experiments as single sweep; returns jobs ids"""
+        from mrunner.backends.k8s import SWEEP_MODE_JOBS
+
+        context = self.context
+        return self.backend('kubernetes').run_sweep([prepared.experiment for prepared in prepared_experiments],
+                                                    mode=context.get('sweep_mode', SWEEP_MODE_JOBS),
+                                                    parallelism=context.get('parallelism'),
+                                                    idle_timeout=context.get('worker_idle_timeout'),
+                                                    submit_workers=self.jobs)
+
+    def record_submission(self, prepared, job_id):
+        """Remembers submitted slurm job, so its resources usage may be harvested later"""
+        experiment = prepared.experiment
+        if self.efficiency_store is None or experiment['backend_type'] != 'slurm' or not job_id:
+            return
+        self.efficiency_store.record_submission(prepared.signature, project=experiment.get('project'),
+                                                script=prepared.script, parameter_names=prepared.parameter_names,
+                                                job_id=job_id,
+                                                slurm_url=self.context.get('slurm_url', DEFAULT_SLURM_URL),
+                                                resources=experiment.get('resources'))
+        self.efficiency_store.save()
+
+    def submit_many(self, experiments, fail_fast=False):
+        """Submits Experiment objects (or dicts of their parameters, as yielded by spec functions) as new sweep;
+        returns futures of backend jobs ids in order of experiments; experiments are submitted in background"""
+        experiments = list(experiments)
+        futures = [Future() for _ in experiments]
+        for future in futures:
+            future.set_running_or_notify_cancel()
+        thread = threading.Thread(target=self._submit_many, args=(experiments, futures, fail_fast))
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+        return futures
+
+    def _submit_many(self, experiments, futures, fail_fast):
+        sweep_id = new_sweep_id()
+        # neptune yamls are kept outside of current directory (which is copied as experiment code, maybe by
+        # other submission at the same time) and are copied with experiment code as NEPTUNE_CODE_DIR
+        neptune_dir = Path(tempfile.mkdtemp(prefix='neptune_mrunner_'))
+        kubernetes = []  # (idx, prepared experiment) submitted as sweep after all experiments are prepared
+        try:
+            def _prepare(entry):
+                idx, (neptune_path, experiment) = entry
+                experiment.setdefault('paths_to_copy', []).append('{}:{}'.format(neptune_dir, NEPTUNE_CODE_DIR))
+                neptune_path = Path(NEPTUNE_CODE_DIR) / Path(neptune_path).name
+                prepared = self.prepare((neptune_path, experiment), sweep_id=sweep_id)
+                if prepared.experiment['backend_type'] == 'kubernetes':
+                    kubernetes.append((idx, prepared))
+                    return None
+                return idx, prepared
+
+            def _on_result(result):
+                if result.failed:
+                    futures[result.idx].set_exception(result.error)
+                elif isinstance(result.item[1], PreparedExperiment):
+                    self.record_submission(result.item[1], result.result)
+                    futures[result.idx].set_result(result.result)
+
+            pipeline = Pipeline(_prepare, lambda prepared: self.submit(prepared[1]), jobs=self.jobs,
+                                fail_fast=fail_fast)
+            entries = prepare_experiments(experiments, self.context, neptune_dir=neptune_dir)
+            results = pipeline.run(enumerate(entries), on_result=_on_result)
+            failed = [result for result in results if result.failed]
+
+            if kubernetes and not (failed and fail_fast):
+                try:
+                    job_ids = self.run_sweep([prepared for _, prepared in kubernetes])
+                    if len(job_ids) != len(kubernetes):
+                        job_ids = job_ids * len(kubernetes)  # indexed job runs all experiments
+                    for (idx, _), job_id in zip(kubernetes, job_ids):
+                        futures[idx].set_result(job_id)
+                except Exception as e:
+                    for idx, _ in kubernetes:
+                        futures[idx].set_exception(e)
+
+            # with fail_fast some experiments are never submitted
+            error = failed[0].error if failed else RuntimeError('Experiment was not submitted')
+            for future in futures:
+                if not future.done():
+                    future.set_exception(error)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            neptune_dir.rmtree_p()
+
+    def close(self):
+        """Waits till all experiments submitted in background are submitted"""
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(context, **session_kwargs):
+    """Returns session shared by calls with same context and session options"""
+    if isinstance(context, str):
+        context = load_context(context)
+    key = repr((sorted(context.items()), sorted(session_kwargs.items())))
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = Session(context, **session_kwargs)
+        return _sessions[key]
+
+
+def submit_many(experiments, context=None, fail_fast=False, **session_kwargs):
+    """Submits experiments (Experiment objects or dicts of their parameters) in given context (dict or name of
+    context from mrunner configuration; active one by default); returns futures of backend jobs ids"""
+    context = context if isinstance(context, dict) else load_context(context)
+    return get_session(context, **session_kwargs).submit_many(experiments, fail_fast=fail_fast)
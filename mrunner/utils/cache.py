@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from path import Path
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_cache_dir():
+    return Path(os.environ.get('XDG_CACHE_HOME', '~/.cache')).expanduser() / 'mrunner'
+
+
+class FileCache(object):
+    """Key-value store persisted in JSON file; entries expire after ttl seconds (never if ttl is None)"""
+
+    def __init__(self, path, ttl=None):
+        self._path = Path(path)
+        self._ttl = ttl
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._load().get(key)
+        if not entry or self._is_expired(entry):
+            return default
+        return entry['value']
+
+    def set(self, key, value):
+        with self._lock:
+            data = {k: v for k, v in self._load().items() if not self._is_expired(v)}
+            data[key] = {'value': value, 'timestamp': time.time()}
+            self._save(data)
+
+    def delete(self, key):
+        with self._lock:
+            data = self._load()
+            if data.pop(key, None) is not None:
+                self._save(data)
+
+    def _is_expired(self, entry):
+        return self._ttl is not None and time.time() - entry['timestamp'] > self._ttl
+
+    def _load(self):
+        try:
+            with self._path.open('r') as cache_file:
+                return json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self, data):
+        # write to temporary file first, so concurrent mrunner invocations never read partial file
+        self._path.abspath().parent.makedirs_p()
+        fd, tmp_path = tempfile.mkstemp(prefix='.mrunner_', dir=self._path.abspath().parent)
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(data, tmp_file)
+        os.rename(tmp_path, self._path)
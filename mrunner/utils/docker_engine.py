@@ -1,130 +1,433 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import io
+import json
 import logging
 import os
+import posixpath
+import tarfile
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import call
 
 import attr
-from docker.errors import ImageNotFound
+from docker.errors import ImageNotFound, APIError, NotFound
 from path import Path
 
+from mrunner.utils.cache import FileCache, get_cache_dir
 from mrunner.utils.utils import GeneratedTemplateFile, get_paths_to_copy
 
 LOGGER = logging.getLogger(__name__)
 
-
-class RequirementsFile(object):
-
-    def __init__(self, path, requirements):
-        self._path = Path(path)
-        with open(path, 'w') as requirements_file:
-            payload = '\n'.join(requirements)
-            requirements_file.writelines(payload)
-
-    def __del__(self):
-        self._path.remove_p()
+BUILD_CONTEXT_CODE_DIR = 'code'
+BUILD_CONTEXT_REQUIREMENTS = 'requirements.txt'
+
+BASE_IMAGE_PULL_ALWAYS = 'always'
+BASE_IMAGE_PULL_IF_NOT_PRESENT = 'if-not-present'
+
+DEFAULT_DOCKER_URL = 'unix:///var/run/docker.sock'
+BASE_IMAGE_DIGEST_TTL = 60  # seconds for which digest resolved with 'always' policy is reused (ex. within sweep)
+DEFAULT_PUSH_WORKERS = 2
+PROGRESS_INTERVAL = 10  # seconds between push progress reports
+LOGIN_TTL = 3600  # seconds after which registry credentials are refreshed
+AUTH_ERRORS = ('unauthorized', 'authentication required', 'denied')
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_docker_client(docker_url):
+    """Returns docker client shared within process, thus its connections and registries credentials are reused"""
+    import docker
+
+    with _clients_lock:
+        if docker_url not in _clients:
+            _clients[docker_url] = docker.DockerClient(base_url=docker_url)
+        return _clients[docker_url]
+
+
+def get_docker_config():
+    path = Path(os.environ.get('DOCKER_CONFIG', '~/.docker')).expanduser() / 'config.json'
+    try:
+        return json.loads(path.text())
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def pin_image(image, digest):
+    """Replaces tag of image with digest, ex. python:3 -> python@sha256:..."""
+    repository = image.split('@')[0]
+    if ':' in repository.rsplit('/', 1)[-1]:
+        repository = repository.rsplit(':', 1)[0]
+    return '{}@{}'.format(repository, digest)
+
+
+def rewrite_paths(cwd, cmd):
+    """Paths in command shall be relative to experiment directory, which is copied into docker image"""
+    updated_cmd = []
+    for item in cmd.split(' '):
+        if Path(item).exists():
+            item = Path(cwd).relpathto(item)
+        updated_cmd.append(item)
+    return ' '.join(updated_cmd)
+
+
+def _normalize_tar_info(info):
+    # archive content shall depend only on content of files
+    info.mtime, info.uid, info.gid, info.uname, info.gname = 0, 0, 0, '', ''
+    return info
+
+
+def _add_bytes(tar_file, name, data):
+    info = _normalize_tar_info(tarfile.TarInfo(name))
+    info.size = len(data)
+    tar_file.addfile(info, io.BytesIO(data))
+
+
+def add_code_to_archive(tar_file, experiment, prefix=''):
+    """Adds experiment code (paths_to_copy) into tar archive; returns list of added paths"""
+    with Path(experiment.cwd):
+        paths_to_copy = sorted(get_paths_to_copy(exclude=experiment.exclude, paths_to_copy=experiment.paths_to_copy))
+        for local_path, remote_path in paths_to_copy:
+            tar_file.add(local_path, arcname=posixpath.join(prefix, remote_path), filter=_normalize_tar_info)
+    return [remote_path for _, remote_path in paths_to_copy]
+
+
+def create_code_archive(experiment):
+    """Packs experiment code into tar archive; archive content depends only on content of files,
+    thus its hash identifies code; returns (hash, payload)"""
+    payload = io.BytesIO()
+    with tarfile.open(fileobj=payload, mode='w') as tar_file:
+        add_code_to_archive(tar_file, experiment)
+    payload = payload.getvalue()
+    return hashlib.sha1(payload).hexdigest(), payload
+
+
+def create_build_context(context_file, experiment, deps_only=False):
+    """Writes docker build context (tar archive) with Dockerfile, requirements file and (unless deps_only)
+    experiment code only; returns hash of the context"""
+    with tarfile.open(fileobj=context_file, mode='w') as tar_file:
+        paths_to_copy = []
+        if not deps_only:
+            paths_to_copy = add_code_to_archive(tar_file, experiment, prefix=BUILD_CONTEXT_CODE_DIR)
+        _add_bytes(tar_file, BUILD_CONTEXT_REQUIREMENTS, '\n'.join(experiment.requirements).encode('utf-8'))
+        dockerfile = DockerFile(experiment=experiment, requirements_file=BUILD_CONTEXT_REQUIREMENTS,
+                                paths_to_copy=[(posixpath.join(BUILD_CONTEXT_CODE_DIR, path), path)
+                                               for path in paths_to_copy],
+                                deps_only=deps_only, buildkit=bool(experiment.buildkit))
+        LOGGER.debug('Dockerfile created:')
+        LOGGER.debug(Path(dockerfile.path).text())
+        tar_file.add(dockerfile.path, arcname='Dockerfile', filter=_normalize_tar_info)
+
+    context_hash = hashlib.sha1()
+    context_file.seek(0)
+    for chunk in iter(lambda: context_file.read(1024 * 1024), b''):
+        context_hash.update(chunk)
+    context_file.seek(0)
+    return context_hash.hexdigest()
+
+
+def _format_size(size):
+    return '{:.1f}MB'.format(size / 1024. / 1024)
+
+
+def _is_auth_error(error):
+    return any(message in str(error).lower() for message in AUTH_ERRORS)
+
+
+def _raise_on_error(event, what):
+    if 'error' in event or 'errorDetail' in event:
+        error = event.get('error') or event['errorDetail'].get('message')
+        raise RuntimeError('Failed to {}: {}'.format(what, error))
+
+
+def _get_digest_max_age(policy):
+    """Returns number of seconds after which digest of base image is resolved again (None: never)"""
+    if policy == BASE_IMAGE_PULL_ALWAYS:
+        return BASE_IMAGE_DIGEST_TTL
+    if policy == BASE_IMAGE_PULL_IF_NOT_PRESENT:
+        return None
+    try:
+        return float(policy) * 60
+    except ValueError:
+        raise ValueError('Unknown base image pull policy: {} (use {}, {} or number of minutes)'.format(
+            policy, BASE_IMAGE_PULL_ALWAYS, BASE_IMAGE_PULL_IF_NOT_PRESENT))
+
+
+class PushProgress(object):
+    """Tracks per-layer progress of image push from stream of docker events"""
+
+    def __init__(self, image_name):
+        self.image_name = image_name
+        self.layers = {}  # layer id -> (pushed bytes, total bytes)
+        self.started = self._last_report = time.time()
+
+    def update(self, event):
+        _raise_on_error(event, 'push {} docker image'.format(self.image_name))
+        layer, status, detail = event.get('id'), event.get('status', ''), event.get('progressDetail') or {}
+        if not layer:
+            return
+        if detail.get('total'):
+            self.layers[layer] = (detail.get('current', 0), detail['total'])
+        elif status in ('Pushed', 'Layer already exists') or status.startswith('Mounted from'):
+            _, total = self.layers.get(layer, (0, 0))
+            self.layers[layer] = (total, total)
+            LOGGER.debug('{}: layer {} {}'.format(self.image_name, layer, status.lower()))
+        if time.time() - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = time.time()
+            LOGGER.info('Pushing {}: {}'.format(self.image_name, self.summary()))
 
     @property
-    def path(self):
-        return self._path
-
+    def pushed(self):
+        return sum(current for current, _ in self.layers.values())
 
-StaticCmd = attr.make_class('StaticCmd', ['command', 'env'], frozen=True)
+    def summary(self):
+        total = sum(total for _, total in self.layers.values())
+        done = len([1 for current, total_ in self.layers.values() if current >= total_])
+        elapsed = max(time.time() - self.started, 1e-3)
+        return '{}/{} layers, {}/{} ({}/s)'.format(done, len(self.layers), _format_size(self.pushed),
+                                                   _format_size(total), _format_size(self.pushed / elapsed))
 
 
 class DockerFile(GeneratedTemplateFile):
     DEFAULT_DOCKERFILE_TEMPLATE = 'Dockerfile.jinja2'
 
-    def __init__(self, experiment, requirements_file):
-        experiment_data = attr.asdict(experiment)
-        # paths in command shall be relative
-        cmd = experiment_data.pop('cmd')
-        updated_cmd = self._rewrite_paths(experiment.cwd, cmd.command)
-        paths_to_copy = get_paths_to_copy(exclude=experiment.exclude, paths_to_copy=experiment.paths_to_copy)
-        experiment = attr.evolve(experiment, cmd=StaticCmd(command=updated_cmd, env=cmd.env))
-
+    def __init__(self, experiment, requirements_file, paths_to_copy, deps_only=False, buildkit=False):
+        # image doesn't depend on experiment command; it is set by backend
         super(DockerFile, self).__init__(template_filename=self.DEFAULT_DOCKERFILE_TEMPLATE,
                                          experiment=experiment, requirements_file=requirements_file,
-                                         paths_to_copy=paths_to_copy)
-
-    def _rewrite_paths(self, cwd, cmd):
-        updated_cmd = []
-        for item in cmd.split(' '):
-            if Path(item).exists():
-                item = Path(cwd).relpathto(item)
-            updated_cmd.append(item)
-        return ' '.join(updated_cmd)
+                                         paths_to_copy=paths_to_copy, deps_only=deps_only, buildkit=buildkit)
 
 
 class DockerEngine(object):
-
-    def __init__(self, docker_url=None):
-        import docker
-        base_url = docker_url if docker_url else os.environ.get('DOCKER_HOST', 'unix://var/run/docker.sock')
-        self._client = docker.DockerClient(base_url=base_url)
+    # images published by this process; experiments of sweep share image
+    _published_images = set()
+    # (docker url, registry url, credentials) -> time of login; credentials are kept by shared docker client
+    _logins = {}
+    _login_lock = threading.Lock()
+    BASE_IMAGES_CACHE_FILENAME = 'base_images.json'
+
+    def __init__(self, docker_url=None, client=None, push_workers=None):
+        base_url = docker_url if docker_url else os.environ.get('DOCKER_HOST', DEFAULT_DOCKER_URL)
+        self._client = client or get_docker_client(base_url)
+        self._docker_url = base_url
+        self._docker_host = docker_url  # passed to docker CLI only if given explicitly
+        self._base_images_cache = FileCache(get_cache_dir() / self.BASE_IMAGES_CACHE_FILENAME)
+        self._base_images_digests = {}  # (base image, pull policy) -> (digest, time of resolving it)
+        self._base_images_lock = threading.Lock()
+
+        # images are pushed in background, so next image may be built meanwhile
+        self._push_executor = ThreadPoolExecutor(max_workers=int(push_workers or DEFAULT_PUSH_WORKERS))
+        self._pushes = {}  # image name -> future of its push; forgotten once waited for
+        self._pushes_lock = threading.Lock()
 
     def _login_with_docker(self, experiment):
         self._client.login(registry=experiment.registry_url, username=experiment.registry_username,
                            password=experiment.registry_password, reauth=True)
 
     def _login_with_gcloud(self, experiment):
-        call('gcloud auth configure-docker'.split(' '))
+        # gcloud credential helper obtains (and refreshes) tokens by itself; it needs to be configured only once
+        registry_host = experiment.registry_url.split(r'://')[1].split('/')[0]
+        if get_docker_config().get('credHelpers', {}).get(registry_host) != 'gcloud':
+            call('gcloud auth configure-docker'.split(' '))
 
-    def build_and_publish_image(self, experiment):
+    def _login(self, experiment, force=False):
+        """Logs into registry once per process (and again after LOGIN_TTL seconds or if force is set)"""
         registry_url = experiment.registry_url
         self._is_gcr = registry_url and registry_url.startswith('https://gcr.io')
-        if registry_url:
+        if not registry_url:
+            return
+
+        # contexts with other credentials for the same registry log in by themselves (password is kept hashed)
+        password_hash = hashlib.sha1((experiment.registry_password or '').encode('utf-8')).hexdigest()
+        key = (self._docker_url, registry_url, experiment.registry_username, password_hash)
+        with self._login_lock:
+            logged_in = self._logins.get(key)
+            if not force and logged_in and time.time() - logged_in < LOGIN_TTL:
+                return
             _login = self._login_with_gcloud if self._is_gcr else self._login_with_docker
             _login(experiment)
+            self._logins[key] = time.time()
+
+    def build_and_publish_image(self, experiment, wait=True):
+        """Builds and publishes image with experiment dependencies and code; image is shared by all experiments
+        with same base image, requirements and code"""
+        return self._build_and_publish(experiment, 'experiments', deps_only=False, wait=wait)
+
+    def build_and_publish_deps_image(self, experiment, wait=True):
+        """Builds and publishes image with experiment dependencies only (without code)"""
+        return self._build_and_publish(experiment, 'deps', deps_only=True, wait=wait)
+
+    def wait_for_push(self, *image_names):
+        """Waits till given images (or all scheduled for push, if none given) are published; raises if any push
+        failed. Waited pushes are forgotten, thus image which failed to be pushed is built and pushed again"""
+        with self._pushes_lock:
+            pushes = [(name, self._pushes.get(name)) for name in image_names or list(self._pushes)]
+        error = None
+        for image_name, future in pushes:
+            if future is None:
+                continue
+            try:
+                future.result()
+            except Exception as e:
+                error = error or e
+            finally:
+                with self._pushes_lock:
+                    if self._pushes.get(image_name) is future:
+                        del self._pushes[image_name]
+        if error:
+            raise error
+
+    def _build_and_publish(self, experiment, name, deps_only, wait=True):
+        """Image is tagged with hash of its content (base image digest, build context and build args),
+        thus it is built and pushed only once; unless wait is set, push is done in background
+        (see wait_for_push)"""
+        self._login(experiment)
+
+        # base image is pinned with digest, thus build doesn't need to reach registry for it
+        base_image_digest = self._get_base_image_digest(experiment)
+        if base_image_digest:
+            experiment = attr.evolve(experiment, base_image=pin_image(experiment.base_image, base_image_digest))
+        pull = not base_image_digest and experiment.base_image_pull == BASE_IMAGE_PULL_ALWAYS
+
+        # build context contains only files copied into image; it is streamed to docker from temporary file
+        with tempfile.TemporaryFile() as context_file:
+            context_hash = create_build_context(context_file, experiment, deps_only=deps_only)
+            neptune_build_args = self._get_neptune_build_args(experiment)
+            content_hash = hashlib.sha1('\n'.join([experiment.base_image, context_hash] +
+                                                  sorted('{}={}'.format(k, v) for k, v in neptune_build_args.items()))
+                                        .encode('utf-8')).hexdigest()[:16]
+            repository_name = self._generate_repository_name(experiment, name=name)
+            image_name = '{}:{}'.format(repository_name, content_hash)
+            with self._pushes_lock:
+                push = self._pushes.get(image_name)
+                if push and push.done() and push.exception():
+                    del self._pushes[image_name]  # failed push (not waited for yet) is retried
+                    push = None
+            if push:
+                pass  # already built by this engine; its push may be still in progress
+            elif image_name in self._published_images or self._is_published(image_name, repository_name):
+                LOGGER.debug('Docker image {} is up to date'.format(image_name))
+                self._published_images.add(image_name)
+                return image_name
+            else:
+                LOGGER.info('Building docker image {}'.format(image_name))
+                if experiment.buildkit:
+                    self._build_with_buildx(context_file, image_name, neptune_build_args, pull=pull)
+                else:
+                    self._build(context_file, image_name, neptune_build_args, pull=pull)
+                with self._pushes_lock:
+                    self._pushes[image_name] = self._push_executor.submit(self._push, experiment, repository_name,
+                                                                          content_hash)
+
+        if wait:
+            self.wait_for_push(image_name)
+        return image_name
 
-        # requirements filename shall be constant for experiment, to use docker cache during build;
-        # thus we don't use dynamic/temporary file names
-        file_path = self._generate_requirements_name(experiment)
-        requirements = RequirementsFile(file_path, experiment.requirements)
-        LOGGER.debug('Requirements file created:')
-        LOGGER.debug(Path(file_path).text())
-
-        dockerfile = DockerFile(experiment=experiment, requirements_file=requirements.path)
-        LOGGER.debug('Dockerfile created:')
-        dockerfile_rel_path = Path(experiment.cwd).relpathto(dockerfile.path)
-
-        # obtain old image for comparison if there where any changes
-        repository_name = self._generate_repository_name(experiment)
+    def _build(self, context_file, image_name, build_args, pull):
+        """Builds image with legacy builder; build output is streamed into debug log"""
+        events = self._client.api.build(fileobj=context_file, custom_context=True, tag=image_name,
+                                        buildargs=build_args, pull=pull, rm=True, forcerm=True, decode=True)
+        for event in events:
+            _raise_on_error(event, 'build {} docker image'.format(image_name))
+            if event.get('stream', '').strip():
+                LOGGER.debug(event['stream'].rstrip())
+
+    def _push(self, experiment, repository_name, tag):
+        """Pushes image; if registry rejects credentials (ex. expired token), logs in again and retries once"""
+        image_name = '{}:{}'.format(repository_name, tag)
+        for attempt in range(2):
+            progress = PushProgress(image_name)
+            try:
+                for event in self._client.api.push(repository_name, tag=tag, stream=True, decode=True):
+                    progress.update(event)
+                break
+            except RuntimeError as e:
+                if attempt or not _is_auth_error(e):
+                    raise
+                LOGGER.info('Registry {} rejected credentials; logging in again'.format(experiment.registry_url))
+                self._login(experiment, force=True)
+        LOGGER.info('Docker image {} published ({})'.format(image_name, progress.summary()))
+        self._published_images.add(image_name)
+
+    def _build_with_buildx(self, context_file, image_name, build_args, pull):
+        """Builds image with BuildKit (docker-py supports only legacy builder); image is loaded into docker,
+        thus it is pushed as other images"""
+        cmd = ['docker', 'buildx', 'build', '--load', '--tag', image_name]
+        # values of build args are passed through environment, so they are not visible in processes list
+        for key in sorted(build_args):
+            cmd += ['--build-arg', key]
+        if pull:
+            cmd.append('--pull')
+        cmd.append('-')  # build context is read from stdin
+        env = dict(os.environ, DOCKER_BUILDKIT='1', **build_args)
+        if self._docker_host:
+            env['DOCKER_HOST'] = self._docker_host
+        LOGGER.debug('Running: {}'.format(' '.join(cmd)))
+        if call(cmd, stdin=context_file, env=env):
+            raise RuntimeError('Failed to build {} docker image with BuildKit'.format(image_name))
+
+    def _is_published(self, image_name, repository_name):
+        """Checks if image with given tag is already in registry; build and push are skipped then"""
         try:
-            old_image = self._client.images.get(repository_name + ':latest')
+            # local image with digest in target repository was already pushed into (or pulled from) it; digests
+            # of other repositories (ex. image built for other registry) don't count
+            repo_digests = self._client.images.get(image_name).attrs.get('RepoDigests') or []
+            if any(repo_digest.split('@')[0] == repository_name for repo_digest in repo_digests):
+                return True
         except ImageNotFound:
-            old_image = None
-
-        # build image; use cache if possible
-        LOGGER.debug(Path(dockerfile.path).text())
-        LOGGER.debug('Building docker image')
-        neptune_build_args = self._get_neptune_build_args(experiment)
-        image, _ = self._client.images.build(path=experiment.cwd, tag=repository_name,
-                                             buildargs=neptune_build_args,
-                                             dockerfile=dockerfile_rel_path, pull=True, rm=True, forcerm=True)
-
-        is_image_updated = not old_image or old_image.id != image.id
-        LOGGER.debug('Docker image built (updated={})'.format(is_image_updated))
-        if is_image_updated:
-            # if new image is generated - tag it and push to repository
-            tag = self._get_tag()
-            image.tag(repository_name, tag=tag)
-            LOGGER.debug('Docker image tagged: {}'.format(tag))
-            result = self._client.images.push(repository_name, tag=tag)
-            LOGGER.debug('Docker image published: {}'.format(tag))
-            if 'errorDetail' in result:
-                raise RuntimeError(result)
-            image = self._client.images.get(repository_name)
-
-        # obtain image name with our tag
-        image_name = [tag for tag in image.tags if not tag.endswith('latest')][0]
-        LOGGER.debug('Docker image {} ready'.format(image_name))
-        return image_name
-
-    def _generate_requirements_name(self, experiment):
-        return 'requirements_{}_{}.txt'.format(experiment.project, experiment.name)
+            pass
+        try:
+            # manifest of image is obtained from registry (without pulling image)
+            self._client.images.get_registry_data(image_name)
+            return True
+        except NotFound:
+            return False
+        except APIError as e:
+            LOGGER.debug('Could not check {} image in registry: {}'.format(image_name, e))
+            return False
+
+    def _get_base_image_digest(self, experiment):
+        """Resolves digest of base image according to pull policy (always, if-not-present or number of minutes
+        after which digest is resolved again); digests are cached on disk; returns None if digest is unknown"""
+        base_image, policy = experiment.base_image, str(experiment.base_image_pull or BASE_IMAGE_PULL_ALWAYS)
+        max_age = _get_digest_max_age(policy)
+        with self._base_images_lock:
+            # digest is reused by this engine only as long as policy allows (engines live long in sessions and daemon)
+            memo = self._base_images_digests.get((base_image, policy))
+            if memo and (max_age is None or time.time() - memo[1] < max_age):
+                return memo[0]
+
+            cached = self._base_images_cache.get(base_image)
+            digest, resolved = None, time.time()
+            if policy == BASE_IMAGE_PULL_IF_NOT_PRESENT:
+                digest = cached['digest'] if cached else self._get_local_digest(base_image)
+            elif policy != BASE_IMAGE_PULL_ALWAYS and cached and time.time() - cached['resolved'] < max_age:
+                digest, resolved = cached['digest'], cached['resolved']
+
+            if not digest:
+                try:
+                    digest = self._client.images.get_registry_data(base_image).id
+                    self._base_images_cache.set(base_image, {'digest': digest, 'resolved': resolved})
+                except APIError as e:
+                    digest = cached['digest'] if cached else self._get_local_digest(base_image)
+                    LOGGER.warning('Could not obtain digest of {} image from registry (using {}): {}'.format(
+                        base_image, digest, e))
+            LOGGER.debug('Base image {}: {}'.format(base_image, digest))
+            self._base_images_digests[(base_image, policy)] = (digest, resolved)
+            return digest
+
+    def _get_local_digest(self, image):
+        try:
+            repo_digests = self._client.images.get(image).attrs.get('RepoDigests') or []
+        except ImageNotFound:
+            return None
+        return repo_digests[0].split('@')[1] if repo_digests else None
 
-    def _generate_repository_name(self, experiment):
-        image_name = '{}/{}'.format(experiment.project, experiment.name)
+    def _generate_repository_name(self, experiment, name):
+        image_name = '{}/{}'.format(experiment.project, name)
 
         # while publishing images there is need to prefix them with repository hostname
         if experiment.registry_url:
@@ -138,10 +441,6 @@ class DockerEngine(object):
 
         return image_name
 
-    def _get_tag(self):
-        from datetime import datetime
-        return datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-
     def _get_neptune_build_args(self, experiment):
         args = {}
         if experiment.neptune_token_files:
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import math
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+import yaml
+from path import Path
+
+LOGGER = logging.getLogger(__name__)
+
+MEMORY_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+FINISHED_STATES = ['COMPLETED', 'FAILED', 'TIMEOUT', 'OUT_OF_MEMORY', 'CANCELLED', 'NODE_FAIL', 'PREEMPTED']
+DEFAULT_HEADROOM = 1.2
+
+JobUsage = namedtuple('JobUsage', 'job_id state elapsed total_cpu max_rss alloc_cpus')
+
+
+def parse_slurm_duration(value):
+    """Converts slurm [DD-[HH:]]MM:SS[.mmm] notation into seconds"""
+    value = value.strip()
+    if not value:
+        return 0.
+    days = 0
+    if '-' in value:
+        days, value = value.split('-', 1)
+    parts = [float(p) for p in value.split(':')]
+    while len(parts) < 3:
+        parts.insert(0, 0.)
+    hours, minutes, seconds = parts
+    return ((int(days) * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def parse_slurm_memory(value, default_unit=None):
+    """Converts memory notation (ex. 1234K, 8G) into bytes; values without unit are interpreted with default_unit"""
+    value = str(value).strip().upper()
+    if not value:
+        return 0
+    if value[-1] in MEMORY_UNITS:
+        return int(float(value[:-1]) * MEMORY_UNITS[value[-1]])
+    return int(float(value) * MEMORY_UNITS.get(default_unit, 1))
+
+
+def format_memory(value):
+    """Formats number of bytes into mrunner resources notation, rounding up"""
+    for unit in ['G', 'M']:
+        if value >= MEMORY_UNITS[unit] or unit == 'M':
+            return '{}{}'.format(max(int(math.ceil(float(value) / MEMORY_UNITS[unit])), 1), unit)
+
+
+def parse_sacct(output):
+    """Parses output of `sacct --noheader --parsable2 --format=JobID,State,Elapsed,TotalCPU,MaxRSS,AllocCPUS`;
+    MaxRSS is reported only for job steps, so it is aggregated over all steps of given job"""
+    jobs = {}
+    max_rss = {}
+    for line in output.splitlines():
+        line = line.strip()
+        if not line or '|' not in line:
+            continue
+        job_id, state, elapsed, total_cpu, rss, alloc_cpus = line.split('|')[:6]
+        main_id = job_id.split('.')[0]
+        max_rss[main_id] = max(max_rss.get(main_id, 0), parse_slurm_memory(rss))
+        if job_id == main_id:
+            jobs[main_id] = JobUsage(job_id=main_id, state=state.split(' ')[0],
+                                     elapsed=parse_slurm_duration(elapsed),
+                                     total_cpu=parse_slurm_duration(total_cpu),
+                                     max_rss=0, alloc_cpus=int(alloc_cpus or 1))
+    return {job_id: usage._replace(max_rss=max_rss.get(job_id, 0)) for job_id, usage in jobs.items()}
+
+
+def experiment_signature(project, script, parameter_names):
+    """Experiments with same project, script and set of parameters are assumed to have similar resource usage"""
+    payload = '|'.join([project or '', Path(script).normpath(), ','.join(sorted(parameter_names or []))])
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:12]
+
+
+def recommend_resources(jobs, headroom=DEFAULT_HEADROOM):
+    """Recommends cpu and mem resources (mrunner notation) based on peak usage of finished jobs"""
+    usages = [JobUsage(**job['usage']) for job in jobs if job.get('usage')]
+    completed = [u for u in usages if u.state == 'COMPLETED' and u.elapsed > 0]
+    if not completed:
+        return {}
+
+    recommended = {}
+    cpus_used = max(u.total_cpu / u.elapsed for u in completed)
+    recommended['cpu'] = str(max(int(math.ceil(cpus_used * headroom)), 1))
+
+    max_rss = max(u.max_rss for u in completed)
+    out_of_memory = [u for u in usages if u.state == 'OUT_OF_MEMORY']
+    if max_rss and not out_of_memory:
+        recommended['mem'] = format_memory(max_rss * headroom)
+    return recommended
+
+
+def efficiency(job):
+    """Returns (cpu efficiency, memory efficiency) of single job; None if not available"""
+    usage = job.get('usage')
+    if not usage:
+        return None, None
+    usage = JobUsage(**usage)
+    cpu_eff = usage.total_cpu / (usage.elapsed * usage.alloc_cpus) if usage.elapsed else None
+    requested_mem = parse_slurm_memory(job.get('resources', {}).get('mem', 0), default_unit='M')
+    mem_eff = float(usage.max_rss) / requested_mem if requested_mem else None
+    return cpu_eff, mem_eff
+
+
+class EfficiencyStore(object):
+    """Stores resources requested by submitted slurm jobs and their usage harvested from sacct;
+    may be shared by threads submitting experiments"""
+    DEFAULT_FILENAME = 'efficiency.yaml'
+    MAX_JOBS_PER_SIGNATURE = 20
+
+    def __init__(self, path):
+        self._path = Path(path)
+        self._data = None
+        self._lock = threading.RLock()
+
+    @property
+    def data(self):
+        with self._lock:
+            if self._data is None:
+                data = {}
+                if self._path.exists():
+                    with self._path.open('r') as store_file:
+                        data = yaml.safe_load(store_file) or {}
+                self._data = data
+            return self._data
+
+    def save(self):
+        with self._lock:
+            self._path.abspath().parent.makedirs_p()
+            with self._path.open('w') as store_file:
+                yaml.safe_dump(self.data, store_file, default_flow_style=False)
+
+    def record_submission(self, signature, project, script, parameter_names, job_id, slurm_url, resources):
+        with self._lock:
+            entry = self.data.setdefault(signature, {'project': project, 'script': str(script),
+                                                     'parameter_names': sorted(parameter_names or []), 'jobs': []})
+            entry['jobs'].append({'job_id': str(job_id), 'slurm_url': slurm_url,
+                                  'resources': {k: str(v) for k, v in (resources or {}).items()},
+                                  'submitted': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+                                  'usage': None})
+            entry['jobs'] = entry['jobs'][-self.MAX_JOBS_PER_SIGNATURE:]
+
+    def pending_jobs(self, slurm_url=None):
+        return [job for entry in self.data.values() for job in entry['jobs']
+                if not job.get('usage') and (slurm_url is None or job['slurm_url'] == slurm_url)]
+
+    def update_usage(self, usages, slurm_url=None):
+        """Updates jobs with usage obtained from sacct; only finished jobs are updated"""
+        updated = 0
+        with self._lock:
+            for job in self.pending_jobs(slurm_url=slurm_url):
+                usage = usages.get(job['job_id'])
+                if usage and usage.state in FINISHED_STATES:
+                    job['usage'] = dict(usage._asdict())
+                    updated += 1
+        return updated
+
+    def recommend(self, signature, headroom=DEFAULT_HEADROOM):
+        entry = self.data.get(signature)
+        return recommend_resources(entry['jobs'], headroom=headroom) if entry else {}
+
+    def report(self, headroom=DEFAULT_HEADROOM):
+        """Yields per signature summary: (signature, entry, finished jobs number, cpu eff, mem eff, recommended)"""
+        for signature, entry in sorted(self.data.items(), key=lambda item: (item[1]['project'], item[1]['script'])):
+            efficiencies = [efficiency(job) for job in entry['jobs'] if job.get('usage')]
+            cpu_effs = [c for c, _ in efficiencies if c is not None]
+            mem_effs = [m for _, m in efficiencies if m is not None]
+            yield (signature, entry, len(efficiencies),
+                   sum(cpu_effs) / len(cpu_effs) if cpu_effs else None,
+                   sum(mem_effs) / len(mem_effs) if mem_effs else None,
+                   recommend_resources(entry['jobs'], headroom=headroom))
+
+
+def apply_recommendation(resources, recommended):
+    """Overwrites only requested resources types (cpu, mem) with recommended values"""
+    resources = dict(resources or {})
+    for resource_type, qty in recommended.items():
+        if resource_type in resources and str(resources[resource_type]) != qty:
+            LOGGER.info('Right-sizing {}: {} -> {}'.format(resource_type, resources[resource_type], qty))
+            resources[resource_type] = qty
+    return resources
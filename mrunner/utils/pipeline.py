@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Pipeline of stages connected by bounded queues: items are generated, prepared and submitted concurrently,
+thus first experiments are submitted while next ones are still generated.
+"""
+import logging
+import threading
+
+from six.moves import queue
+
+LOGGER = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.1
+_END = object()
+
+
+class PipelineResult(object):
+
+    def __init__(self, idx, item, result=None, error=None):
+        self.idx = idx
+        self.item = item
+        self.result = result
+        self.error = error
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+
+class Pipeline(object):
+    """Generates items in one thread, prepares them in second one and submits prepared items in `jobs` threads;
+    prepare may return None for items which shall not be submitted (ex. submitted later as batch).
+
+    With fail_fast no new items are generated nor submitted after first failure (already submitted ones
+    are finished); otherwise all items are processed. Results are reported with on_result callback (called
+    from thread running pipeline) in order of items."""
+
+    def __init__(self, prepare, submit, jobs=1, fail_fast=True, queue_size=None):
+        self._prepare = prepare
+        self._submit = submit
+        self._jobs = max(int(jobs or 1), 1)
+        self._fail_fast = fail_fast
+        self._queue_size = int(queue_size or 2 * self._jobs)
+        self._stop = threading.Event()
+
+    def run(self, items, on_result=None):
+        """Returns list of PipelineResult in order of items"""
+        self._stop.clear()
+        prepare_queue, submit_queue = queue.Queue(self._queue_size), queue.Queue(self._queue_size)
+        results_queue = queue.Queue()
+
+        threads = [threading.Thread(target=self._generate, args=(items, prepare_queue, results_queue)),
+                   threading.Thread(target=self._prepare_items, args=(prepare_queue, submit_queue, results_queue))]
+        threads += [threading.Thread(target=self._submit_items, args=(submit_queue, results_queue))
+                    for _ in range(self._jobs)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        # results are buffered till all preceding items are reported
+        results, pending, next_idx = [], {}, 0
+        while any(thread.is_alive() for thread in threads) or not results_queue.empty():
+            try:
+                result = results_queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if result.failed and self._fail_fast and not self._stop.is_set():
+                LOGGER.debug('Stopping pipeline after failure: {}'.format(result.error))
+                self._stop.set()
+            pending[result.idx] = result
+            while next_idx in pending:
+                results.append(self._report(pending.pop(next_idx), on_result))
+                next_idx += 1
+
+        # with fail_fast some items are never processed
+        for idx in sorted(pending):
+            results.append(self._report(pending[idx], on_result))
+        return results
+
+    @staticmethod
+    def _report(result, on_result):
+        if on_result:
+            on_result(result)
+        return result
+
+    def _put(self, target_queue, item):
+        while not self._stop.is_set():
+            try:
+                target_queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source_queue):
+        while not self._stop.is_set():
+            try:
+                return source_queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _generate(self, items, prepare_queue, results_queue):
+        count = 0
+        try:
+            for item in items:
+                if not self._put(prepare_queue, (count, item)):
+                    break
+                count += 1
+        except Exception as e:
+            results_queue.put(PipelineResult(count, None, error=e))
+        finally:
+            self._put(prepare_queue, _END)
+
+    def _prepare_items(self, prepare_queue, submit_queue, results_queue):
+        try:
+            while True:
+                entry = self._get(prepare_queue)
+                if entry is _END:
+                    break
+                idx, item = entry
+                try:
+                    prepared = self._prepare(item)
+                except Exception as e:
+                    results_queue.put(PipelineResult(idx, item, error=e))
+                    continue
+                if prepared is None:
+                    results_queue.put(PipelineResult(idx, item))
+                elif not self._put(submit_queue, (idx, prepared)):
+                    break
+        finally:
+            for _ in range(self._jobs):
+                self._put(submit_queue, _END)
+
+    def _submit_items(self, submit_queue, results_queue):
+        while True:
+            entry = self._get(submit_queue)
+            if entry is _END:
+                break
+            idx, prepared = entry
+            try:
+                results_queue.put(PipelineResult(idx, prepared, result=self._submit(prepared)))
+            except Exception as e:
+                results_queue.put(PipelineResult(idx, prepared, error=e))
@@ -1,5 +1,7 @@
 import datetime
 import logging
+import threading
+import time
 from collections import namedtuple, OrderedDict
 from tempfile import NamedTemporaryFile
 
@@ -116,3 +118,20 @@ def filter_only_attr(AttrClass, d):
             continue
         LOGGER.debug('Ignoring argument {}={}'.format(k, v))
     return {k: v for k, v in d.items() if k in available_fields}
+
+
+class RateLimiter(object):
+    """Thread safe limiter of calls rate; calls are evenly spread in time"""
+
+    def __init__(self, rate):
+        self._interval = 1. / rate if rate else 0.
+        self._lock = threading.Lock()
+        self._next_time = 0.
+
+    def acquire(self):
+        with self._lock:
+            now = time.time()
+            wait = self._next_time - now
+            self._next_time = max(now, self._next_time) + self._interval
+        if wait > 0:
+            time.sleep(wait)
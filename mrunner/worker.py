@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Worker running experiments taken from queue of experiment specs stored in (shared) directory.
+
+Module is copied into experiment docker image and run there as standalone script,
+thus it shall depend only on python standard library.
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_IDLE_TIMEOUT = 60
+DEFAULT_POLL_INTERVAL = 2
+DEFAULT_HEARTBEAT_INTERVAL = 30
+DEFAULT_LEASE = 300  # running spec without heartbeat for so many seconds is re-queued (its worker died)
+
+
+class FileQueue(object):
+    """
+    Queue of experiment specs (JSON files); spec is claimed by worker by atomic rename
+    from pending into running directory, thus each spec is run once; while spec is run, worker
+    touches it periodically, and specs of dead workers (not touched within lease) are re-queued
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+
+    def __init__(self, root):
+        self.root = root
+        for subdir in [self.PENDING, self.RUNNING, self.DONE]:
+            os.makedirs(os.path.join(root, subdir), exist_ok=True)
+
+    @staticmethod
+    def new_spec_id(name=''):
+        # specs are claimed in order of their ids
+        return '-'.join(p for p in ['{:013d}'.format(int(time.time() * 1000)), name, uuid.uuid4().hex[:6]] if p)
+
+    @staticmethod
+    def spec_filename(spec_id):
+        return '{}.json'.format(spec_id)
+
+    @staticmethod
+    def dumps(spec):
+        return json.dumps(spec, sort_keys=True).encode('utf-8')
+
+    def put(self, spec, spec_id=None):
+        spec_id = spec_id or self.new_spec_id()
+        self._write(os.path.join(self.root, self.PENDING, self.spec_filename(spec_id)), self.dumps(spec))
+        return spec_id
+
+    def claim(self):
+        """Returns (spec_id, spec) of first pending spec or None if queue is empty"""
+        pending_dir = os.path.join(self.root, self.PENDING)
+        for filename in sorted(os.listdir(pending_dir)):
+            if not filename.endswith('.json'):
+                continue
+            running_path = os.path.join(self.root, self.RUNNING, filename)
+            try:
+                os.rename(os.path.join(pending_dir, filename), running_path)
+                # lease starts with claim (modification time is preserved by rename)
+                os.utime(running_path, None)
+                with open(running_path, 'r') as spec_file:
+                    return filename[:-len('.json')], json.load(spec_file)
+            except OSError:
+                continue  # already claimed by other worker
+        return None
+
+    def heartbeat(self, spec_id):
+        """Extends lease of running spec"""
+        os.utime(os.path.join(self.root, self.RUNNING, self.spec_filename(spec_id)), None)
+
+    def requeue_stale(self, lease=DEFAULT_LEASE):
+        """Moves running specs not touched within lease seconds back to pending; returns their ids"""
+        running_dir = os.path.join(self.root, self.RUNNING)
+        requeued = []
+        for filename in sorted(os.listdir(running_dir)):
+            running_path = os.path.join(running_dir, filename)
+            try:
+                if not filename.endswith('.json') or time.time() - os.path.getmtime(running_path) < lease:
+                    continue
+                os.rename(running_path, os.path.join(self.root, self.PENDING, filename))
+            except OSError:
+                continue  # completed or re-queued meanwhile
+            requeued.append(filename[:-len('.json')])
+        return requeued
+
+    def complete(self, spec_id, spec, result):
+        filename = self.spec_filename(spec_id)
+        self._write(os.path.join(self.root, self.DONE, filename), self.dumps(dict(spec, result=result)))
+        try:
+            os.remove(os.path.join(self.root, self.RUNNING, filename))
+        except OSError:
+            pass  # lease expired and spec was re-queued
+
+    def depth(self):
+        return len([f for f in os.listdir(os.path.join(self.root, self.PENDING)) if f.endswith('.json')])
+
+    def results(self):
+        done_dir = os.path.join(self.root, self.DONE)
+        for filename in sorted(os.listdir(done_dir)):
+            with open(os.path.join(done_dir, filename), 'r') as done_file:
+                yield filename[:-len('.json')], json.load(done_file)['result']
+
+    def _write(self, path, payload):
+        # write under temporary name first, so partially written specs are never claimed
+        tmp_path = os.path.join(self.root, '.{}.tmp'.format(uuid.uuid4().hex))
+        with open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(payload)
+        os.rename(tmp_path, path)
+
+
+def _run_spec(queue, spec_id, spec, heartbeat_interval):
+    """Runs command of spec, extending its lease meanwhile; returns exit code"""
+    env = os.environ.copy()
+    env.update({k: str(v) for k, v in spec.get('env', {}).items()})
+    process = subprocess.Popen(spec['command'], env=env, cwd=spec.get('cwd'))
+    while True:
+        try:
+            return process.wait(timeout=heartbeat_interval)
+        except subprocess.TimeoutExpired:
+            try:
+                queue.heartbeat(spec_id)
+            except OSError as e:
+                LOGGER.warning('Could not extend lease of {}: {}'.format(spec_id, e))
+
+
+def run_worker(queue, worker_id=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, poll_interval=DEFAULT_POLL_INTERVAL,
+               heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL, lease=DEFAULT_LEASE):
+    """Runs experiments from queue till it is empty for idle_timeout seconds; returns number of run experiments"""
+    worker_id = worker_id or socket.gethostname()
+    processed = 0
+    idle_since = time.time()
+    while True:
+        claimed = queue.claim()
+        if claimed is None:
+            # experiments of dead workers are run again
+            requeued = queue.requeue_stale(lease)
+            if requeued:
+                LOGGER.warning('{}: re-queued {} experiments of dead workers: {}'.format(
+                    worker_id, len(requeued), ', '.join(requeued)))
+                continue
+            if time.time() - idle_since >= idle_timeout:
+                LOGGER.info('{}: queue is empty; exiting after {} experiments'.format(worker_id, processed))
+                return processed
+            time.sleep(poll_interval)
+            continue
+
+        spec_id, spec = claimed
+        LOGGER.info('{}: running {}'.format(worker_id, spec_id))
+        started = time.time()
+        try:
+            exit_code = _run_spec(queue, spec_id, spec, heartbeat_interval)
+        except OSError as e:
+            LOGGER.error('{}: could not run {}: {}'.format(worker_id, spec_id, e))
+            exit_code = 127
+        queue.complete(spec_id, spec, {'worker': worker_id, 'exit_code': exit_code,
+                                       'started': started, 'finished': time.time()})
+        LOGGER.info('{}: {} finished with exit code {}'.format(worker_id, spec_id, exit_code))
+        processed += 1
+        idle_since = time.time()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run experiments taken from queue')
+    parser.add_argument('--queue', required=True, help='Path to queue directory')
+    parser.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help='Exit after given number of seconds with empty queue')
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL)
+    parser.add_argument('--heartbeat-interval', type=float, default=DEFAULT_HEARTBEAT_INTERVAL)
+    parser.add_argument('--lease', type=float, default=DEFAULT_LEASE,
+                        help='Re-queue experiments of workers silent for given number of seconds')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='[mrunner-worker] %(message)s')
+    run_worker(FileQueue(args.queue), idle_timeout=args.idle_timeout, poll_interval=args.poll_interval,
+               heartbeat_interval=args.heartbeat_interval, lease=args.lease)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+from unittest import mock
+
+from click.testing import CliRunner
+from path import tempdir
+
+from mrunner.backends.k8s import generate_label_selector, QueuedSpec
+from mrunner.cli import mrunner_cli
+from mrunner.cli.mrunner_cli import cancel, gc, get_sweeps_cache
+
+CONTEXT = {'context_name': 'gke', 'backend_type': 'kubernetes', 'neptune': True, 'storage_dir': '/storage'}
+
+
+class FakeBackend(object):
+
+    def __init__(self):
+        self.deleted = []
+        self.deleted_queued = []
+
+    def delete_jobs(self, namespace, label_selector, only_succeeded=False, dry_run=False):
+        self.deleted.append((namespace, label_selector, only_succeeded, dry_run))
+        return ['job-1', 'job-2']
+
+    def delete_queued(self, namespace, sweep_id=None, experiment_name=None, dry_run=False):
+        self.deleted_queued.append((namespace, sweep_id, experiment_name, dry_run))
+        return [QueuedSpec('pool', '0001-exp', 'pending', 'exp', sweep_id, None)] if sweep_id else []
+
+
+class CancelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._cache_dir = tempdir()
+        os.environ['XDG_CACHE_HOME'] = self._cache_dir
+        get_sweeps_cache().set('gke', {'project': 'sandbox', 'sweep_id': 'last-sweep'})
+        self.backend = FakeBackend()
+        self._patch = mock.patch.object(mrunner_cli, 'get_backend', return_value=self.backend)
+        self._patch.start()
+
+    def tearDown(self):
+        self._patch.stop()
+        del os.environ['XDG_CACHE_HOME']
+        self._cache_dir.rmtree()
+
+    def _invoke(self, command, args):
+        result = CliRunner().invoke(command, args, obj={'context': CONTEXT})
+        self.assertEqual(0, result.exit_code, result.output)
+        return result.output
+
+    def test_cancel_selection(self):
+        self._invoke(cancel, [])
+        self._invoke(cancel, ['--all'])
+        self._invoke(cancel, ['--project', 'other', '--experiment', 'exp'])
+        self.assertEqual([('sandbox', generate_label_selector('sandbox', sweep_id='last-sweep'), False, False),
+                          ('sandbox', generate_label_selector('sandbox'), False, False),
+                          ('other', generate_label_selector('other', experiment_name='exp'), False, False)],
+                         self.backend.deleted)
+        # experiments of sweep queued in workers pools are removed too
+        self.assertEqual([('sandbox', 'last-sweep', None, False), ('sandbox', None, None, False),
+                          ('other', None, 'exp', False)], self.backend.deleted_queued)
+
+    def test_dry_run(self):
+        output = self._invoke(cancel, ['--dry-run'])
+        self.assertIn('queue/pool/0001-exp\nWould cancel 1 queued experiments\n', output)
+        self.assertIn('job/job-1\njob/job-2\nWould cancel 2 jobs', output)
+        self._invoke(gc, ['--dry-run'])
+        self.assertEqual(('sandbox', generate_label_selector('sandbox'), True, True), self.backend.deleted[-1])
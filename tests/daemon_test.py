@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import io
+import stat
+import sys
+import threading
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+from path import tempdir
+
+import mrunner.daemon
+from mrunner.cli.client import forward, get_subcommand, get_environment
+from mrunner.daemon import DaemonServer
+
+
+def _fake_run_command(argv, cwd, stdout, stderr):
+    stdout.write('{} in {}\n'.format(' '.join(argv), cwd))
+    stderr.write('INFO:mrunner:done\n')
+    return 3
+
+
+class DaemonTestCase(unittest.TestCase):
+
+    def test_subcommand(self):
+        self.assertEqual('run', get_subcommand(['--context', 'gke', '--debug', 'run', 'exp.py', '--', '--lr', '1']))
+        self.assertEqual('context', get_subcommand(['--config', 'run.yaml', 'context', 'edit']))
+        self.assertIsNone(get_subcommand(['--help']))
+
+    def test_forward(self):
+        with tempdir() as tmp:
+            socket_path = tmp / 'daemon.sock'
+            self.assertIsNone(forward(['status'], socket_path=socket_path))
+
+            server = DaemonServer(socket_path)
+            self.assertEqual(0o600, stat.S_IMODE(socket_path.stat().st_mode))
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            run_command, mrunner.daemon.run_command = mrunner.daemon.run_command, _fake_run_command
+            try:
+                stdout, stderr = io.StringIO(), io.StringIO()
+                sys_stderr, sys.stderr = sys.stderr, stderr
+                try:
+                    with redirect_stdout(stdout):
+                        exit_code = forward(['status', '--sweep', 'abc'], socket_path=socket_path)
+                finally:
+                    sys.stderr = sys_stderr
+            finally:
+                mrunner.daemon.run_command = run_command
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+            self.assertEqual(3, exit_code)
+            self.assertTrue(stdout.getvalue().startswith('status --sweep abc in '))
+            self.assertEqual('INFO:mrunner:done\n', stderr.getvalue())
+
+    def test_refuse_other_environment(self):
+        self.assertEqual({'KUBECONFIG': '/kube', 'NEPTUNE_API_TOKEN': 'token'},
+                         get_environment({'KUBECONFIG': '/kube', 'NEPTUNE_API_TOKEN': 'token', 'HOME': '/home'}))
+        with tempdir() as tmp:
+            socket_path = tmp / 'daemon.sock'
+            server = DaemonServer(socket_path)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            stderr = io.StringIO()
+            sys_stderr, sys.stderr = sys.stderr, stderr
+            try:
+                # daemon was started with other kubeconfig; client runs command by itself
+                with mock.patch('mrunner.daemon.get_environment', return_value={'KUBECONFIG': '/daemon/kube'}), \
+                        mock.patch('mrunner.daemon.run_command') as run_command:
+                    self.assertIsNone(forward(['run', 'exp.py'], socket_path=socket_path))
+                self.assertFalse(run_command.called)
+            finally:
+                sys.stderr = sys_stderr
+                server.shutdown()
+                server.server_close()
+                thread.join()
+            self.assertIn('environment differs: KUBECONFIG', stderr.getvalue())
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import tarfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import attr
+from docker.errors import ImageNotFound, NotFound
+from path import tempdir
+
+from mrunner.backends.k8s import ExperimentRunOnKubernetes
+from mrunner.utils.docker_engine import create_build_context, DockerEngine, pin_image
+
+
+class TmpCmd(object):
+    command = 'python experiment1.py -- --foo bar'
+    env = {}
+
+
+class FakeImages(object):
+    """Images api of docker client backed by dict of tags stored in registry"""
+
+    def __init__(self, registry, local=None):
+        self.registry = registry
+        self.local = dict(local or {})  # local image name -> its repo digests
+        self.registry_calls = 0
+
+    def get(self, name):
+        if name not in self.local:
+            raise ImageNotFound(name)
+        return type('Image', (object,), {'attrs': {'RepoDigests': self.local[name]}})
+
+    def get_registry_data(self, name):
+        self.registry_calls += 1
+        if name not in self.registry:
+            raise NotFound(name)
+        return type('RegistryData', (object,), {'id': self.registry[name]})
+
+
+class FakeApi(object):
+    """Low-level api of docker client; build and push return streams of decoded events"""
+
+    def __init__(self, registry, push_errors=()):
+        self.registry = registry
+        self.push_errors = list(push_errors)
+        self.built = []
+        self.pushing = threading.Event()
+        self.release_push = threading.Event()
+        self.release_push.set()
+
+    def build(self, fileobj, tag, **kwargs):
+        with tarfile.open(fileobj=fileobj) as tar_file:
+            self.dockerfile = tar_file.extractfile('Dockerfile').read().decode('utf-8')
+        self.built.append(tag)
+        return iter([{'stream': 'Step 1/5 : FROM python:3\n'}, {'stream': 'Successfully built 123\n'}])
+
+    def push(self, repository, tag, **kwargs):
+        yield {'status': 'The push refers to repository [{}]'.format(repository)}
+        yield {'status': 'Pushing', 'id': 'layer1', 'progressDetail': {'current': 512, 'total': 1024}}
+        self.pushing.set()
+        self.release_push.wait()
+        if self.push_errors:
+            error = self.push_errors.pop(0)
+            yield {'error': error, 'errorDetail': {'message': error}}
+            return
+        yield {'status': 'Pushed', 'id': 'layer1', 'progressDetail': {}}
+        yield {'status': 'Layer already exists', 'id': 'layer2', 'progressDetail': {}}
+        self.registry['{}:{}'.format(repository, tag)] = 'sha256:{}'.format(tag)
+
+
+class FakeClient(object):
+
+    def __init__(self, registry, push_errors=()):
+        self.images = FakeImages(registry)
+        self.api = FakeApi(registry, push_errors=push_errors)
+        self.logins = 0
+
+    def login(self, **kwargs):
+        self.logins += 1
+
+
+def _create_experiment(cwd, **kwargs):
+    return ExperimentRunOnKubernetes(backend_type='kubernetes', name='experiment', storage_dir='/storage',
+                                     cmd=TmpCmd(), registry_url='https://registry:5000', base_image='python:3',
+                                     project='project-name', requirements=['numpy'], cwd=cwd, **kwargs)
+
+
+class DockerEngineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._cache_dir = tempdir()
+        os.environ['XDG_CACHE_HOME'] = self._cache_dir
+        DockerEngine._published_images.clear()
+        DockerEngine._logins.clear()
+
+    def tearDown(self):
+        del os.environ['XDG_CACHE_HOME']
+        self._cache_dir.rmtree()
+
+    def test_build_context(self):
+        with tempdir() as tmp:
+            (tmp / 'experiment1.py').write_text('print(1)')
+            (tmp / 'data').makedirs()
+            (tmp / 'data' / 'dataset.bin').write_bytes(b'0' * 1024)
+            with tempdir() as external:
+                (external / 'utils.py').write_text('pass')
+                experiment = _create_experiment(tmp, exclude=['data'],
+                                                paths_to_copy=['{}:lib/utils.py'.format(external / 'utils.py')])
+
+                context_file = io.BytesIO()
+                context_hash = create_build_context(context_file, experiment)
+                with tarfile.open(fileobj=context_file) as tar_file:
+                    self.assertEqual(['Dockerfile', 'code/experiment1.py', 'code/lib/utils.py', 'requirements.txt'],
+                                     sorted(tar_file.getnames()))
+                    dockerfile = tar_file.extractfile('Dockerfile').read().decode('utf-8')
+                self.assertIn('COPY code/lib/utils.py ${EXP_DIR}/lib/utils.py', dockerfile)
+                self.assertEqual(context_hash, create_build_context(io.BytesIO(), experiment))
+
+                buildkit_context_file = io.BytesIO()
+                create_build_context(buildkit_context_file, attr.evolve(experiment, buildkit=True))
+                with tarfile.open(fileobj=buildkit_context_file) as tar_file:
+                    dockerfile = tar_file.extractfile('Dockerfile').read().decode('utf-8')
+                self.assertTrue(dockerfile.startswith('# syntax=docker/dockerfile:1\n'))
+                self.assertIn('--mount=type=cache,target=/root/.cache/pip', dockerfile)
+
+                deps_context_file = io.BytesIO()
+                create_build_context(deps_context_file, experiment, deps_only=True)
+                with tarfile.open(fileobj=deps_context_file) as tar_file:
+                    self.assertEqual(['Dockerfile', 'requirements.txt'], sorted(tar_file.getnames()))
+
+    def test_skip_published_image(self):
+        with tempdir() as tmp:
+            (tmp / 'experiment1.py').write_text('print(1)')
+            registry = {'python:3': 'sha256:base'}
+
+            engine = DockerEngine(client=FakeClient(registry))
+            image = engine.build_and_publish_image(_create_experiment(tmp))
+            self.assertEqual([image], engine._client.api.built)
+            self.assertIn(image, registry)
+
+            self.assertIn('FROM python@sha256:base', engine._client.api.dockerfile)
+
+            # other process finds image in registry
+            DockerEngine._published_images.clear()
+            engine = DockerEngine(client=FakeClient(registry))
+            self.assertEqual(image, engine.build_and_publish_image(_create_experiment(tmp)))
+            self.assertEqual([], engine._client.api.built)
+
+            (tmp / 'experiment1.py').write_text('print(2)')
+            self.assertNotEqual(image, engine.build_and_publish_image(_create_experiment(tmp)))
+            self.assertEqual(1, len(engine._client.api.built))
+
+    def test_local_repo_digests(self):
+        with tempdir() as tmp:
+            (tmp / 'experiment1.py').write_text('print(1)')
+            registry = {'python:3': 'sha256:base'}
+            image = DockerEngine(client=FakeClient(dict(registry))).build_and_publish_image(_create_experiment(tmp))
+            repository = image.rsplit(':', 1)[0]
+
+            # image pushed into other registry is built and pushed into target one
+            DockerEngine._published_images.clear()
+            engine = DockerEngine(client=FakeClient(dict(registry)))
+            engine._client.images.local[image] = ['other:5000/project-name/experiments@sha256:1']
+            self.assertEqual(image, engine.build_and_publish_image(_create_experiment(tmp)))
+            self.assertEqual([image], engine._client.api.built)
+
+            # image with digest in target repository is not looked up in registry (where it is missing here)
+            DockerEngine._published_images.clear()
+            engine = DockerEngine(client=FakeClient(dict(registry)))
+            engine._client.images.local[image] = ['{}@sha256:1'.format(repository)]
+            self.assertEqual(image, engine.build_and_publish_image(_create_experiment(tmp)))
+            self.assertEqual([], engine._client.api.built)
+
+    def test_concurrent_push(self):
+        with tempdir() as tmp:
+            (tmp / 'experiment1.py').write_text('print(1)')
+            registry = {'python:3': 'sha256:base'}
+            engine = DockerEngine(client=FakeClient(registry))
+
+            # second image is built while first one is still pushed
+            engine._client.api.release_push.clear()
+            try:
+                first_image = engine.build_and_publish_image(_create_experiment(tmp), wait=False)
+                engine._client.api.pushing.wait(5)
+                self.assertNotIn(first_image, registry)
+                second_image = engine.build_and_publish_image(
+                    attr.evolve(_create_experiment(tmp), requirements=['six']), wait=False)
+                self.assertEqual([first_image, second_image], engine._client.api.built)
+                self.assertEqual(first_image, engine.build_and_publish_image(_create_experiment(tmp), wait=False))
+                self.assertEqual(2, len(engine._client.api.built))
+            finally:
+                engine._client.api.release_push.set()
+            engine.wait_for_push()
+            self.assertIn(first_image, registry)
+            self.assertIn(second_image, registry)
+
+            DockerEngine._published_images.clear()
+            engine = DockerEngine(client=FakeClient({'python:3': 'sha256:base'}, push_errors=['blob unknown']))
+            self.assertRaises(RuntimeError, engine.build_and_publish_image, _create_experiment(tmp))
+
+    def test_retry_failed_push(self):
+        with tempdir() as tmp:
+            (tmp / 'experiment1.py').write_text('print(1)')
+            registry = {'python:3': 'sha256:base'}
+            engine = DockerEngine(client=FakeClient(registry, push_errors=['blob unknown']))
+            self.assertRaises(RuntimeError, engine.build_and_publish_image, _create_experiment(tmp))
+
+            # failed push is forgotten; image is built and pushed again
+            image = engine.build_and_publish_image(_create_experiment(tmp))
+            self.assertEqual([image, image], engine._client.api.built)
+            self.assertIn(image, registry)
+            engine.wait_for_push()
+
+            # failure of push not waited for is not reported by waits for other images
+            engine._client.api.push_errors.append('blob unknown')
+            failed_image = engine.build_and_publish_image(attr.evolve(_create_experiment(tmp), requirements=['six']),
+                                                          wait=False)
+            self.assertIsNotNone(engine._pushes[failed_image].exception(5))
+            other_image = engine.build_and_publish_image(attr.evolve(_create_experiment(tmp), requirements=['attrs']),
+                                                         wait=False)
+            engine.wait_for_push(other_image)
+            self.assertRaises(RuntimeError, engine.wait_for_push, failed_image)
+            engine.wait_for_push()
+
+    def test_buildx_docker_host(self):
+        with tempdir() as tmp:
+            (tmp / 'experiment1.py').write_text('print(1)')
+            experiment = _create_experiment(tmp, buildkit=True)
+            with mock.patch.dict(os.environ), mock.patch('mrunner.utils.docker_engine.call', return_value=0) as call:
+                os.environ.pop('DOCKER_HOST', None)
+                DockerEngine(client=FakeClient({'python:3': 'sha256:base'})).build_and_publish_image(experiment)
+                # docker CLI uses its own default daemon socket
+                self.assertNotIn('DOCKER_HOST', call.call_args[1]['env'])
+
+                DockerEngine._published_images.clear()
+                DockerEngine(docker_url='tcp://builder:2375', client=FakeClient({'python:3': 'sha256:base'})) \
+                    .build_and_publish_image(experiment)
+                self.assertEqual(2, call.call_count)
+                self.assertEqual('tcp://builder:2375', call.call_args[1]['env']['DOCKER_HOST'])
+
+    def test_login_once(self):
+        with tempdir() as tmp:
+            (tmp / 'experiment1.py').write_text('print(1)')
+            registry = {'python:3': 'sha256:base'}
+            engine = DockerEngine(client=FakeClient(registry, push_errors=['unauthorized: token expired']))
+            engine.build_and_publish_image(_create_experiment(tmp))
+            # expired credentials are refreshed and push is retried
+            self.assertEqual(2, engine._client.logins)
+            self.assertEqual(1, len(engine._client.api.built))
+
+            (tmp / 'experiment1.py').write_text('print(2)')
+            engine.build_and_publish_image(_create_experiment(tmp))
+            self.assertEqual(2, engine._client.logins)
+
+            # context with other credentials for the same registry logs in by itself
+            (tmp / 'experiment1.py').write_text('print(3)')
+            engine.build_and_publish_image(_create_experiment(tmp, registry_username='other', registry_password='x'))
+            self.assertEqual(3, engine._client.logins)
+
+    def test_base_image_pull_policy(self):
+        self.assertEqual('python@sha256:1', pin_image('python:3', 'sha256:1'))
+        self.assertEqual('registry:5000/team/base@sha256:1', pin_image('registry:5000/team/base:latest', 'sha256:1'))
+        self.assertEqual('registry:5000/base@sha256:1', pin_image('registry:5000/base', 'sha256:1'))
+
+        with tempdir() as tmp:
+            registry = {'python:3': 'sha256:base'}
+            for policy, expected_calls in [('always', 1), ('60', 0), ('if-not-present', 0)]:
+                engine = DockerEngine(client=FakeClient(registry))
+                experiment = _create_experiment(tmp, base_image_pull=policy)
+                self.assertEqual('sha256:base', engine._get_base_image_digest(experiment))
+                self.assertEqual('sha256:base', engine._get_base_image_digest(experiment))
+                self.assertEqual(expected_calls, engine._client.images.registry_calls)
+
+            # long living engine resolves digest again once policy window passes
+            engine = DockerEngine(client=FakeClient(registry))
+            experiment = _create_experiment(tmp, base_image_pull='always')
+            engine._get_base_image_digest(experiment)
+            registry['python:3'] = 'sha256:updated'
+            self.assertEqual('sha256:base', engine._get_base_image_digest(experiment))
+            with mock.patch('mrunner.utils.docker_engine.time.time', return_value=time.time() + 61):
+                self.assertEqual('sha256:updated', engine._get_base_image_digest(experiment))
+            self.assertEqual(2, engine._client.images.registry_calls)
+
+            self.assertRaises(ValueError, DockerEngine(client=FakeClient(registry))._get_base_image_digest,
+                              _create_experiment(tmp, base_image_pull='sometimes'))
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from path import tempdir
+
+from mrunner.utils.efficiency import parse_sacct, parse_slurm_duration, parse_slurm_memory, EfficiencyStore, \
+    experiment_signature, apply_recommendation
+
+SACCT_OUTPUT = '''123|COMPLETED|00:10:00|00:19:30||4
+123.batch|COMPLETED|00:10:00|00:19:30|2097152K|4
+123.extern|COMPLETED|00:10:00|00:00:00|1024K|4
+124|CANCELLED by 42|1-00:00:00|12:00:00||8
+124.batch|CANCELLED|1-00:00:00|12:00:00|3G|8
+125|RUNNING|00:01:00|00:00:00||1
+'''
+
+
+class EfficiencyTestCase(unittest.TestCase):
+
+    def test_parse_slurm_notation(self):
+        self.assertEqual(parse_slurm_duration('05:30.500'), 330.5)
+        self.assertEqual(parse_slurm_duration('01:00:00'), 3600)
+        self.assertEqual(parse_slurm_duration('2-01:00:00'), 49 * 3600)
+        self.assertEqual(parse_slurm_memory('1024K'), 1024 ** 2)
+        self.assertEqual(parse_slurm_memory('8G'), 8 * 1024 ** 3)
+        self.assertEqual(parse_slurm_memory('512', default_unit='M'), 512 * 1024 ** 2)
+        self.assertEqual(parse_slurm_memory(''), 0)
+
+    def test_parse_sacct(self):
+        usages = parse_sacct(SACCT_OUTPUT)
+        self.assertEqual({'123', '124', '125'}, set(usages))
+        self.assertEqual(usages['123'].max_rss, 2 * 1024 ** 3)
+        self.assertEqual(usages['123'].total_cpu, 1170)
+        self.assertEqual(usages['123'].alloc_cpus, 4)
+        self.assertEqual(usages['124'].state, 'CANCELLED')
+        self.assertEqual(usages['124'].elapsed, 24 * 3600)
+
+    def test_store_recommendation(self):
+        with tempdir() as tmp:
+            signature = experiment_signature('project', 'experiment.py', ['lr', 'batch_size'])
+            self.assertEqual(signature, experiment_signature('project', './experiment.py', ['batch_size', 'lr']))
+
+            store = EfficiencyStore(tmp / EfficiencyStore.DEFAULT_FILENAME)
+            for job_id in ['123', '124', '125']:
+                store.record_submission(signature, 'project', 'experiment.py', ['lr', 'batch_size'], job_id,
+                                        'user@host', {'cpu': 8, 'mem': '32G'})
+            self.assertEqual(store.update_usage(parse_sacct(SACCT_OUTPUT)), 2)
+            store.save()
+
+            store = EfficiencyStore(tmp / EfficiencyStore.DEFAULT_FILENAME)
+            self.assertEqual(['125'], [job['job_id'] for job in store.pending_jobs()])
+            # only completed job is taken into account: ~2 cores busy and 2G of peak memory
+            recommended = store.recommend(signature, headroom=1.2)
+            self.assertEqual({'cpu': '3', 'mem': '3G'}, recommended)
+            self.assertEqual({'cpu': '3', 'mem': '3G'}, apply_recommendation({'cpu': 8, 'mem': '32G'}, recommended))
+            self.assertEqual({'cpu': '3'}, apply_recommendation({'cpu': 8}, recommended))
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+
+from path import tempdir
+
+from mrunner import experiment as experiment_module
+from mrunner.experiment import get_experiments_spec, get_experiments_spec_handle
+
+SPEC_SCRIPT = """
+from mrunner.experiment import Experiment
+
+open({runs!r}, 'a').write('x')
+
+
+def spec():
+    return [Experiment(project='sandbox', name='exp-{{}}'.format(idx), script='run.py',
+                       parameters={{'lr': idx}}) for idx in range({count})]
+"""
+
+
+class ExperimentSpecTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._cache_dir = tempdir()
+        os.environ['XDG_CACHE_HOME'] = self._cache_dir
+        experiment_module._scripts_globals.clear()
+        experiment_module._specs_experiments.clear()
+
+    def tearDown(self):
+        del os.environ['XDG_CACHE_HOME']
+        self._cache_dir.rmtree()
+
+    def test_script_executed_once(self):
+        with tempdir() as tmp:
+            script, runs = tmp / 'spec.py', tmp / 'runs'
+            script.write_text(SPEC_SCRIPT.format(runs=str(runs), count=2))
+            self.assertIsNotNone(get_experiments_spec_handle(script, 'spec'))
+            self.assertIsNone(get_experiments_spec_handle(script, 'other_spec'))
+            experiments = get_experiments_spec(script, 'spec')
+            self.assertEqual(['exp-0', 'exp-1'], [experiment['name'] for experiment in experiments])
+            experiments[0].pop('name')
+            self.assertEqual('exp-0', get_experiments_spec(script, 'spec')[0]['name'])
+            self.assertEqual('x', runs.text())
+
+            script.write_text(SPEC_SCRIPT.format(runs=str(runs), count=3))
+            self.assertEqual(3, len(get_experiments_spec(script, 'spec')))
+            self.assertEqual('xx', runs.text())
+
+    def test_spec_cache(self):
+        with tempdir() as tmp:
+            script, runs = tmp / 'spec.py', tmp / 'runs'
+            script.write_text(SPEC_SCRIPT.format(runs=str(runs), count=2))
+            experiments = get_experiments_spec(script, 'spec', cache=True)
+
+            # next mrunner invocation
+            experiment_module._scripts_globals.clear()
+            experiment_module._specs_experiments.clear()
+            self.assertEqual(experiments, get_experiments_spec(script, 'spec', cache=True))
+            self.assertEqual('x', runs.text())
+            self.assertEqual(experiments, get_experiments_spec(script, 'spec'))
@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+import collections
+import io
+import os
+import subprocess
+import tarfile
+import threading
+import unittest
+from unittest import mock
+
+import attr
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+from path import tempdir
+
+from mrunner.backends.k8s import ExperimentRunOnKubernetes, Job, IndexedJob, SweepConfigMap, KubernetesBackend, \
+    JobsTable, generate_label_selector, ImagePrePullDaemonSet, get_storage_shard, DistributedJob, DistributedJobSvc, \
+    WorkerPoolJob
+from mrunner.utils.cache import FileCache
+from mrunner.utils.docker_engine import create_code_archive
+from mrunner.utils.utils import RateLimiter
+from mrunner.worker import FileQueue
+
+
+class TmpCmd(object):
+
+    def __init__(self, command):
+        self.command = command
+
+    @property
+    def env(self):
+        return {'CMD_VAR': 2}
+
+
+def _create_experiment(name='experiment-name', params='--foo bar', storage_dir='/storage', **kwargs):
+    return ExperimentRunOnKubernetes(backend_type='kubernetes', name=name, storage_dir=storage_dir,
+                                     cmd=TmpCmd('python experiment1.py -- {}'.format(params)),
+                                     registry_url='https://gcr.io', base_image='python:3',
+                                     project='project-name', env={'EXPERIMENT_VAR': 3},
+                                     resources={'cpu': '2', 'mem': '4G'}, **kwargs)
+
+
+class FakeBatchApi(object):
+    """Batch api of kubernetes client keeping jobs in list"""
+
+    def __init__(self, jobs=(), throttled=None, errors=None):
+        self.jobs = list(jobs)
+        self.deleted = []
+        self.throttled = dict(throttled or {})  # job name -> number of 429 responses before job is created
+        self.errors = dict(errors or {})  # job name -> status of error response
+
+    def create_namespaced_job(self, namespace, body):
+        name = body.metadata.name
+        body.metadata.uid = 'uid-{}'.format(name)
+        if self.throttled.get(name):
+            self.throttled[name] -= 1
+            error = ApiException(status=429, reason='Too Many Requests')
+            error.headers = {'Retry-After': '2'} if name.endswith('retry-after') else None
+            raise error
+        if name in self.errors:
+            raise ApiException(status=self.errors[name], reason='Error')
+        self.jobs.append(body)
+        return body
+
+    def list_namespaced_job(self, namespace, label_selector=None):
+        return client.V1JobList(items=list(self.jobs))
+
+    def delete_namespaced_job(self, name, namespace, **kwargs):
+        self.deleted.append(name)
+        self.jobs = [job for job in self.jobs if job.metadata.name != name]
+
+    def delete_collection_namespaced_job(self, namespace, label_selector=None, **kwargs):
+        self.deleted.extend(job.metadata.name for job in self.jobs)
+
+
+class FakeCoreApi(object):
+    """Core api of kubernetes client failing to create config maps with given status"""
+
+    def __init__(self, create_error=None):
+        self.create_error = create_error
+        self.config_maps = []
+
+    def __getattr__(self, name):
+        return mock.Mock()  # other calls are ignored
+
+    def list_namespaced_config_map(self, namespace, field_selector=None):
+        return client.V1ConfigMapList(items=[])
+
+    def create_namespaced_config_map(self, namespace, body):
+        if self.create_error:
+            raise ApiException(status=self.create_error, reason='Error')
+        self.config_maps.append(body)
+        return body
+
+
+class FakeAppsApi(object):
+    """Apps api of kubernetes client returning daemon sets with given statuses (one per read)"""
+
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.deleted = []
+
+    def read_namespaced_daemon_set_status(self, name, namespace):
+        return client.V1DaemonSet(metadata=client.V1ObjectMeta(name=name, generation=1), status=self.statuses.pop(0))
+
+    def delete_namespaced_daemon_set(self, name, namespace, **kwargs):
+        self.deleted.append(name)
+
+
+def _create_backend(**apis):
+    """Backend with fake apis; it doesn't need kubeconfig nor cluster"""
+    backend = KubernetesBackend.__new__(KubernetesBackend)
+    backend._submit_workers = KubernetesBackend.DEFAULT_SUBMIT_WORKERS
+    backend._rate_limiter = RateLimiter(None)
+    backend._key_locks, backend._key_locks_lock = collections.defaultdict(threading.Lock), threading.Lock()
+    backend.core_api, backend.apps_api, backend.batch_api = mock.Mock(), mock.Mock(), mock.Mock()
+    for name, api in apis.items():
+        setattr(backend, name, api)
+    return backend
+
+
+def _create_job_resource(name, condition=None, completions=None):
+    conditions = [client.V1JobCondition(type=condition, status='True')] if condition else None
+    return client.V1Job(metadata=client.V1ObjectMeta(name=name),
+                        spec=client.V1JobSpec(template=client.V1PodTemplateSpec(), completions=completions),
+                        status=client.V1JobStatus(conditions=conditions, succeeded=completions))
+
+
+class KubernetesJobTestCase(unittest.TestCase):
+
+    def test_job(self):
+        job = Job('image:tag', _create_experiment())
+        self.assertRegexpMatches(job.metadata.name, 'experiment-name-.*')
+        self.assertEqual(0, job.spec.backoff_limit)
+        self.assertIsNone(job.spec.ttl_seconds_after_finished)
+        self.assertEqual(3600, Job('image:tag', _create_experiment(job_ttl='3600')).spec.ttl_seconds_after_finished)
+
+        container = job.spec.template.spec.containers[0]
+        self.assertEqual(['python', 'experiment1.py', '--'], container.command)
+        self.assertEqual(['--foo', 'bar'], container.args)
+        self.assertEqual({'cpu': '2', 'memory': '4Gi'}, container.resources.limits)
+        self.assertEqual({'EXPERIMENT_VAR': '3', 'CMD_VAR': '2'}, {e.name: e.value for e in container.env})
+        self.assertEqual(KubernetesBackend.NFS_PVC_NAME,
+                         job.spec.template.spec.volumes[0].persistent_volume_claim.claim_name)
+
+    def test_labels(self):
+        job = Job('image:tag', _create_experiment(name='experiment_name', sweep_id='sweep-1'))
+        expected_labels = {'mrunner/project': 'project-name', 'mrunner/sweep': 'sweep-1',
+                           'mrunner/experiment': 'experiment_name'}
+        self.assertEqual(expected_labels, job.metadata.labels)
+        self.assertEqual(expected_labels, job.spec.template.metadata.labels)
+        self.assertEqual('mrunner/project=project-name,mrunner/sweep=sweep-1',
+                         generate_label_selector('project_name', sweep_id='sweep-1'))
+
+        # workers pool is shared by sweeps
+        job = WorkerPoolJob('image:tag', _create_experiment(sweep_id='sweep-1'), 'pool-1', '/queue', 2)
+        self.assertEqual({'mrunner/project': 'project-name', 'mrunner/pool': 'pool-1'}, job.metadata.labels)
+
+    def test_indexed_job(self):
+        experiments = [_create_experiment(params='--foo {}'.format(idx)) for idx in range(3)]
+        job = IndexedJob('image:tag', experiments, parallelism=2)
+        self.assertEqual('Indexed', job.spec.completion_mode)
+        self.assertEqual(3, job.spec.completions)
+        self.assertEqual(2, job.spec.parallelism)
+        self.assertEqual(job.metadata.name, job.spec.template.spec.volumes[1].config_map.name)
+
+        config_map = SweepConfigMap(job.metadata.name, experiments)
+        self.assertEqual({'0', '1', '2'}, set(config_map.data))
+        self.assertIn("export EXPERIMENT_VAR=3\n", config_map.data['0'])
+        self.assertTrue(config_map.data['2'].endswith('exec python experiment1.py -- --foo 2\n'))
+
+        experiments.append(_create_experiment(storage_dir='/other'))
+        self.assertRaises(ValueError, IndexedJob, 'image:tag', experiments)
+
+    def test_scratch(self):
+        job = Job('image:tag', _create_experiment(scratch='memory', scratch_size='4G'))
+        pod_spec = job.spec.template.spec
+        container = pod_spec.containers[0]
+        self.assertEqual(Job.SCRATCH_MOUNT_PATH, {e.name: e.value for e in container.env}['STORAGE_DIR'])
+        self.assertEqual(['/storage', Job.SCRATCH_MOUNT_PATH], [m.mount_path for m in container.volume_mounts])
+        self.assertEqual('Memory', pod_spec.volumes[1].empty_dir.medium)
+        self.assertEqual('4Gi', pod_spec.volumes[1].empty_dir.size_limit)
+        self.assertEqual('Always', pod_spec.init_containers[0].restart_policy)
+
+        pod_spec = Job('image:tag', _create_experiment(scratch='/mnt/ssd')).spec.template.spec
+        self.assertEqual('/mnt/ssd', pod_spec.volumes[1].host_path.path)
+        self.assertEqual('$(POD_NAME)', pod_spec.containers[0].volume_mounts[1].sub_path_expr)
+        self.assertRaises(ValueError, Job, 'image:tag', _create_experiment(scratch='ssd'))
+
+    def test_storage_shards(self):
+        experiments = [_create_experiment(params='--foo {}'.format(idx), storage_shards=4) for idx in range(20)]
+        shards = [get_storage_shard(experiment) for experiment in experiments]
+        self.assertEqual(shards, [get_storage_shard(experiment) for experiment in experiments])
+        self.assertEqual({0, 1, 2, 3}, set(shards))
+        claims = [Job('image:tag', experiment).spec.template.spec.volumes[0].persistent_volume_claim.claim_name
+                  for experiment in experiments]
+        self.assertEqual(['nfs-{}'.format(shard) if shard else 'nfs' for shard in shards], claims)
+        self.assertEqual(0, get_storage_shard(_create_experiment()))
+
+    def test_profile(self):
+        profiles = {'gpu': {'requests': {'cpu': '4', 'mem': '16G'}, 'limits': {'gpu': '1'},
+                            'node_selector': {'cloud.google.com/gke-accelerator': 'nvidia-tesla-v100'},
+                            'tolerations': [{'key': 'nvidia.com/gpu', 'operator': 'Exists', 'effect': 'NoSchedule'}],
+                            'priority_class': 'low',
+                            'topology_spread': [{'maxSkew': 1, 'topologyKey': 'kubernetes.io/hostname',
+                                                 'whenUnsatisfiable': 'ScheduleAnyway'}]}}
+        experiment = _create_experiment(profiles=profiles, profile='gpu', profile_overrides={'limits': {'gpu': '2'}})
+        experiment = attr.evolve(experiment, resources={'cpu': '8', 'mem': '32G'})
+        pod_spec = Job('image:tag', experiment).spec.template.spec
+        self.assertEqual({'cpu': '4', 'memory': '16Gi'}, pod_spec.containers[0].resources.requests)
+        # experiment resources are merged with (and take precedence over) limits of profile
+        self.assertEqual({'nvidia.com/gpu': '2', 'cpu': '8', 'memory': '32Gi'}, pod_spec.containers[0].resources.limits)
+        experiment = attr.evolve(experiment, resources={'gpu': '4'})
+        self.assertEqual({'nvidia.com/gpu': '4'}, Job('image:tag', experiment).spec.template.spec.containers[0]
+                         .resources.limits)
+        self.assertEqual('low', pod_spec.priority_class_name)
+        self.assertEqual({'cloud.google.com/gke-accelerator': 'nvidia-tesla-v100'}, pod_spec.node_selector)
+        self.assertEqual({'matchLabels': {'mrunner/project': 'project-name'}},
+                         pod_spec.topology_spread_constraints[0]['labelSelector'])
+        serialized = client.ApiClient().sanitize_for_serialization(pod_spec)
+        self.assertEqual('nvidia.com/gpu', serialized['tolerations'][0]['key'])
+
+        self.assertRaises(ValueError, Job, 'image:tag', _create_experiment(profiles=profiles, profile='tpu'))
+        profiles['gpu']['limits'] = {'gpus': '1'}
+        with self.assertRaisesRegex(ValueError, 'Unknown resource: gpus'):
+            Job('image:tag', _create_experiment(profiles=profiles, profile='gpu'))
+
+    def test_distributed_job(self):
+        job = DistributedJob('image:tag', _create_experiment(nodes='4'))
+        name = job.metadata.name
+        self.assertEqual(('Indexed', 4, 4), (job.spec.completion_mode, job.spec.completions, job.spec.parallelism))
+        self.assertEqual(name, job.spec.template.spec.subdomain)
+        env = {e.name: e.value for e in job.spec.template.spec.containers[0].env}
+        self.assertEqual('{}-0.{}'.format(name, name), env['MASTER_ADDR'])
+        self.assertEqual('4', env['WORLD_SIZE'])
+        self.assertEqual('3', env['EXPERIMENT_VAR'])
+        rank = [e for e in job.spec.template.spec.containers[0].env if e.name == 'RANK'][0]
+        self.assertIn(JobsTable.INDEX_ANNOTATION, rank.value_from.field_ref.field_path)
+
+        svc = DistributedJobSvc(job)
+        self.assertEqual('None', svc.spec.cluster_ip)
+        self.assertEqual({'job-name': name}, svc.spec.selector)
+
+    def test_code_overlay(self):
+        with tempdir() as tmp:
+            (tmp / 'experiment1.py').write_text('print(1)')
+            (tmp / 'lib').makedirs()
+            (tmp / 'lib' / 'utils.py').write_text('pass')
+            code_hash, payload = create_code_archive(_create_experiment(cwd=tmp))
+            (tmp / 'lib' / 'utils.py').utime((0, 0))
+            self.assertEqual(code_hash, create_code_archive(_create_experiment(cwd=tmp))[0])
+            with tarfile.open(fileobj=io.BytesIO(payload)) as tar_file:
+                self.assertEqual(['experiment1.py', 'lib', 'lib/utils.py'], sorted(tar_file.getnames()))
+            (tmp / 'experiment1.py').write_text('print(2)')
+            self.assertNotEqual(code_hash, create_code_archive(_create_experiment(cwd=tmp))[0])
+
+        job = Job('image:deps', _create_experiment(code_archive='.mrunner/code/abc.tar', storage_shards=2))
+        pod_spec = job.spec.template.spec
+        self.assertEqual(['python', 'experiment1.py', '--'], pod_spec.containers[0].command)
+        self.assertEqual(['--foo', 'bar'], pod_spec.containers[0].args)
+        self.assertEqual(['tar', 'xf', '/mnt/mrunner/.mrunner/code/abc.tar', '-C', '/experiment'],
+                         pod_spec.init_containers[0].command)
+        volumes = {volume.name: volume for volume in pod_spec.volumes}
+        self.assertEqual('nfs', volumes[Job.CODE_STORAGE_VOLUME_NAME].persistent_volume_claim.claim_name)
+        self.assertIsNotNone(volumes[Job.CODE_VOLUME_NAME].empty_dir)
+
+    def test_prepull_daemon_set(self):
+        daemon_set = ImagePrePullDaemonSet('prepull-1', 'image:tag', node_selector={'pool': 'gpu'})
+        pod_spec = daemon_set.spec.template.spec
+        self.assertEqual('image:tag', pod_spec.init_containers[0].image)
+        self.assertEqual(ImagePrePullDaemonSet.PAUSE_IMAGE, pod_spec.containers[0].image)
+        self.assertEqual({'pool': 'gpu'}, pod_spec.node_selector)
+        self.assertEqual(daemon_set.spec.selector.match_labels, daemon_set.spec.template.metadata.labels)
+
+
+def _create_pod(job_name, phase, index=None, exit_code=None):
+    annotations = {JobsTable.INDEX_ANNOTATION: index} if index is not None else None
+    terminated = client.V1ContainerStateTerminated(exit_code=exit_code) if exit_code is not None else None
+    statuses = [client.V1ContainerStatus(name='ctr', image='image', image_id='', ready=False, restart_count=0,
+                                         state=client.V1ContainerState(terminated=terminated))]
+    return client.V1Pod(metadata=client.V1ObjectMeta(name='{}-pod'.format(job_name), labels={'job-name': job_name},
+                                                     annotations=annotations),
+                        status=client.V1PodStatus(phase=phase, container_statuses=statuses))
+
+
+class JobsTableTestCase(unittest.TestCase):
+
+    def test_table(self):
+        table = JobsTable()
+        table.expect([client.V1Job(spec=client.V1JobSpec(template=client.V1PodTemplateSpec(), completions=2)),
+                      client.V1Job(spec=client.V1JobSpec(template=client.V1PodTemplateSpec()))])
+        self.assertTrue(table.update(_create_pod('sweep', 'Running', index='0')))
+        self.assertFalse(table.update(_create_pod('sweep', 'Running', index='0')))
+        self.assertTrue(table.update(_create_pod('sweep', 'Failed', index='1', exit_code=1)))
+        self.assertTrue(table.update(_create_pod('single', 'Succeeded', exit_code=0)))
+        self.assertFalse(table.finished)
+
+        table.update(_create_pod('sweep', 'Succeeded', index='0', exit_code=0))
+        self.assertTrue(table.finished)
+        self.assertEqual(1, table.count('Failed'))
+        self.assertEqual([('single', None, '', 'Succeeded', 0), ('sweep', '0', '', 'Succeeded', 0),
+                          ('sweep', '1', '', 'Failed', 1)], list(table.rows))
+
+
+class KubernetesBackendTestCase(unittest.TestCase):
+
+    def test_delete_jobs(self):
+        # indexed job with many succeeded pods is completed as well
+        jobs = [_create_job_resource('single', 'Complete', completions=1),
+                _create_job_resource('sweep', 'Complete', completions=8),
+                _create_job_resource('failed', 'Failed'), _create_job_resource('running')]
+        batch_api = FakeBatchApi(jobs)
+        backend = _create_backend(batch_api=batch_api)
+
+        self.assertEqual(['single', 'sweep'], backend.delete_jobs('ns', 'sweep=1', only_succeeded=True, dry_run=True))
+        self.assertEqual([], batch_api.deleted)
+        self.assertEqual(['single', 'sweep'], backend.delete_jobs('ns', 'sweep=1', only_succeeded=True))
+        self.assertEqual(['single', 'sweep'], batch_api.deleted)
+
+        batch_api.deleted = []
+        self.assertEqual(['failed', 'running'], backend.delete_jobs('ns', 'sweep=1'))
+        self.assertEqual(['failed', 'running'], batch_api.deleted)
+
+    def test_create_jobs(self):
+        jobs = [('ns', _create_job_resource('job-{}'.format(idx))) for idx in range(20)]
+        batch_api = FakeBatchApi(throttled={'job-3': 2, 'job-5-retry-after': 1})
+        jobs.append(('ns', _create_job_resource('job-5-retry-after')))
+        backend = _create_backend(batch_api=batch_api)
+        with mock.patch('mrunner.backends.k8s.time') as fake_time:
+            job_ids = backend.create_jobs(jobs)
+        # ids are returned in order of jobs, although they are created concurrently
+        self.assertEqual(['ns/{}'.format(job.metadata.name) for _, job in jobs], job_ids)
+        self.assertEqual(21, len(batch_api.jobs))
+        delays = sorted(call[0][0] for call in fake_time.sleep.call_args_list)
+        self.assertEqual(3, len(delays))
+        self.assertIn(2., delays)  # Retry-After header is respected
+
+    def test_create_jobs_errors(self):
+        jobs = [('ns', _create_job_resource(name)) for name in ['ok', 'invalid', 'throttled']]
+        batch_api = FakeBatchApi(throttled={'throttled': KubernetesBackend.MAX_THROTTLED_RETRIES + 1},
+                                 errors={'invalid': 422})
+        with mock.patch('mrunner.backends.k8s.time'):
+            with self.assertRaises(RuntimeError) as context:
+                _create_backend(batch_api=batch_api).create_jobs(jobs)
+        self.assertIn('Failed to create 2/3 jobs', str(context.exception))
+        self.assertIn('job/invalid', str(context.exception))
+        self.assertIn('job/throttled', str(context.exception))
+
+    def test_prepull_without_nodes(self):
+        # no node matches selector; prepull is given up as soon as controller reports it
+        apps_api = FakeAppsApi([client.V1DaemonSetStatus(current_number_scheduled=0, desired_number_scheduled=0,
+                                                         number_misscheduled=0, number_ready=0,
+                                                         observed_generation=1)])
+        backend = _create_backend(apps_api=apps_api, _docker_engine=mock.Mock(), _prepulled_images=set(),
+                                  _ensure_resource=mock.Mock())
+        experiment = _create_experiment(prepull_image=True, prepull_timeout=600,
+                                        prepull_node_selector={'pool': 'tpu'})
+        backend.ensure_image_pulled(experiment, 'image:tag')
+        self.assertEqual(1, len(apps_api.deleted))
+
+    def _create_indexed_backend(self, **apis):
+        backend = _create_backend(**apis)
+        backend.ensure_project = mock.Mock()
+        backend.ensure_image_pulled = mock.Mock()
+        backend.prepare_image = lambda experiment, wait=True: ('image:tag', experiment)
+        return backend
+
+    def test_run_indexed(self):
+        experiments = [_create_experiment(name='exp-{}'.format(idx), sweep_id='sweep') for idx in range(3)]
+        batch_api, core_api = FakeBatchApi(), FakeCoreApi()
+        job_id = self._create_indexed_backend(batch_api=batch_api, core_api=core_api).run_indexed(experiments)
+        job = batch_api.jobs[0]
+        self.assertEqual('{}/{}'.format(experiments[0].namespace, job.metadata.name), job_id)
+        self.assertEqual(job.metadata.uid, core_api.config_maps[0].metadata.owner_references[0].uid)
+
+    def _create_setup_backend(self, host='https://cluster', setup_cache=None, list_namespace=None):
+        # storage of project (with storage class) is made of pvc and deployment
+        core_api = mock.Mock(**{'list_namespaced_persistent_volume_claim.return_value':
+                                client.V1PersistentVolumeClaimList(items=[])})
+        core_api.list_namespace.side_effect = list_namespace or (lambda **kwargs: client.V1NamespaceList(items=[]))
+        apps_api = mock.Mock(**{'list_namespaced_deployment.return_value': client.V1DeploymentList(items=[])})
+        backend = _create_backend(core_api=core_api, apps_api=apps_api, _configured_projects=set(),
+                                  _setup_cache=setup_cache, api_client=mock.Mock())
+        backend.api_client.configuration.host = host
+        return backend
+
+    def test_ensure_project(self):
+        experiment = _create_experiment(storage_class='standard')
+        other_experiment = attr.evolve(experiment, project='other-project')
+
+        # project is set up once, even by concurrent submissions
+        backend = self._create_setup_backend()
+        threads = [threading.Thread(target=backend.ensure_project, args=(experiment_, ))
+                   for experiment_ in [experiment] * 8 + [other_experiment] * 8]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(2, backend.core_api.list_namespace.call_count)
+
+        # setup of one project doesn't wait for setup of other one
+        other_configured, waited = threading.Event(), []
+
+        def _list_namespace(field_selector):
+            if other_experiment.namespace in field_selector:
+                other_configured.set()
+            else:
+                waited.append(other_configured.wait(5))
+            return client.V1NamespaceList(items=[])
+
+        backend = self._create_setup_backend(list_namespace=_list_namespace)
+        threads = [threading.Thread(target=backend.ensure_project, args=(experiment_, ))
+                   for experiment_ in [experiment, other_experiment]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([True], waited)
+
+        with tempdir() as tmp:
+            # recent setup remembered on disk is not repeated by other process
+            setup_cache = FileCache(tmp / 'setup.json', ttl=60)
+            backend = self._create_setup_backend(setup_cache=setup_cache)
+            backend.ensure_project(experiment)
+            self.assertEqual(1, backend.core_api.list_namespace.call_count)
+            backend = self._create_setup_backend(setup_cache=setup_cache)
+            backend.ensure_project(experiment)
+            self.assertEqual(0, backend.core_api.list_namespace.call_count)
+            backend.ensure_project(other_experiment)
+            self.assertEqual(1, backend.core_api.list_namespace.call_count)
+
+            # same namespace in other cluster is set up
+            backend = self._create_setup_backend(host='https://other-cluster', setup_cache=setup_cache)
+            backend.ensure_project(experiment)
+            self.assertEqual(1, backend.core_api.list_namespace.call_count)
+
+    def test_run_sweep_prepares_image_once(self):
+        experiments = [_create_experiment(name='exp-{}'.format(idx), code_delivery='overlay', requirements=['numpy'])
+                       for idx in range(3)] + [_create_experiment(name='exp-3', code_delivery='overlay')]
+        batch_api = FakeBatchApi()
+        backend = _create_backend(batch_api=batch_api, _docker_engine=mock.Mock(), _uploaded_code=set())
+        backend.ensure_project, backend.ensure_image_pulled = mock.Mock(), mock.Mock()
+        backend.exec_in_storage = mock.Mock(return_value='exists')
+        backend.docker_engine.build_and_publish_deps_image.return_value = 'image:deps'
+        with mock.patch('mrunner.backends.k8s.create_code_archive', return_value=('abc', b'')) as code_archive:
+            self.assertEqual(4, len(backend.run_sweep([{field.name: getattr(experiment, field.name)
+                                                         for field in attr.fields(type(experiment)) if field.init}
+                                                        for experiment in experiments])))
+        # experiments with same code and requirements share code archive and image
+        self.assertEqual(2, code_archive.call_count)
+        self.assertEqual(2, backend.docker_engine.build_and_publish_deps_image.call_count)
+        self.assertEqual(['tar', 'xf', '/mnt/mrunner/.mrunner/code/abc.tar', '-C', '/experiment'],
+                         batch_api.jobs[2].spec.template.spec.init_containers[0].command)
+
+    def test_queued(self):
+        with tempdir() as tmp:
+            queues_dir = tmp / KubernetesBackend.QUEUES_DIR
+            queue = FileQueue(queues_dir / 'pool-1')
+            for spec_id, sweep_id in [('0001-done', 'sweep'), ('0002-running', 'sweep'), ('0003-pending', 'sweep'),
+                                      ('0004-other', 'other-sweep')]:
+                queue.put({'name': spec_id[5:], 'sweep_id': sweep_id, 'command': ['true']}, spec_id=spec_id)
+            queue.complete(*queue.claim(), result={'exit_code': 1})
+            queue.claim()
+
+            # commands are run on local copy of project storage
+            backend = _create_backend(batch_api=FakeBatchApi([_create_job_resource('workers-1')]))
+            backend.STORAGE_EXPORT_PATH = tmp
+            backend.exec_in_storage = lambda namespace, command: subprocess.check_output(command).decode('utf-8')
+            self.assertEqual([('0001-done', 'Failed', 1), ('0002-running', 'Running', None),
+                              ('0003-pending', 'Queued', None)],
+                             [(spec.spec_id, spec.phase, spec.exit_code)
+                              for spec in sorted(backend.list_queued('ns', sweep_id='sweep'))])
+            self.assertEqual(['0004-other'],
+                             [spec.spec_id for spec in backend.list_queued('ns', experiment_name='other')])
+
+            self.assertEqual(['0003-pending'],
+                             [spec.spec_id for spec in backend.delete_queued('ns', sweep_id='sweep')])
+            self.assertEqual(['0004-other.json'], os.listdir(queues_dir / 'pool-1' / FileQueue.PENDING))
+            self.assertEqual([], backend.delete_queued('ns', sweep_id='sweep'))
+
+            # projects without workers pools have no queues
+            backend.batch_api = FakeBatchApi()
+            self.assertEqual([], backend.list_queued('ns'))
+
+    def test_run_indexed_failures(self):
+        experiments = [_create_experiment(name='exp-{}'.format(idx), sweep_id='sweep') for idx in range(3)]
+        # too large sweep is rejected before job is created
+        batch_api = FakeBatchApi()
+        backend = self._create_indexed_backend(batch_api=batch_api, core_api=FakeCoreApi())
+        with mock.patch.object(SweepConfigMap, 'MAX_SIZE', 10):
+            self.assertRaises(ValueError, backend.run_indexed, experiments)
+        self.assertEqual([], batch_api.jobs)
+
+        # job is not left waiting for config map which could not be created
+        backend = self._create_indexed_backend(batch_api=batch_api, core_api=FakeCoreApi(create_error=500))
+        self.assertRaises(ApiException, backend.run_indexed, experiments)
+        self.assertEqual([], batch_api.jobs)
+        self.assertEqual(1, len(batch_api.deleted))
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import random
+import threading
+import time
+import unittest
+
+from mrunner.utils.pipeline import Pipeline
+
+
+def _submit(item):
+    time.sleep(random.random() * 0.01)
+    if item % 10 == 3:
+        raise RuntimeError('failed {}'.format(item))
+    return 'job-{}'.format(item)
+
+
+class PipelineTestCase(unittest.TestCase):
+
+    def test_ordered_results(self):
+        reported, submitting = [], set()
+        lock = threading.Lock()
+        concurrency = []
+
+        def _submit_tracked(item):
+            with lock:
+                submitting.add(item)
+                concurrency.append(len(submitting))
+            try:
+                return _submit(item)
+            finally:
+                with lock:
+                    submitting.discard(item)
+
+        pipeline = Pipeline(lambda item: item if item % 5 else None, _submit_tracked, jobs=4, fail_fast=False)
+        results = pipeline.run(iter(range(30)), on_result=lambda result: reported.append(result.idx))
+        self.assertEqual(list(range(30)), reported)
+        self.assertEqual(list(range(30)), [result.idx for result in results])
+        self.assertEqual([3, 13, 23], [result.idx for result in results if result.failed])
+        self.assertEqual('job-1', results[1].result)
+        self.assertIsNone(results[5].result)  # not submitted
+        self.assertLessEqual(max(concurrency), 4)
+
+    def test_fail_fast(self):
+        generated = []
+
+        def _items():
+            for item in range(1000):
+                generated.append(item)
+                yield item
+
+        results = Pipeline(lambda item: item, _submit, jobs=2, fail_fast=True).run(_items())
+        self.assertEqual(1, len([result for result in results if result.failed]))
+        self.assertLess(len(generated), 1000)
+
+    def test_generation_error(self):
+        def _items():
+            yield 1
+            raise ValueError('broken spec')
+
+        results = Pipeline(lambda item: item, lambda item: item, fail_fast=False).run(_items())
+        self.assertEqual([1, None], [result.result for result in results])
+        self.assertIsInstance(results[1].error, ValueError)
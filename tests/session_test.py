@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import unittest
+
+from path import Path, tempdir
+
+from mrunner.experiment import Experiment
+from mrunner.session import Session, get_efficiency_store, NEPTUNE_CODE_DIR
+
+CONTEXT = {'context_name': 'test', 'backend_type': 'slurm', 'neptune': True, 'storage_dir': '/storage'}
+
+
+class FakeBackend(object):
+
+    def __init__(self):
+        self.submitted = []
+        self.lock = threading.Lock()
+
+    def run(self, experiment):
+        if experiment['name'] == 'broken':
+            raise RuntimeError('submission failed')
+        # neptune yaml shall be shipped with experiment code
+        neptune_dir, remote_dir = experiment['paths_to_copy'][-1].split(':')
+        assert remote_dir == NEPTUNE_CODE_DIR
+        argv = experiment['cmd'].command.split(' ')
+        config_path = Path(argv[argv.index('--config') + 1])
+        assert config_path.parent == NEPTUNE_CODE_DIR and (Path(neptune_dir) / config_path.name).exists()
+        with self.lock:
+            self.submitted.append(experiment)
+        return 'job-{}'.format(experiment['name'])
+
+    def run_sweep(self, experiments, **kwargs):
+        self.sweep_kwargs = kwargs
+        return ['ns/{}'.format(experiment['name']) for experiment in experiments]
+
+
+def _create_experiment(name, backend_type='slurm'):
+    return Experiment(project='sandbox', name=name, script='run.py', parameters={'lr': 0.1},
+                      backend_type=backend_type)
+
+
+class SessionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # efficiency store is kept next to user configuration
+        self._config_dir = tempdir()
+        os.environ['XDG_CONFIG_HOME'] = self._config_dir
+
+    def tearDown(self):
+        del os.environ['XDG_CONFIG_HOME']
+        self._config_dir.rmtree()
+
+    def test_validation(self):
+        self.assertRaises(ValueError, Session, dict(CONTEXT, neptune=False))
+        self.assertRaises(ValueError, Session, dict(CONTEXT, backend_type='kubernetes'))
+
+    def test_submit_many(self):
+        with tempdir() as tmp, tmp:
+            backend = FakeBackend()
+            with Session(CONTEXT, jobs=4) as session:
+                session._backends.update({'slurm': backend, 'kubernetes': backend})
+                futures = session.submit_many([_create_experiment('exp-{}'.format(idx)) for idx in range(5)] +
+                                              [dict(what='run.py', tags=[], pythonpath='', paths_to_dump='',
+                                                    name='legacy', project_name='sandbox', parameters={}),
+                                               _create_experiment('on-k8s', backend_type='kubernetes'),
+                                               _create_experiment('broken')])
+                self.assertEqual(['job-exp-{}'.format(idx) for idx in range(5)] + ['job-legacy'],
+                                 [future.result(10) for future in futures[:6]])
+                self.assertEqual('ns/on-k8s', futures[6].result(10))
+                self.assertEqual(4, backend.sweep_kwargs['submit_workers'])
+                self.assertRaises(RuntimeError, futures[7].result, 10)
+
+                # backends are reused by following submissions
+                self.assertEqual('job-next', session.submit_many([_create_experiment('next')])[0].result(10))
+
+            # slurm submissions are recorded in the same efficiency store as by CLI
+            self.assertEqual(7, len(get_efficiency_store().pending_jobs()))
+            self.assertEqual(7, len(backend.submitted))
+            self.assertEqual(1, len({experiment['sweep_id'] for experiment in backend.submitted[:6]}))
+            self.assertNotEqual(backend.submitted[0]['sweep_id'], backend.submitted[-1]['sweep_id'])
+            # neptune yamls are not placed in current directory (copied as experiment code)
+            self.assertEqual([], tmp.listdir())
+            self.assertFalse(Path(backend.submitted[0]['paths_to_copy'][-1].split(':')[0]).exists())
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from mrunner.backends import get_backend_class
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# libraries used only by backends or neptune; commands not submitting experiments shall not import them
+HEAVY_MODULES = ['kubernetes', 'docker', 'fabric', 'paramiko', 'neptune', 'deepsense']
+IMPORT_TIME_BUDGET = 1.0  # seconds; generous, as cold start of kubernetes client alone exceeds it
+
+_PROBE = """
+import json, sys, time
+start = time.time()
+import {module}
+print(json.dumps({{'time': time.time() - start,
+                   'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def _probe_import(module):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([REPO_DIR, env.get('PYTHONPATH', '')])
+    output = subprocess.check_output([sys.executable, '-c', _PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                                     env=env, cwd=REPO_DIR)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+class StartupTestCase(unittest.TestCase):
+
+    def test_cli_imports_no_backends(self):
+        for module in ['mrunner.cli.client', 'mrunner.cli.mrunner_cli', 'mrunner.session']:
+            probe = _probe_import(module)
+            self.assertEqual([], probe['heavy'], module)
+            self.assertLess(probe['time'], IMPORT_TIME_BUDGET, module)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            get_backend_class('local')
@@ -33,6 +33,5 @@ ENV STORAGE_DIR=${STORAGE_DIR}
 VOLUME ${STORAGE_DIR}
 VOLUME ${EXP_DIR}
 WORKDIR ${EXP_DIR}
-
-ENTRYPOINT ["neptune", "run", "foo.py", "--storage", "/storage", "--"]'''
+'''
         self.assertEqual(dockerfile_payload, expected_dockerfile_payload)
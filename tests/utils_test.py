@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 import unittest
+from unittest import mock
 
 from path import tempdir, Path
 
 from mrunner.cli.config import ConfigParser
-from mrunner.utils.utils import get_paths_to_copy, PathToDump
+from mrunner.utils.cache import FileCache
+from mrunner.utils.utils import get_paths_to_copy, PathToDump, RateLimiter
 
 
 class ConfigTestCase(unittest.TestCase):
@@ -18,6 +20,21 @@ class ConfigTestCase(unittest.TestCase):
             self.assertTrue(not config_path.exists())
 
 
+class FakeClock(object):
+    """Replaces time module; sleep only advances time"""
+
+    def __init__(self, now=1000.):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
 class UtilsTestCase(unittest.TestCase):
 
     # def test_dobject(self):
@@ -81,3 +98,34 @@ class UtilsTestCase(unittest.TestCase):
                                                                         ('file2', 'file2'),
                                                                         ('file3', 'file3')}},
                              set(get_paths_to_copy(paths_to_copy=[tmp / '../external1'])))
+
+    def test_file_cache(self):
+        with tempdir() as tmp:
+            cache = FileCache(tmp / 'cache.json')
+            self.assertIsNone(cache.get('foo'))
+            cache.set('foo', {'bar': 1})
+            self.assertEqual({'bar': 1}, FileCache(tmp / 'cache.json').get('foo'))
+            cache.delete('foo')
+            self.assertEqual('missing', cache.get('foo', 'missing'))
+
+            cache = FileCache(tmp / 'cache.json', ttl=-1)
+            cache.set('foo', 'bar')
+            self.assertIsNone(cache.get('foo'))
+
+    def test_rate_limiter(self):
+        clock = FakeClock()
+        with mock.patch('mrunner.utils.utils.time', clock):
+            limiter = RateLimiter(4)
+            for _ in range(3):
+                limiter.acquire()
+            # calls are spread evenly: first one passes, next ones wait for their slots
+            self.assertEqual([0.25, 0.25], clock.sleeps)
+
+            clock.now += 10
+            limiter.acquire()
+            self.assertEqual(2, len(clock.sleeps))
+
+            unlimited = RateLimiter(None)
+            for _ in range(3):
+                unlimited.acquire()
+            self.assertEqual(2, len(clock.sleeps))
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import threading
+import time
+import unittest
+
+from path import tempdir
+
+from mrunner.worker import FileQueue, run_worker
+
+
+class FileQueueTestCase(unittest.TestCase):
+
+    def test_claim_in_order(self):
+        with tempdir() as tmp:
+            queue = FileQueue(tmp)
+            first_id = queue.put({'command': ['true']}, spec_id='0001')
+            queue.put({'command': ['false']}, spec_id='0002')
+            self.assertEqual(2, queue.depth())
+
+            spec_id, spec = queue.claim()
+            self.assertEqual(first_id, spec_id)
+            self.assertEqual({'command': ['true']}, spec)
+            self.assertEqual(1, queue.depth())
+
+            queue.complete(spec_id, spec, {'exit_code': 0})
+            self.assertEqual([('0001', {'exit_code': 0})], list(queue.results()))
+            self.assertEqual('0002', queue.claim()[0])
+            self.assertIsNone(queue.claim())
+
+    def test_workers_run_each_experiment_once(self):
+        with tempdir() as tmp:
+            queue = FileQueue(tmp / 'queue')
+            out_dir = tmp / 'out'
+            out_dir.makedirs()
+            for idx in range(20):
+                script = 'open("{}/{}", "a").write("x"); exit({})'.format(out_dir, idx, idx % 2)
+                queue.put({'command': [sys.executable, '-c', script], 'env': {'IDX': idx}},
+                          spec_id=FileQueue.new_spec_id(str(idx)))
+
+            processed = []
+            workers = [threading.Thread(target=lambda worker_id=worker_id: processed.append(
+                run_worker(FileQueue(tmp / 'queue'), worker_id=worker_id, idle_timeout=0.2, poll_interval=0.05)))
+                       for worker_id in ['w1', 'w2', 'w3']]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+            self.assertEqual(20, sum(processed))
+            self.assertEqual(0, queue.depth())
+            self.assertEqual({str(idx): 'x' for idx in range(20)}, {p.name: p.text() for p in out_dir.files()})
+            exit_codes = [result['exit_code'] for _, result in queue.results()]
+            self.assertEqual(10, exit_codes.count(1))
+
+    def test_requeue_stale(self):
+        with tempdir() as tmp:
+            queue = FileQueue(tmp)
+            queue.put({'command': [sys.executable, '-c', 'exit(3)']}, spec_id='0001')
+            queue.put({'command': ['true']}, spec_id='0002')
+            # worker which claimed first spec died long ago; second one is run right now
+            self.assertEqual('0001', queue.claim()[0])
+            self.assertEqual('0002', queue.claim()[0])
+            stale_path = tmp / FileQueue.RUNNING / FileQueue.spec_filename('0001')
+            os.utime(stale_path, (time.time() - 1000, time.time() - 1000))
+
+            self.assertEqual(1, run_worker(queue, worker_id='w1', idle_timeout=0.2, poll_interval=0.05, lease=100))
+            self.assertEqual([('0001', 3)], [(spec_id, result['exit_code']) for spec_id, result in queue.results()])
+            self.assertEqual([FileQueue.spec_filename('0002')], os.listdir(tmp / FileQueue.RUNNING))
+
+    def test_heartbeat(self):
+        with tempdir() as tmp:
+            queue = FileQueue(tmp)
+            queue.put({'command': [sys.executable, '-c', 'import time; time.sleep(0.5)']}, spec_id='0001')
+            # lease shorter than experiment is extended by heartbeats, thus experiment is run once
+            processed = []
+            workers = [threading.Thread(target=lambda worker_id=worker_id: processed.append(
+                run_worker(FileQueue(tmp), worker_id=worker_id, idle_timeout=0.8, poll_interval=0.05,
+                           heartbeat_interval=0.05, lease=0.3))) for worker_id in ['w1', 'w2']]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            self.assertEqual(1, sum(processed))